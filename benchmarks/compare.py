@@ -0,0 +1,45 @@
+import argparse
+import json
+import sys
+
+
+# Compares two run_benchmarks result files case by case and returns the list of regressions: cases whose time or
+# peak memory grew by more than `tolerance` (0.1 = 10%).
+def compare(baseline, candidate, tolerance=0.1):
+    baseline_results = {(record['case'], record['size']): record for record in baseline['results']}
+    regressions = []
+    print(f"{'case':<28} {'size':>9}  {'time':>10} {'change':>8}  {'peak MB':>9} {'change':>8}")
+    for record in candidate['results']:
+        key = (record['case'], record['size'])
+        if key not in baseline_results:
+            print(f"{key[0]:<28} {key[1]:>9}  {record['seconds']:10.4f} {'new':>8}")
+            continue
+        base = baseline_results[key]
+        time_change = record['seconds'] / base['seconds'] - 1 if base['seconds'] else 0.0
+        memory_change = record['peak_bytes'] / base['peak_bytes'] - 1 if base['peak_bytes'] else 0.0
+        flags = []
+        if time_change > tolerance:
+            flags.append('SLOWER')
+        if memory_change > tolerance:
+            flags.append('MORE MEMORY')
+        if flags:
+            regressions.append((key, time_change, memory_change))
+        print(f"{key[0]:<28} {key[1]:>9}  {record['seconds']:10.4f} {time_change:+8.1%}  "
+              f"{record['peak_bytes'] / 2 ** 20:9.1f} {memory_change:+8.1%}  {' '.join(flags)}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs and report regressions.")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    regressions = compare(baseline, candidate, args.tolerance)
+    print(f"\n{len(regressions)} regression(s)")
+    sys.exit(1 if regressions else 0)
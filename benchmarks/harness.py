@@ -0,0 +1,26 @@
+import gc
+import statistics
+import time
+import tracemalloc
+
+
+# Times `func` (called with no arguments) `repeat` times, then runs it once more under tracemalloc to get the peak
+# memory it allocated. Tracing is kept out of the timed runs because it slows allocations down considerably.
+# Returns {'seconds': best time, 'median_seconds': ..., 'peak_bytes': ...}.
+def measure(func, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': min(timings), 'median_seconds': statistics.median(timings), 'peak_bytes': peak}
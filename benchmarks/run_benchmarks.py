@@ -0,0 +1,169 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+from benchmarks.harness import measure
+from benchmarks.synthetic_playlist import write_playlist_xml
+from graph_formation import graph_functions as gf
+from graph_formation.pyvis_export import export_graph
+from playlist_io.playlist_store import convert_playlist
+from shuffle import shuffle_functions as sf
+from shuffle.song_index import SongIndex
+from shuffle.cluster_shuffle import ClusterSearch, generate_cluster_queue
+from graph_formation.communities import Clustering
+
+# Usage, from the repository root:
+#   python -m benchmarks.run_benchmarks --sizes 1000 10000 --output output/bench_new.json
+#   python -m benchmarks.compare output/bench_old.json output/bench_new.json
+
+ATTRIBUTES = ['danceability', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness', 'liveness',
+              'valence', 'tempo']
+WEIGHTS = {'danceability': 1.2, 'energy': 1.5, 'loudness': 1, 'speechiness': 1, 'acousticness': 1.2,
+           'instrumentalness': 1.2, 'liveness': 1, 'valence': 0.8, 'tempo': 0}
+NUM_QUERIES = 20
+QUEUE_LENGTH = 100
+
+
+# Every benchmark case: (name, largest size it is run at, function taking the context and returning the callable
+# to measure). The context holds the XML path, the parsed songs and a few random seed songs. Cases that write a file
+# set the callable's output_file attribute, and its size is recorded as output_bytes.
+def _cases():
+    def parse_xml(context):
+        return lambda: sf.parse_xml(context['xml_file'])
+
+    def read_all_audio_features(context):
+        return lambda: gf.read_all_audio_features(context['xml_file'])
+
+    def open_store(context):
+        convert_playlist(context['xml_file'])
+        return lambda: sf.load_songs(context['xml_file'])
+
+    def find_similar_songs(context):
+        return lambda: [sf.find_similar_songs(song_id, context['songs'], WEIGHTS, ATTRIBUTES)
+                        for song_id in context['seeds']]
+
+    def build_song_index(context):
+        return lambda: SongIndex(context['songs'], WEIGHTS, ATTRIBUTES)
+
+    def query_song_index(context):
+        index = SongIndex(context['songs'], WEIGHTS, ATTRIBUTES, backend='kdtree')
+        return lambda: [index.query(song_id) for song_id in context['seeds']]
+
+    def generate_song_queue(context):
+        index = SongIndex(context['songs'], WEIGHTS, ATTRIBUTES, backend='kdtree', cache_size=0)
+        return lambda: sf.generate_song_queue(context['seeds'][0], context['songs'], WEIGHTS, ATTRIBUTES,
+                                              QUEUE_LENGTH, index=index)
+
+    def build_clusters(context):
+        index = SongIndex(context['songs'], WEIGHTS, ATTRIBUTES, cache_size=0)
+        return lambda: Clustering.from_vectors(index.vectors, index.song_ids)
+
+    # Same queue as generate_song_queue, searching the current song's cluster and its neighbours only
+    def generate_cluster_queue_case(context):
+        index = SongIndex(context['songs'], WEIGHTS, ATTRIBUTES, backend='kdtree', cache_size=0)
+        search = ClusterSearch(index, Clustering.from_vectors(index.vectors, index.song_ids))
+        return lambda: generate_cluster_queue(context['seeds'][0], context['songs'], WEIGHTS, ATTRIBUTES, search,
+                                              QUEUE_LENGTH)
+
+    def similarity_graph_threshold(context):
+        return lambda: gf.create_similarity_graph_threshold(context['xml_file'], 'cosine', 0.985, output='sparse')
+
+    def similarity_graph_number(context):
+        all_features, titles = gf.read_all_audio_features(context['xml_file'])
+        return lambda: gf.create_similarity_graph_number(all_features, titles, 10, output='sparse')
+
+    def _topk_graph(context):
+        if 'topk_graph' not in context:
+            all_features, titles = gf.read_all_audio_features(context['xml_file'])
+            context['topk_graph'] = gf.create_similarity_graph_number(all_features, titles, 10, output='sparse')
+        return context['topk_graph']
+
+    def export_pyvis(context):
+        graph = _topk_graph(context)
+        filename = os.path.join(context['directory'], 'pyvis.html')
+        func = lambda: gf.draw_graph_with_pyvis(graph, filename)
+        func.output_file = filename
+        return func
+
+    # Layout computed on every call (no cache), so it's the full cost of a first export
+    def export_vis_compact(context):
+        graph = _topk_graph(context)
+        filename = os.path.join(context['directory'], 'compact.html')
+        func = lambda: export_graph(graph, filename)
+        func.output_file = filename
+        return func
+
+    return [
+        ('parse_xml', 1000000, parse_xml),
+        ('read_all_audio_features', 1000000, read_all_audio_features),
+        ('load_songs_from_store', 1000000, open_store),
+        ('find_similar_songs', 100000, find_similar_songs),
+        ('build_song_index', 1000000, build_song_index),
+        ('query_song_index', 1000000, query_song_index),
+        ('generate_song_queue', 1000000, generate_song_queue),
+        ('build_clusters', 1000000, build_clusters),
+        ('generate_cluster_queue', 1000000, generate_cluster_queue_case),
+        ('similarity_graph_threshold', 20000, similarity_graph_threshold),
+        ('similarity_graph_number', 20000, similarity_graph_number),
+        ('export_pyvis', 5000, export_pyvis),
+        ('export_vis_compact', 20000, export_vis_compact),
+    ]
+
+
+def run(sizes, cases=None, repeat=3, seed=0):
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            xml_file = os.path.join(directory, f"playlist_{size}.xml")
+            write_playlist_xml(xml_file, size, seed)
+            songs = sf.parse_xml(xml_file)
+            rng = np.random.default_rng(seed)
+            context = {
+                'directory': directory,
+                'xml_file': xml_file,
+                'songs': songs,
+                'seeds': [songs[i]['id'] for i in rng.choice(len(songs), min(NUM_QUERIES, len(songs)), replace=False)],
+            }
+            for name, max_size, setup in _cases():
+                if (cases and name not in cases) or size > max_size:
+                    continue
+                # The builders print progress, keep the report readable
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                    func = setup(context)
+                    result = measure(func, repeat)
+                result.update({'case': name, 'size': size})
+                output_file = getattr(func, 'output_file', None)
+                if output_file and os.path.exists(output_file):
+                    result['output_bytes'] = os.path.getsize(output_file)
+                records.append(result)
+                output = f"  {result['output_bytes'] / 2 ** 20:8.2f}MB file" if 'output_bytes' in result else ''
+                print(f"{name:<28} {size:>9} tracks  {result['seconds']:10.4f}s  "
+                      f"{result['peak_bytes'] / 2 ** 20:10.1f}MB peak{output}")
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the shuffle and graph hot paths on synthetic playlists.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--cases', nargs='+', help="Only run these cases")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    records = run(args.sizes, args.cases, args.repeat, args.seed)
+    if args.output:
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'results': records,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,71 @@
+import argparse
+import numpy as np
+from xml.sax.saxutils import escape
+
+# Number of tracks drawn and written at once
+CHUNK_SIZE = 10000
+
+
+# Draws n tracks' audio features from distributions shaped like Spotify's catalogue: most attributes are skewed
+# betas in [0, 1], loudness is in negative dB around -7, tempo is in BPM around 120, and instrumentalness is ~0 for
+# most (vocal) tracks. Returns {attribute: array}.
+def sample_audio_features(n, rng):
+    vocal = rng.random(n) < 0.65
+    return {
+        'danceability': rng.beta(5, 3.5, n),
+        'energy': rng.beta(3, 1.8, n),
+        'key': rng.integers(0, 12, n),
+        'loudness': -np.clip(rng.gamma(2, 3.5, n), 0.5, 60),
+        'mode': (rng.random(n) < 0.65).astype(int),
+        'speechiness': 0.022 + rng.beta(0.8, 9, n) * 0.9,
+        'acousticness': rng.beta(0.45, 1, n),
+        'instrumentalness': np.where(vocal, rng.exponential(2e-5, n), rng.beta(1.2, 1, n)),
+        'liveness': 0.02 + rng.beta(1.5, 6, n),
+        'valence': rng.beta(2.2, 2, n),
+        'tempo': np.clip(rng.normal(120, 29, n), 50, 220),
+        'duration_ms': np.clip(rng.normal(230000, 60000, n), 30000, 900000).astype(int),
+        'time_signature': rng.choice([3, 4, 5], n, p=[0.08, 0.9, 0.02]),
+    }
+
+
+# Random 22-character base62 ids, like Spotify track ids
+def sample_track_ids(n, rng):
+    alphabet = np.array(list('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'))
+    return [''.join(row) for row in alphabet[rng.integers(0, len(alphabet), (n, 22))]]
+
+
+# Writes a playlist XML file in the format pull_song_attributes.py produces, chunk by chunk so even 1M tracks only
+# need a few MB of memory. A `missing_rate` fraction of the feature values is left out at random.
+def write_playlist_xml(path, num_tracks, seed=0, missing_rate=0.0):
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<playlist>')
+        for start in range(0, num_tracks, CHUNK_SIZE):
+            n = min(CHUNK_SIZE, num_tracks - start)
+            track_ids = sample_track_ids(n, rng)
+            features = sample_audio_features(n, rng)
+            columns = [(name, values.tolist()) for name, values in features.items()]
+            missing = rng.random((n, len(columns))) < missing_rate
+            for row, track_id in enumerate(track_ids):
+                parts = [f'<track><title>Track {start + row}</title><id>{track_id}</id>'
+                         f'<artist>{escape(f"Artist {rng.integers(0, 5000)}")}</artist>']
+                for column, (name, values) in enumerate(columns):
+                    if not missing[row, column]:
+                        parts.append(f'<{name}>{values[row]}</{name}>')
+                parts.append(f'<type>audio_features</type><uri>spotify:track:{track_id}</uri>'
+                             f'<track_href>https://api.spotify.com/v1/tracks/{track_id}</track_href>'
+                             f'<analysis_url>https://api.spotify.com/v1/audio-analysis/{track_id}</analysis_url>'
+                             f'</track>')
+                f.write(''.join(parts))
+        f.write('</playlist>\n')
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic playlist XML file.")
+    parser.add_argument('num_tracks', type=int)
+    parser.add_argument('path')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--missing-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    write_playlist_xml(args.path, args.num_tracks, args.seed, args.missing_rate)
@@ -0,0 +1,199 @@
+import numpy as np
+from scipy import sparse
+from graph_formation.preprocessing import prepare_features_cached
+from graph_formation.similarity_graph import as_similarity_graph
+from instrumentation import trace
+
+# Splits a library into clusters of similar songs ("moods") once, so later stages can work on a small partition
+# instead of the whole library (see shuffle/cluster_shuffle.py). Two ways to get them:
+#   label_propagation - communities of a SimilarityGraph, linear in the number of edges per iteration
+#   minibatch_kmeans  - k-means on feature vectors from small random batches, so its cost doesn't grow with the
+#                       library beyond the final assignment pass
+# Either way the result is a Clustering (assignments and centroids) that can be saved next to the graph.
+
+# Average cluster size aimed for when the number of k-means clusters isn't given
+DEFAULT_CLUSTER_SIZE = 200
+
+# Number of rows assigned to their nearest centroid at once (keeps the distance block around 32MB)
+ASSIGN_BLOCK_CELLS = 2 ** 22
+
+
+# Community label of every node of a SimilarityGraph (or networkx graph) by label propagation: every node starts in
+# its own community and repeatedly adopts the label with the largest total edge weight among its neighbours. Only a
+# random update_fraction of the nodes moves per iteration, which stops the label swapping synchronous updates fall into.
+# Stops when fewer than tolerance * n nodes change. Returns labels numbered 0..C-1.
+@trace.traced('communities.label_propagation')
+def label_propagation(graph, max_iterations=30, update_fraction=0.5, tolerance=1e-3, seed=0):
+    rng = np.random.default_rng(seed)
+    graph = as_similarity_graph(graph)
+    adjacency = graph.adjacency
+    num_nodes = len(graph)
+    weights = np.maximum(adjacency.data, 0).astype(np.float64)
+    labels = np.arange(num_nodes)
+    has_neighbors = np.diff(adjacency.indptr) > 0
+    for _ in range(max_iterations):
+        # scores[i, c] = total weight of the edges from i to nodes labelled c, with a little noise to break ties
+        members = sparse.csr_array((np.ones(num_nodes), (np.arange(num_nodes), labels)), shape=(num_nodes, num_nodes))
+        scores = sparse.csr_array((weights, adjacency.indices, adjacency.indptr), shape=adjacency.shape) @ members
+        scores.sum_duplicates()
+        scores.data *= 1 + 1e-9 * rng.random(len(scores.data))
+        best = _row_argmax(scores, labels)
+
+        update = has_neighbors & (rng.random(num_nodes) < update_fraction)
+        changed = int((update & (best != labels)).sum())
+        labels = np.where(update, best, labels)
+        if changed <= tolerance * num_nodes:
+            break
+    return np.unique(labels, return_inverse=True)[1]
+
+
+# Column of the largest stored entry of every row of a CSR matrix (`default` for empty rows)
+def _row_argmax(matrix, default):
+    best = np.array(default, copy=True)
+    lengths = np.diff(matrix.indptr)
+    nonempty = lengths > 0
+    if not nonempty.any():
+        return best
+    rows = np.repeat(np.arange(matrix.shape[0]), lengths)
+    row_max = np.full(matrix.shape[0], -np.inf)
+    row_max[nonempty] = np.maximum.reduceat(matrix.data, matrix.indptr[:-1][nonempty])
+    entries = np.flatnonzero(matrix.data == row_max[rows])
+    first = np.unique(rows[entries], return_index=True)[1]  # First maximum of every row
+    best[rows[entries[first]]] = matrix.indices[entries[first]]
+    return best
+
+
+# Index of the closest centroid of every vector, computed in blocks
+def nearest_centroid(vectors, centroids):
+    labels = np.empty(len(vectors), dtype=np.int64)
+    squared_norms = np.einsum('ij,ij->i', centroids, centroids)
+    block_size = max(1, ASSIGN_BLOCK_CELLS // max(len(centroids), 1))
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        # ||x||^2 is the same for every centroid, so it can be left out of the argmin
+        labels[start:start + len(block)] = np.argmin(squared_norms[None, :] - 2 * block @ centroids.T, axis=1)
+    return labels
+
+
+# k-means++ seeding: every new centroid is drawn with probability proportional to its squared distance to the
+# closest centroid picked so far
+def _kmeans_plus_plus(vectors, num_clusters, rng):
+    centroids = np.empty((num_clusters, vectors.shape[1]))
+    centroids[0] = vectors[rng.integers(len(vectors))]
+    closest = np.einsum('ij,ij->i', vectors - centroids[0], vectors - centroids[0])
+    for cluster in range(1, num_clusters):
+        total = closest.sum()
+        choice = rng.choice(len(vectors), p=closest / total) if total > 0 else rng.integers(len(vectors))
+        centroids[cluster] = vectors[choice]
+        difference = vectors - centroids[cluster]
+        np.minimum(closest, np.einsum('ij,ij->i', difference, difference), out=closest)
+    return centroids
+
+
+# Mini-batch k-means (Sculley 2010): centroids are seeded with k-means++ on a sample, then every iteration moves them
+# towards the mean of the batch songs assigned to them with a per-centroid learning rate of 1 / songs seen, so they
+# converge to running means. A final pass assigns every vector and sets the centroids to their clusters' means;
+# clusters left empty are dropped. Returns (labels numbered 0..C-1, (C, d) centroids).
+@trace.traced('communities.minibatch_kmeans')
+def minibatch_kmeans(vectors, num_clusters, batch_size=1024, iterations=100, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float64)
+    num_clusters = max(1, min(num_clusters, len(vectors)))
+    sample_size = min(len(vectors), max(batch_size, 4 * num_clusters))
+    centroids = _kmeans_plus_plus(vectors[rng.choice(len(vectors), sample_size, replace=False)], num_clusters, rng)
+
+    seen = np.zeros(num_clusters)
+    for _ in range(iterations):
+        batch = vectors[rng.integers(len(vectors), size=batch_size)]
+        assigned = nearest_centroid(batch, centroids)
+        batch_counts = np.bincount(assigned, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assigned, batch)
+        seen += batch_counts
+        moved = batch_counts > 0
+        centroids[moved] += (sums[moved] - batch_counts[moved, None] * centroids[moved]) / seen[moved, None]
+
+    labels = nearest_centroid(vectors, centroids)
+    used, labels = np.unique(labels, return_inverse=True)
+    return labels, cluster_means(vectors, labels, len(used))
+
+
+# Mean vector of every cluster
+def cluster_means(vectors, labels, num_clusters):
+    sums = np.zeros((num_clusters, vectors.shape[1]))
+    np.add.at(sums, labels, vectors)
+    return sums / np.maximum(np.bincount(labels, minlength=num_clusters), 1)[:, None]
+
+
+# Cluster assignment of a library: labels[i] is the cluster of track_ids[i], and centroids (when known) the mean
+# feature vector of every cluster, in the space the clustering was computed in
+class Clustering:
+    def __init__(self, track_ids, labels, centroids=None, method='kmeans'):
+        self.track_ids = list(track_ids)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.centroids = centroids
+        self.method = method
+        self.index = {track_id: position for position, track_id in enumerate(self.track_ids)}
+
+    # Clusters of a SimilarityGraph by label propagation. Pass the vectors of the graph's tracks (in track_ids
+    # order) to get centroids too.
+    @classmethod
+    def from_graph(cls, graph, vectors=None, **options):
+        graph = as_similarity_graph(graph)
+        labels = label_propagation(graph, **options)
+        centroids = cluster_means(np.asarray(vectors, dtype=np.float64), labels, int(labels.max()) + 1) \
+            if vectors is not None and len(labels) else None
+        return cls(graph.track_ids, labels, centroids, 'label_propagation')
+
+    # Clusters of (n, d) vectors by mini-batch k-means, with about DEFAULT_CLUSTER_SIZE songs per cluster unless
+    # num_clusters is given
+    @classmethod
+    def from_vectors(cls, vectors, track_ids, num_clusters=None, **options):
+        if num_clusters is None:
+            num_clusters = int(np.ceil(len(vectors) / DEFAULT_CLUSTER_SIZE))
+        labels, centroids = minibatch_kmeans(vectors, num_clusters, **options)
+        return cls(track_ids, labels, centroids, 'kmeans')
+
+    # k-means on a FeatureMatrix, scaled and weighted like the shuffle (see preprocessing.prepare_features) so
+    # loudness and tempo don't decide the clusters on their own. Missing values count as the attribute's center.
+    @classmethod
+    def from_features(cls, feature_matrix, num_clusters=None, weights=None, scaling='minmax', **options):
+        prepared = prepare_features_cached(feature_matrix.values, feature_matrix.mask, feature_matrix.attributes,
+                                           weights, scaling)
+        return cls.from_vectors(prepared.vectors, feature_matrix.track_ids, num_clusters, **options)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    @property
+    def num_clusters(self):
+        return int(self.labels.max()) + 1 if len(self.labels) else 0
+
+    @property
+    def sizes(self):
+        return np.bincount(self.labels, minlength=self.num_clusters)
+
+    # Cluster of a track, or None if the clustering doesn't know it
+    def cluster_of(self, track_id):
+        position = self.index.get(track_id)
+        return None if position is None else int(self.labels[position])
+
+    def members(self, cluster):
+        return [self.track_ids[position] for position in np.flatnonzero(self.labels == cluster).tolist()]
+
+    # Cluster of the closest centroid of each vector (e.g. tracks added after the clustering was computed)
+    def assign(self, vectors):
+        if self.centroids is None:
+            raise ValueError("This clustering has no centroids")
+        return nearest_centroid(np.asarray(vectors, dtype=np.float64), self.centroids)
+
+    def save(self, path):
+        centroids = self.centroids if self.centroids is not None else np.empty((0, 0))
+        np.savez(path, track_ids=np.array(self.track_ids, dtype=str), labels=self.labels, centroids=centroids,
+                 has_centroids=self.centroids is not None, method=self.method)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            centroids = saved['centroids'] if bool(saved['has_centroids']) else None
+            return cls(saved['track_ids'].tolist(), saved['labels'], centroids, str(saved['method']))
@@ -0,0 +1,172 @@
+import numpy as np
+from playlist_io.xml_stream import iter_feature_batches
+from graph_formation.preprocessing import prepare_features_cached
+from instrumentation import trace
+
+# Target number of float32 cells in one block of the similarity matrix (~16MB). Each block is a handful of
+# temporaries of this size, so peak memory stays bounded no matter how many tracks are in the library.
+BLOCK_CELLS = 2 ** 22
+
+
+# Dense, contiguous view of the audio features of a library. Rows are tracks, columns are attributes. Missing values
+# are stored as 0 in `values` and flagged False in `mask`, so every pairwise operation can be done with matrix
+# products over the whole library instead of rebuilding vectors from dicts for every pair.
+class FeatureMatrix:
+    def __init__(self, values, mask, track_ids, attributes, titles=None):
+        self.mask = np.ascontiguousarray(mask, dtype=bool)
+        self.values = np.ascontiguousarray(np.where(self.mask, values, 0), dtype=np.float32)
+        self.track_ids = list(track_ids)
+        self.index = {track_id: row for row, track_id in enumerate(self.track_ids)}
+        self.attributes = list(attributes)
+        self.titles = titles if titles is not None else {}
+
+    # Builds the matrix from the ({track_id: {attribute: value}}, {track_id: title}) pair returned by
+    # read_all_audio_features
+    @classmethod
+    def from_audio_features(cls, all_features, titles, attributes):
+        track_ids = list(all_features.keys())
+        values = np.zeros((len(track_ids), len(attributes)), dtype=np.float32)
+        mask = np.zeros((len(track_ids), len(attributes)), dtype=bool)
+        columns = {attribute: column for column, attribute in enumerate(attributes)}
+        for row, track_id in enumerate(track_ids):
+            for attribute, value in all_features[track_id].items():
+                column = columns.get(attribute)
+                if column is not None:
+                    values[row, column] = value
+                    mask[row, column] = True
+        return cls(values, mask, track_ids, attributes, titles)
+
+    # Builds the matrix from (track_ids, titles, values, mask) batches such as the ones iter_feature_batches yields,
+    # copying each batch into a growing array so no per-track dicts are ever built
+    @classmethod
+    def from_batches(cls, batches, attributes):
+        values = np.zeros((0, len(attributes)), dtype=np.float32)
+        mask = np.zeros((0, len(attributes)), dtype=bool)
+        track_ids = []
+        titles = {}
+        for batch_ids, batch_titles, batch_values, batch_mask in batches:
+            start = len(track_ids)
+            stop = start + len(batch_ids)
+            if stop > len(values):
+                capacity = max(stop, 2 * len(values))
+                values = np.resize(values, (capacity, len(attributes)))
+                mask = np.resize(mask, (capacity, len(attributes)))
+            values[start:stop] = batch_values
+            mask[start:stop] = batch_mask
+            track_ids.extend(batch_ids)
+            titles.update(zip(batch_ids, batch_titles))
+        return cls(values[:len(track_ids)], mask[:len(track_ids)], track_ids, attributes, titles)
+
+    # Streams the features of a playlist XML file into a matrix (titles are only kept for tracks with features)
+    @classmethod
+    @trace.traced('parse.feature_matrix_from_xml')
+    def from_xml(cls, xml_file, attributes):
+        return cls.from_batches(iter_feature_batches(xml_file, attributes), attributes)
+
+    # Builds the matrix straight from the arrays of a PlaylistStore, with the same rules as read_all_audio_features:
+    # only non-negative values count as features and tracks without any feature are left out. Deleted tracks are
+    # skipped, and `rows` limits the matrix to those store rows (e.g. the ones a sync just appended).
+    @classmethod
+    @trace.traced('features.from_store')
+    def from_store(cls, store, attributes, rows=None):
+        attributes = [name for name in attributes if name in store.numeric_columns]
+        values, mask = store.features(attributes)
+        mask = mask & (np.nan_to_num(values, nan=-1) >= 0)
+        ids = store.ids
+        keep = ~store.deleted & np.array([track_id is not None for track_id in ids], dtype=bool)
+        if rows is not None:
+            keep &= np.isin(np.arange(len(store)), rows)
+        track_titles = store.strings('title')
+        titles = {ids[row]: track_titles[row] if track_titles[row] is not None else 'No Title'
+                  for row in np.flatnonzero(keep).tolist()}
+        rows = np.flatnonzero(keep & mask.any(axis=1))
+        return cls(values[rows], mask[rows], [ids[row] for row in rows.tolist()], attributes, titles)
+
+    # Copy of the matrix with every attribute rescaled over the library and the weights folded in (see
+    # preprocessing.prepare_features), so the similarity blocks compute weighted similarities with plain matrix products
+    def prepared(self, weights=None, scaling='none', similarity_metric='euclidean'):
+        if not weights and scaling == 'none':
+            return self
+        prepared = prepare_features_cached(self.values, self.mask, self.attributes, weights, scaling, similarity_metric,
+                                           dtype=np.float32)
+        return FeatureMatrix(prepared.vectors, self.mask, self.track_ids, self.attributes, self.titles)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    # Returns the row of a track, or None if the track has no features
+    def row(self, track_id):
+        return self.index.get(track_id)
+
+
+# Picks a number of rows per block so a block of the n x n similarity matrix stays around BLOCK_CELLS cells
+def default_block_size(num_tracks):
+    return max(1, min(num_tracks, BLOCK_CELLS // max(num_tracks, 1)))
+
+
+# Similarity of the rows `rows_values` / `rows_mask` against every track of `values` / `mask`, computed only over the
+# attributes both tracks have (the same rule compute_similarity applies per pair). Returns (sim, valid), where valid
+# is False when the tracks share no attributes, when the similarity is undefined, or when it is exactly 0, matching
+# the pairs the per-pair code skipped.
+@trace.traced('similarity.block')
+def block_similarity(rows_values, rows_mask, values, mask, similarity_metric='cosine'):
+    rows_present = rows_mask.astype(np.float32)
+    present = mask.astype(np.float32)
+    rows_squares = rows_values * rows_values
+    squares = values * values
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        common = rows_present @ present.T
+        dot = rows_values @ values.T
+        # Squared norms of each side restricted to the attributes shared with the other track
+        norms1 = rows_squares @ present.T
+        norms2 = rows_present @ squares.T
+
+        if similarity_metric == 'euclidean':
+            distance = np.sqrt(np.maximum(norms1 + norms2 - 2 * dot, 0))
+            sim = 1 / (1 + distance)
+        elif similarity_metric == 'cosine':
+            sim = dot / np.sqrt(norms1 * norms2)
+        else:
+            raise ValueError("Invalid similarity metric. Choose 'euclidean' or 'cosine'.")
+
+        valid = (common > 0) & np.isfinite(sim) & (sim != 0)
+    return sim, valid
+
+
+# Keeps the k most similar valid tracks of every row of a similarity block, ignoring the track itself (row i of the
+# block is track `start + i`). Returns (indices, sims) arrays of shape (rows, k), most similar first; rows with fewer
+# than k valid neighbours are padded with index -1 and similarity -inf.
+def block_top_k(sim, valid, start, k):
+    rows = np.arange(len(sim))
+    sim = np.where(valid, sim, -np.inf).astype(np.float32, copy=False)
+    self_columns = start + rows
+    in_block = self_columns < sim.shape[1]
+    sim[rows[in_block], self_columns[in_block]] = -np.inf  # Don't connect a song to itself
+    k = min(k, sim.shape[1])
+    top = np.argpartition(-sim, k - 1, axis=1)[:, :k] if k < sim.shape[1] else \
+        np.broadcast_to(np.arange(sim.shape[1]), sim.shape)
+    top_sim = np.take_along_axis(sim, top, axis=1)
+    order = np.argsort(-top_sim, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1).astype(np.int32)
+    top_sim = np.take_along_axis(top_sim, order, axis=1)
+    top[~np.isfinite(top_sim)] = -1
+    return top, top_sim
+
+
+# Generator that yields the pairwise similarity matrix one block of rows at a time, as (start, stop, sim, valid).
+# `sim[i, j]` is the similarity between track start + i and track j (see block_similarity).
+def iter_similarity_blocks(feature_matrix, similarity_metric='cosine', block_size=None):
+    if similarity_metric not in ('euclidean', 'cosine'):
+        raise ValueError("Invalid similarity metric. Choose 'euclidean' or 'cosine'.")
+
+    values = feature_matrix.values
+    mask = feature_matrix.mask
+    num_tracks = len(feature_matrix)
+    if block_size is None:
+        block_size = default_block_size(num_tracks)
+
+    for start in range(0, num_tracks, block_size):
+        stop = min(start + block_size, num_tracks)
+        sim, valid = block_similarity(values[start:stop], mask[start:stop], values, mask, similarity_metric)
+        yield start, stop, sim, valid
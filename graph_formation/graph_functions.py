@@ -1,13 +1,18 @@
 import numpy as np
 from scipy.spatial.distance import euclidean, cosine
-import xml.etree.ElementTree as ET
 import networkx as nx
 from pyvis.network import Network
-from tqdm import tqdm
-from itertools import combinations
-from multiprocessing import Pool
 import matplotlib.pyplot as plt
-from collections import defaultdict
+import matplotlib.colors as mcolors
+from matplotlib.collections import LineCollection
+from playlist_io.playlist_store import load_playlist
+from playlist_io.xml_stream import iter_tracks, is_feature_text
+from graph_formation.feature_matrix import FeatureMatrix
+from graph_formation.topk_graph import create_similarity_graph_topk
+from graph_formation.threshold_graph import threshold_edges
+from instrumentation import trace
+from graph_formation.similarity_graph import SimilarityGraph, as_networkx, as_similarity_graph
+from graph_formation.layout import compute_layout
 
 # Attributes to take into account when forming the graph
 SELECTED_ATTRIBUTES = ['danceability', 
@@ -18,27 +23,44 @@ SELECTED_ATTRIBUTES = ['danceability',
                        'liveness', 
                        'valence']
 
+# Defaults for draw_graph_with_matplotlib
+DEFAULT_MATPLOTLIB_SETTINGS = {
+    "figsize": (20, 20),
+    "k": None,
+    "iterations": 50,
+    "node_size": 300,
+    "node_color": "skyblue",
+    "layout": "auto",
+    "layout_cache": "../output/layout_cache",
+    "labels": True,
+}
+
 # Function takes in a file path to an XML file and returns two arrays, one with all the attribute values, and one 
 # with all the track names
+@trace.traced('parse.read_all_audio_features')
 def read_all_audio_features(xml_file):
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
     all_features = {}
     titles = {}  # To store the titles
-    for track in root.findall('track'):
-        track_id = track.find('id').text
-        title = track.find('title').text if track.find('title') is not None else 'No Title'
-        titles[track_id] = title  # Store the title
+    for track in iter_tracks(xml_file):
+        track_id = track['id']
+        titles[track_id] = track.get('title', 'No Title')  # Store the title
         features = {}
-        for feature in track:
-            if feature.tag in SELECTED_ATTRIBUTES and feature.text.replace('.', '', 1).isdigit():
-                features[feature.tag] = float(feature.text)
+        for tag, text in track.items():
+            if tag in SELECTED_ATTRIBUTES and is_feature_text(text):
+                features[tag] = float(text)
         if features:
             all_features[track_id] = features
     return all_features, titles
 
+# Same output as read_all_audio_features, but read from the playlist's binary store (rebuilt from the XML file when it
+# is missing or out of date) instead of parsing the XML every time
+def load_audio_features(xml_file):
+    return load_playlist(xml_file).to_audio_features(SELECTED_ATTRIBUTES)
+
 # Function takes in a graph object and a file output name and directory, and it creates a html file of the graph
+@trace.traced('render.pyvis')
 def draw_graph_with_pyvis(graph, filename='graph.html'):
+    graph = as_networkx(graph)
     net = Network(height="750px", width="750px", bgcolor="#222222", font_color="white", select_menu=True)
 
     # for node, attr in graph.nodes(data=True):
@@ -54,38 +76,49 @@ def draw_graph_with_pyvis(graph, filename='graph.html'):
     net.show_buttons(filter_=['physics'])
     net.save_graph(filename)
 
-# Function takes in a graph object and an output directory and name, and it creates a png of the graph
-def draw_graph_with_matplotlib(graph, settings, filename='graph.png'):
-    print("Computing layout...")
-    plt.figure(figsize=settings["figsize"])  # Set the size of the plot
-    pos = nx.spring_layout(graph, k=settings["k"], iterations=settings["iterations"])  # Compute node positions
+# Function takes in a graph object (SimilarityGraph or networkx) and an output directory and name, and it creates a png
+# of the graph. All edges are drawn as one LineCollection and the node positions are cached on disk, so redrawing the
+# same graph only costs the drawing itself. Besides the sizes and colours, settings can pick the "layout" ('auto',
+# 'spring', 'spectral' or 'force', see layout.compute_layout), "layout_cache" (a directory, None to disable) and
+# "labels" (False to skip the titles on big graphs).
+@trace.traced('render.matplotlib')
+def draw_graph_with_matplotlib(graph, settings=None, filename='graph.png'):
+    settings = {**DEFAULT_MATPLOTLIB_SETTINGS, **(settings or {})}
+    graph = as_similarity_graph(graph)
 
-    print("Drawing nodes...")
-    nx.draw_networkx_nodes(graph, pos, node_size=settings["node_size"], node_color=settings["node_color"], alpha=0.7)
+    print("Computing layout...")
+    pos = compute_layout(graph, settings["layout"], iterations=settings["iterations"], k=settings["k"],
+                         cache_dir=settings["layout_cache"])
+    fig, ax = plt.subplots(figsize=settings["figsize"])  # Set the size of the plot
 
     print("Drawing edges...")
-    # Get edge weights (similarities)
-    weights = np.array([data['weight'] for _, _, data in graph.edges(data=True)])
-    # Normalize weights to range between 0.05 and 0.2 for alpha (opacity)
-    alpha_values = 0.05 + (weights - weights.min()) / (weights.max() - weights.min()) * 0.19
-    # Normalize weights to range between 0.1 and 2 for line width
-    linewidths = 0.1 + (weights - weights.min()) / (weights.max() - weights.min()) * 1.9
+    rows, cols, weights = graph.edges()
+    if len(weights):
+        # Normalize weights to range between 0.05 and 0.2 for alpha (opacity), and 0.1 and 2 for line width
+        spread = weights.max() - weights.min()
+        scaled = (weights - weights.min()) / spread if spread > 0 else np.ones_like(weights)
+        colors = np.tile(mcolors.to_rgba('grey'), (len(weights), 1))
+        colors[:, 3] = 0.05 + scaled * 0.19
+        edges = LineCollection(np.stack([pos[rows], pos[cols]], axis=1), colors=colors,
+                               linewidths=0.1 + scaled * 1.9, zorder=1)
+        ax.add_collection(edges)
 
-    # Use tqdm for progress bar
-    edge_data = zip(graph.edges(data=True), alpha_values, linewidths)
-    for (src, dst, data), alpha, linewidth in tqdm(edge_data, total=len(graph.edges), desc="Drawing Edges"):
-        nx.draw_networkx_edges(graph, pos, edgelist=[(src, dst)], width=linewidth, edge_color='grey', alpha=alpha)
+    print("Drawing nodes...")
+    ax.scatter(pos[:, 0], pos[:, 1], s=settings["node_size"], c=settings["node_color"], alpha=0.7, zorder=2)
 
-    print("Adding labels...")
-    labels = nx.get_node_attributes(graph, 'label')
-    nx.draw_networkx_labels(graph, pos, labels, font_size=6, font_color='black')
+    if settings["labels"]:
+        print("Adding labels...")
+        for (x, y), track_id in zip(pos.tolist(), graph.track_ids):
+            ax.text(x, y, graph.titles.get(track_id, track_id), fontsize=6, color='black', ha='center', va='center',
+                    zorder=3)
 
-    plt.title('Song Similarity Graph', size=25)
-    plt.axis('off')  # Turn off the axis
+    ax.set_title('Song Similarity Graph', size=25)
+    ax.axis('off')  # Turn off the axis
+    ax.autoscale_view()
 
     print("Saving figure...")
-    plt.savefig(filename, format='png', bbox_inches='tight', dpi=300)
-    plt.close()  # Close the figure to free memory
+    fig.savefig(filename, format='png', bbox_inches='tight', dpi=300)
+    plt.close(fig)  # Close the figure to free memory
 
 # The following functions are used to compute the similarity between two tracks
 def compute_similarity_pair(args):
@@ -117,52 +150,30 @@ def compute_similarity(features1, features2, similarity_metric='cosine'):
 
     return similarity
 
-def create_similarity_graph_threshold(xml_file, similarity_metric='euclidean', threshold=None):
-    all_features, titles = read_all_audio_features(xml_file)
-    track_ids = list(all_features.keys())
-
-    # Create all pairs of tracks
-    pairs = [(track_id1, track_id2, all_features[track_id1], all_features[track_id2], similarity_metric)
-             for track_id1, track_id2 in combinations(track_ids, 2)]
-
-    G = nx.Graph()
-
-    # Add nodes with titles as labels
-    for track_id, title in titles.items():
-        G.add_node(track_id, label=title)
+# Builds the feature matrix for the attributes the graph builders use
+def build_feature_matrix(all_features, titles):
+    return FeatureMatrix.from_audio_features(all_features, titles, SELECTED_ATTRIBUTES)
+
+# Connects every pair of tracks whose similarity is above the threshold (every pair when threshold is None).
+# output='sparse' returns a SimilarityGraph, output='networkx' the equivalent networkx.Graph with titles as labels.
+# weights and scaling are applied once to the whole feature matrix (see FeatureMatrix.prepared). Candidate pairs come
+# from range queries (see threshold_graph.iter_threshold_edges), so high thresholds never score most of the n^2 pairs.
+@trace.traced('graph_build.threshold')
+def create_similarity_graph_threshold(xml_file, similarity_metric='euclidean', threshold=None, output='networkx',
+                                      weights=None, scaling='none'):
+    if output not in ('networkx', 'sparse'):
+        raise ValueError("Invalid output. Choose 'networkx' or 'sparse'.")
+    feature_matrix = FeatureMatrix.from_store(load_playlist(xml_file), SELECTED_ATTRIBUTES)
+    feature_matrix = feature_matrix.prepared(weights, scaling, similarity_metric)
 
     print("Calculating similarities...")
-    edges = []
-    with Pool(processes=4) as pool:  # Adjust the number of processes based on your machine
-        for result in tqdm(pool.imap_unordered(compute_similarity_pair, pairs), total=len(pairs),
-                           desc="Similarity Calculations"):
-            if result and (threshold is None or result[2]['weight'] > threshold):
-                edges.append(result)
-
-    print("Adding edges...")
-    G.add_edges_from(edges)  # Bulk addition of edges
-    return G
+    rows, cols, sims = threshold_edges(feature_matrix, similarity_metric, threshold)
+    graph = SimilarityGraph.from_edges(rows, cols, sims, feature_matrix.track_ids, feature_matrix.titles)
+    return graph if output == 'sparse' else graph.to_networkx()
 
 # This function makes a graph with a set number of connections per node instead of a hard cutoff:
-def create_similarity_graph_number(all_features, titles, top_n=10):
-    G = nx.Graph()
-
-    # Add nodes
-    for track_id, title in titles.items():
-        G.add_node(track_id, label=title)
-
-    # Compute similarity for each pair and store in a dictionary
-    similarity_dict = defaultdict(list)
-    for track_id1, track_id2 in combinations(all_features.keys(), 2):
-        similarity = compute_similarity(all_features[track_id1], all_features[track_id2])
-        if similarity:
-            similarity_dict[track_id1].append((track_id2, similarity))
-            similarity_dict[track_id2].append((track_id1, similarity))
-
-    # For each node, keep only the top N similarities
-    for track_id, similarities in similarity_dict.items():
-        top_similarities = sorted(similarities, key=lambda x: x[1], reverse=True)[:top_n]
-        for neighbor_id, sim in top_similarities:
-            G.add_edge(track_id, neighbor_id, weight=sim)
-
-    return G
\ No newline at end of file
+@trace.traced('graph_build.number')
+def create_similarity_graph_number(all_features, titles, top_n=10, similarity_metric='cosine', processes=None,
+                                   output='networkx', weights=None, scaling='none'):
+    feature_matrix = build_feature_matrix(all_features, titles).prepared(weights, scaling, similarity_metric)
+    return create_similarity_graph_topk(feature_matrix, top_n, similarity_metric, processes=processes, output=output)
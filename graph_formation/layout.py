@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import numpy as np
+import networkx as nx
+from scipy import sparse
+from scipy.sparse.linalg import eigsh, ArpackNoConvergence
+from instrumentation import trace
+
+# Graphs with more nodes than this use the 'force' layout when the method is 'auto'
+SPRING_LAYOUT_MAX_NODES = 1000
+
+# Number of grid cells per side used to approximate repulsion in the force layout
+FORCE_GRID_SIZE = 32
+
+# Number of nodes whose repulsion is computed at once (keeps the node x cell block around 32MB)
+FORCE_CHUNK_CELLS = 2 ** 22
+
+
+# Hash of a graph's structure and the layout settings, used as the layout cache key
+def graph_hash(graph, layout_settings):
+    digest = hashlib.sha1()
+    digest.update('\n'.join(graph.track_ids).encode('utf-8'))
+    for array in (graph.adjacency.indptr, graph.adjacency.indices, graph.adjacency.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(json.dumps(layout_settings, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Spectral positions from the eigenvectors of the normalized adjacency matrix, computed with a sparse eigensolver.
+# Similar songs end up close together; used on its own or as the starting point of the force layout.
+def spectral_layout(graph, seed=0):
+    rng = np.random.default_rng(seed)
+    num_nodes = len(graph)
+    if num_nodes < 4:
+        return rng.random((num_nodes, 2))
+    adjacency = graph.adjacency.astype(np.float64)
+    degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+    scale = sparse.diags_array(1 / np.sqrt(np.maximum(degrees, 1e-12)))
+    normalized = scale @ adjacency @ scale
+    try:
+        _, vectors = eigsh(normalized, k=3, which='LA', v0=rng.random(num_nodes), maxiter=num_nodes * 20)
+        positions = vectors[:, :2] * 1.0
+    except ArpackNoConvergence:
+        positions = rng.random((num_nodes, 2))
+    # Isolated nodes all land on 0, spread them out a little
+    positions += rng.normal(scale=1e-3 * (np.abs(positions).max() + 1e-12), size=positions.shape)
+    return _rescale(positions)
+
+
+def _rescale(positions):
+    positions = positions - positions.mean(axis=0)
+    extent = np.abs(positions).max()
+    return positions / extent if extent > 0 else positions
+
+
+# Force-directed layout in the spirit of ForceAtlas2 with a Barnes-Hut style approximation. Edges pull their ends
+# together in proportion to weight and distance; repulsion is computed against the centres of mass of a
+# FORCE_GRID_SIZE x FORCE_GRID_SIZE grid instead of every other node, so an iteration costs O(n * cells + edges)
+# instead of O(n^2). Starts from the spectral layout.
+def force_layout(graph, iterations=100, k=None, seed=0):
+    num_nodes = len(graph)
+    positions = spectral_layout(graph, seed)
+    if num_nodes < 2:
+        return positions
+    k = k if k is not None else 1 / np.sqrt(num_nodes)
+    rows, cols, weights = graph.edges()
+    weights = weights.astype(np.float64)
+    temperature = 0.1
+
+    for _ in range(iterations):
+        displacement = np.zeros_like(positions)
+
+        # Attraction along edges: f = d^2 / k, weighted
+        delta = positions[rows] - positions[cols]
+        distance = np.linalg.norm(delta, axis=1) + 1e-9
+        pull = (weights * distance / k)[:, None] * delta
+        np.add.at(displacement, rows, -pull)
+        np.add.at(displacement, cols, pull)
+
+        # Repulsion from grid cell centres of mass: f = k^2 / d, times the number of nodes in the cell
+        low = positions.min(axis=0)
+        span = np.maximum(positions.max(axis=0) - low, 1e-9)
+        cells = np.minimum((positions - low) / span * FORCE_GRID_SIZE, FORCE_GRID_SIZE - 1).astype(np.int64)
+        cell_ids = cells[:, 0] * FORCE_GRID_SIZE + cells[:, 1]
+        mass = np.bincount(cell_ids, minlength=FORCE_GRID_SIZE ** 2).astype(np.float64)
+        occupied = np.flatnonzero(mass)
+        centres = np.stack([np.bincount(cell_ids, positions[:, axis], FORCE_GRID_SIZE ** 2)[occupied]
+                            for axis in (0, 1)], axis=1) / mass[occupied, None]
+        mass = mass[occupied]
+        chunk = max(1, FORCE_CHUNK_CELLS // len(occupied))
+        for start in range(0, num_nodes, chunk):
+            delta = positions[start:start + chunk, None, :] - centres[None, :, :]
+            squared = np.einsum('ijk,ijk->ij', delta, delta) + (k * 1e-2) ** 2
+            displacement[start:start + chunk] += np.einsum('ij,ijk->ik', mass / squared, delta) * k ** 2
+
+        # Move every node at most `temperature`, cooling down over time
+        length = np.linalg.norm(displacement, axis=1) + 1e-9
+        positions += displacement / length[:, None] * np.minimum(length, temperature)[:, None]
+        temperature *= 0.97
+
+    return _rescale(positions)
+
+
+# nx.spring_layout, returned as an array in track_ids order
+def spring_layout(graph, iterations=50, k=None, seed=0):
+    pos = nx.spring_layout(graph.to_networkx(), k=k, iterations=iterations, seed=seed)
+    return np.array([pos[track_id] for track_id in graph.track_ids], dtype=np.float64).reshape(len(graph), 2)
+
+
+LAYOUTS = {
+    'spring': spring_layout,
+    'spectral': lambda graph, iterations=None, k=None, seed=0: spectral_layout(graph, seed),
+    'force': force_layout,
+}
+
+
+# Computes the (n, 2) node positions of a SimilarityGraph. method is 'spring', 'spectral', 'force', or 'auto'
+# (spring for small graphs, force for large ones). When cache_dir is given, layouts are saved there keyed by the graph
+# hash, so drawing the same graph again skips the layout entirely.
+@trace.traced('render.layout')
+def compute_layout(graph, method='auto', iterations=50, k=None, seed=0, cache_dir=None):
+    if method == 'auto':
+        method = 'spring' if len(graph) <= SPRING_LAYOUT_MAX_NODES else 'force'
+    if method not in LAYOUTS:
+        raise ValueError(f"Invalid layout. Expected one of {sorted(LAYOUTS)} or 'auto'")
+
+    cache_path = None
+    if cache_dir is not None:
+        key = graph_hash(graph, {'method': method, 'iterations': iterations, 'k': k, 'seed': seed})
+        cache_path = os.path.join(cache_dir, key + '.npy')
+        if os.path.exists(cache_path):
+            trace.count('layout.cache.hits')
+            return np.load(cache_path)
+        trace.count('layout.cache.misses')
+
+    positions = LAYOUTS[method](graph, iterations=iterations, k=k, seed=seed)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_path, positions)
+    return positions
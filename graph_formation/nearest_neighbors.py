@@ -1,4 +1,9 @@
 import graph_functions as gf
+from graph_formation.pyvis_export import export_graph
+from graph_formation.communities import Clustering
+from graph_formation.feature_matrix import FeatureMatrix
+from graph_formation.topk_graph import TopKTable
+from playlist_io.playlist_store import load_playlist
 
 matplotlib_settings = {
     "figsize": (20, 20),
@@ -11,10 +16,21 @@ matplotlib_settings = {
 number_of_neighbors = 20
 
 xml_file = '../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml'  # The XML file with the audio features
-all_features, titles = gf.read_all_audio_features(xml_file)
-similarity_graph = gf.create_similarity_graph_number(all_features, titles, number_of_neighbors)
+feature_matrix = FeatureMatrix.from_store(load_playlist(xml_file), gf.SELECTED_ATTRIBUTES)
+# Keep the neighbour lists too, so spotify_api/playlist_sync.py can update the graph when the playlist changes
+topk_table = TopKTable.build(feature_matrix, number_of_neighbors)
+topk_table.save("../output/gabeMain_topk.npz")
+similarity_graph = topk_table.to_graph()
+similarity_graph.save("../output/gabeMain_graph.npz")  # Reload later with SimilarityGraph.load
 
-gf.draw_graph_with_pyvis(similarity_graph, "../output/gabeMain.html")
+# Communities of the graph, with their centroids in feature space
+rows = [feature_matrix.row(track_id) for track_id in similarity_graph.track_ids]
+communities = Clustering.from_graph(similarity_graph, feature_matrix.values[rows])
+communities.save("../output/gabeMain_communities.npz")
+print(f"{communities.num_clusters} communities")
+
+# Precomputed layout and pruned edges so the page opens quickly; gf.draw_graph_with_pyvis draws every edge with physics
+export_graph(similarity_graph, "../output/gabeMain.html", layout_cache="../output/layout_cache")
 # gf.draw_graph_with_matplotlib(similarity_graph, matplotlib_settings, filename="../output/beccaGraph.png")
 
 print("Done!")
\ No newline at end of file
@@ -0,0 +1,112 @@
+import hashlib
+import warnings
+from collections import OrderedDict
+import numpy as np
+from instrumentation import trace
+
+# Per-attribute scalings prepare_features knows about:
+#   none   - raw values (what calculate_distance has always used)
+#   minmax - (x - min) / (max - min), every attribute in [0, 1]
+#   zscore - (x - mean) / std
+#   robust - (x - median) / interquartile range, not thrown off by a few extreme tracks
+SCALINGS = ('none', 'minmax', 'zscore', 'robust')
+
+# Number of prepared matrices kept by prepare_features_cached
+PREPARED_CACHE_SIZE = 16
+
+
+# Library features after scaling with the weights folded in, so weighted distances need no per-attribute work:
+#   euclidean: vectors = (x - center) / scale * sqrt(w), and ||a - b|| is the weighted Euclidean distance
+#   cosine:    vectors = (x - center) / scale * w, the same weighting calculate_distance applies before cosine
+# Missing values are 0 in `vectors` and False in `mask`.
+class PreparedFeatures:
+    def __init__(self, vectors, mask, center, scale, multipliers, attributes, scaling, metric):
+        self.vectors = vectors
+        self.mask = mask
+        self.center = center
+        self.scale = scale
+        self.multipliers = multipliers
+        self.attributes = attributes
+        self.scaling = scaling
+        self.metric = metric
+
+    # Applies the same scaling and weights to new rows (e.g. tracks added after the library was prepared)
+    def transform(self, values, mask=None):
+        if mask is None:
+            mask = ~np.isnan(values)
+        vectors = (np.where(mask, values, 0) - self.center) / self.scale * self.multipliers
+        return np.where(mask, vectors, 0).astype(self.vectors.dtype), mask
+
+
+# Per-attribute (center, scale) of the chosen scaling, computed over the values that are present
+def fit_scaling(values, mask, scaling='none'):
+    if scaling not in SCALINGS:
+        raise ValueError(f"Invalid scaling. Expected one of {SCALINGS}")
+    num_attributes = values.shape[1]
+    if scaling == 'none':
+        return np.zeros(num_attributes), np.ones(num_attributes)
+
+    present = np.where(mask, values, np.nan).astype(np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-missing columns
+        if scaling == 'minmax':
+            center = np.nanmin(present, axis=0)
+            scale = np.nanmax(present, axis=0) - center
+        elif scaling == 'zscore':
+            center = np.nanmean(present, axis=0)
+            scale = np.nanstd(present, axis=0)
+        else:
+            center = np.nanmedian(present, axis=0)
+            scale = np.nanpercentile(present, 75, axis=0) - np.nanpercentile(present, 25, axis=0)
+    # Constant or empty attributes keep their values as they are
+    center = np.nan_to_num(center)
+    scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+    return center, scale
+
+
+# Scales the (tracks x attributes) values once and folds the weights in (see PreparedFeatures)
+@trace.traced('features.prepare')
+def prepare_features(values, mask, attributes, weights=None, scaling='none', metric='euclidean', dtype=np.float64):
+    if metric not in ('euclidean', 'cosine'):
+        raise ValueError("Invalid metric. Expected 'euclidean' or 'cosine'")
+    weights = weights or {}
+    column_weights = np.array([weights.get(key, 1) for key in attributes], dtype=np.float64)
+    if np.any(column_weights < 0):
+        raise ValueError("Weights must be non-negative.")
+    multipliers = np.sqrt(column_weights) if metric == 'euclidean' else column_weights
+
+    values = np.asarray(values, dtype=np.float64)
+    mask = np.asarray(mask, dtype=bool)
+    center, scale = fit_scaling(values, mask, scaling)
+    vectors = (np.where(mask, values, 0) - center) / scale * multipliers
+    vectors = np.ascontiguousarray(np.where(mask, vectors, 0), dtype=dtype)
+    return PreparedFeatures(vectors, mask, center, scale, multipliers, list(attributes), scaling, metric)
+
+
+# Hash of a library's values, used to key the cache
+def library_fingerprint(values, mask):
+    digest = hashlib.sha1()
+    digest.update(str(values.shape).encode('utf-8'))
+    digest.update(np.ascontiguousarray(values).tobytes())
+    digest.update(np.ascontiguousarray(mask).tobytes())
+    return digest.hexdigest()
+
+
+_prepared_cache = OrderedDict()
+
+
+# prepare_features, remembered per (library, attributes, weights, scaling, metric) so every index, queue and graph
+# built from the same library and settings shares one prepared matrix
+def prepare_features_cached(values, mask, attributes, weights=None, scaling='none', metric='euclidean',
+                            dtype=np.float64):
+    key = (library_fingerprint(values, mask), tuple(attributes), tuple(sorted((weights or {}).items())), scaling,
+           metric, np.dtype(dtype).str)
+    prepared = _prepared_cache.get(key)
+    trace.count('features.cache.hits' if prepared is not None else 'features.cache.misses')
+    if prepared is None:
+        prepared = prepare_features(values, mask, attributes, weights, scaling, metric, dtype)
+        _prepared_cache[key] = prepared
+        while len(_prepared_cache) > PREPARED_CACHE_SIZE:
+            _prepared_cache.popitem(last=False)
+    _prepared_cache.move_to_end(key)
+    return prepared
@@ -0,0 +1,187 @@
+import json
+import os
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from instrumentation import trace
+from graph_formation.layout import compute_layout
+from graph_formation.similarity_graph import as_similarity_graph
+
+# Browser-friendly alternative to draw_graph_with_pyvis. The layout is computed here (and cached) instead of by the
+# browser's physics engine, edges are pruned to the strongest few per node, and the page carries the graph as a few
+# flat arrays (numeric ids, a title table, integer coordinates) that a small script turns into vis-network data sets.
+# Big libraries can be split into tiles (one page per cluster) with an overview page linking them.
+
+VIS_NETWORK_URL = "https://unpkg.com/vis-network@9.1.9/standalone/umd/vis-network.min.js"
+
+# Edges kept per node by default (an edge stays when it is among the top k of either end)
+DEFAULT_TOP_K = 5
+
+# Target number of nodes per tile for tile_by='grid'
+DEFAULT_TILE_NODES = 2000
+
+# Layout coordinates are scaled so nodes end up roughly this many pixels apart on average
+NODE_SPACING = 40
+
+# Weights are stored as integers in thousandths
+WEIGHT_SCALE = 1000
+
+_PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="{vis_url}"></script>
+<style>
+  html, body {{ margin: 0; height: 100%; background: #222222; color: white; font-family: sans-serif; }}
+  #graph {{ width: 100%; height: 100%; }}
+  #info {{ position: absolute; top: 8px; left: 8px; font-size: 13px; opacity: 0.8; }}
+</style>
+</head>
+<body>
+<div id="info">{title}</div>
+<div id="graph"></div>
+<script>
+const data = {data};
+const nodes = new vis.DataSet(data.titles.map((title, id) => ({{
+  id: id, label: title, x: data.x[id], y: data.y[id],
+  group: data.groups ? data.groups[id] : undefined, link: data.links ? data.links[id] : undefined
+}})));
+const edges = new vis.DataSet(Array.from({{length: data.w.length}}, (_, i) => ({{
+  from: data.e[2 * i], to: data.e[2 * i + 1], value: data.w[i] / {weight_scale}
+}})));
+const network = new vis.Network(document.getElementById("graph"), {{nodes: nodes, edges: edges}}, {{
+  physics: false,
+  nodes: {{shape: "dot", size: 8, font: {{color: "white", size: 10}}}},
+  edges: {{color: {{color: "#888888", opacity: 0.4}}, smooth: false, scaling: {{min: 0.2, max: 3}}}},
+  interaction: {{hideEdgesOnDrag: true, hideEdgesOnZoom: true, tooltipDelay: 100}},
+  layout: {{improvedLayout: false}}
+}});
+network.on("doubleClick", params => {{
+  const node = params.nodes.length ? nodes.get(params.nodes[0]) : null;
+  if (node && node.link) window.location.href = node.link;
+}});
+</script>
+</body>
+</html>
+"""
+
+
+# Edges to draw, as (rows, cols, weights) with every pair once. top_k keeps the k strongest edges of every node (an
+# edge stays when either end ranks it in its top k); quantile keeps only the edges at or above that weight quantile.
+# Both can be combined, and None disables either.
+def prune_edges(graph, top_k=DEFAULT_TOP_K, quantile=None):
+    adjacency = graph.adjacency
+    keep = np.ones(adjacency.nnz, dtype=bool)
+    if top_k is not None:
+        rows = np.repeat(np.arange(len(graph)), np.diff(adjacency.indptr))
+        # Rank of every stored entry within its row, strongest first
+        order = np.lexsort((-adjacency.data, rows))
+        ranks = np.empty(adjacency.nnz, dtype=np.int64)
+        ranks[order] = np.arange(adjacency.nnz) - adjacency.indptr[rows[order]]
+        keep &= ranks < top_k
+    if quantile is not None and adjacency.nnz:
+        keep &= adjacency.data >= np.quantile(adjacency.data, quantile)
+
+    # Copies of the index arrays: eliminate_zeros() compacts them in place and they belong to the graph
+    kept = sparse.csr_array((np.where(keep, adjacency.data, 0), adjacency.indices.copy(), adjacency.indptr.copy()),
+                            shape=adjacency.shape)
+    kept.eliminate_zeros()
+    upper = sparse.triu(kept.maximum(kept.T), k=1).tocoo()
+    return upper.row, upper.col, upper.data
+
+
+# One label per node for tiling: 'components' uses the connected components of the pruned graph, 'grid' cuts the
+# layout into square cells holding about tile_nodes nodes each. An array of labels (e.g. communities) is used as is.
+def tile_labels(tile_by, num_nodes, positions, rows, cols, tile_nodes=DEFAULT_TILE_NODES):
+    if isinstance(tile_by, str) and tile_by == 'components':
+        adjacency = sparse.coo_array((np.ones(len(rows)), (rows, cols)), shape=(num_nodes, num_nodes))
+        return connected_components(adjacency, directed=False)[1]
+    if isinstance(tile_by, str) and tile_by == 'grid':
+        cells = max(1, int(np.ceil(np.sqrt(num_nodes / tile_nodes))))
+        low, high = positions.min(axis=0), positions.max(axis=0)
+        cell = np.minimum(((positions - low) / np.maximum(high - low, 1e-12) * cells).astype(np.int64), cells - 1)
+        return np.unique(cell[:, 0] * cells + cell[:, 1], return_inverse=True)[1]
+    labels = np.asarray(tile_by)
+    if labels.shape != (num_nodes,):
+        raise ValueError("tile_by must be 'components', 'grid' or one label per node")
+    return np.unique(labels, return_inverse=True)[1]
+
+
+# Integer page coordinates of layout positions, spread for num_nodes nodes (defaults to the number of positions)
+def _pixel_coordinates(positions, num_nodes=None):
+    scale = NODE_SPACING * np.sqrt(max(len(positions) if num_nodes is None else num_nodes, 1))
+    return np.round(positions * scale).astype(np.int64)
+
+
+# Writes one page and returns its size in bytes
+def _write_page(filename, title, titles, x, y, rows, cols, weights, groups=None, links=None):
+    data = {
+        'titles': titles,
+        'x': x.tolist(),
+        'y': y.tolist(),
+        'e': np.column_stack([rows, cols]).ravel().tolist(),
+        'w': np.round(np.asarray(weights) * WEIGHT_SCALE).astype(np.int64).tolist(),
+    }
+    if groups is not None:
+        data['groups'] = groups.tolist()
+    if links is not None:
+        data['links'] = links
+    # Compact separators, and no "</" so a title can't close the script tag
+    payload = json.dumps(data, separators=(',', ':'), ensure_ascii=False).replace('</', '<\\/')
+    page = _PAGE_TEMPLATE.format(title=title, vis_url=VIS_NETWORK_URL, data=payload, weight_scale=WEIGHT_SCALE)
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(page)
+    return len(page.encode('utf-8'))
+
+
+# Exports a graph (SimilarityGraph or networkx) to a vis-network page with physics off. The layout comes from
+# layout.compute_layout (cached in layout_cache when given) and edges are pruned with prune_edges. With tile_by set
+# (see tile_labels), every tile is written to its own page next to `filename`, and `filename` becomes an overview
+# with one node per tile (double-click opens it). Returns {'nodes', 'edges', 'files', 'bytes'}.
+@trace.traced('render.export_graph')
+def export_graph(graph, filename='graph.html', top_k=DEFAULT_TOP_K, quantile=None, layout='auto', iterations=50,
+                 layout_cache=None, tile_by=None, tile_nodes=DEFAULT_TILE_NODES, title='Song Similarity Graph'):
+    graph = as_similarity_graph(graph)
+    positions = compute_layout(graph, layout, iterations=iterations, cache_dir=layout_cache)
+    rows, cols, weights = prune_edges(graph, top_k, quantile)
+    known_titles = graph.titles or {}
+    titles = [known_titles.get(track_id, track_id) for track_id in graph.track_ids]
+    pixels = _pixel_coordinates(positions)
+
+    if tile_by is None:
+        size = _write_page(filename, title, titles, pixels[:, 0], pixels[:, 1], rows, cols, weights)
+        return {'nodes': len(graph), 'edges': len(weights), 'files': [filename], 'bytes': size}
+
+    labels = tile_labels(tile_by, len(graph), positions, rows, cols, tile_nodes)
+    num_tiles = int(labels.max()) + 1 if len(labels) else 0
+    base, extension = os.path.splitext(filename)
+    files, total_bytes = [], 0
+    local = np.empty(len(graph), dtype=np.int64)  # Node id within its tile
+    for tile in range(num_tiles):
+        members = np.flatnonzero(labels == tile)
+        local[members] = np.arange(len(members))
+        inside = (labels[rows] == tile) & (labels[cols] == tile)
+        tile_file = f"{base}_tile{tile}{extension}"
+        tile_pixels = _pixel_coordinates(positions[members] - positions[members].mean(axis=0))
+        total_bytes += _write_page(tile_file, f"{title} - tile {tile} ({len(members)} songs)",
+                                   [titles[member] for member in members.tolist()], tile_pixels[:, 0],
+                                   tile_pixels[:, 1], local[rows[inside]], local[cols[inside]], weights[inside])
+        files.append(tile_file)
+
+    # Overview: tiles at the centre of their songs, linked by the number of edges running between them
+    sizes = np.bincount(labels, minlength=num_tiles)
+    centres = np.zeros((num_tiles, 2))
+    np.add.at(centres, labels, positions)
+    centres /= np.maximum(sizes, 1)[:, None]
+    crossing = labels[rows] != labels[cols]
+    between = sparse.coo_array((np.ones(int(crossing.sum())), (labels[rows[crossing]], labels[cols[crossing]])),
+                               shape=(num_tiles, num_tiles)).tocsr()
+    between = sparse.triu(between + between.T, k=1).tocoo()
+    overview_pixels = _pixel_coordinates(centres, len(graph))
+    total_bytes += _write_page(filename, f"{title} - {num_tiles} tiles (double-click to open)",
+                               [f"Tile {tile} ({sizes[tile]} songs)" for tile in range(num_tiles)],
+                               overview_pixels[:, 0], overview_pixels[:, 1], between.row, between.col,
+                               between.data / max(between.data.max(), 1) if between.nnz else between.data,
+                               links=[os.path.basename(tile_file) for tile_file in files])
+    return {'nodes': len(graph), 'edges': len(weights), 'files': [filename] + files, 'bytes': total_bytes}
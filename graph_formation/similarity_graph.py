@@ -0,0 +1,105 @@
+import numpy as np
+import networkx as nx
+from scipy import sparse
+
+
+# Undirected similarity graph stored as a symmetric scipy.sparse CSR adjacency matrix plus the track id of each
+# row/column. A million edges take a few tens of MB here instead of gigabytes of networkx dicts, the graph can be saved
+# and reloaded as a single .npz file, and a networkx.Graph is only built when something asks for one.
+class SimilarityGraph:
+    def __init__(self, adjacency, track_ids, titles=None):
+        track_ids = list(track_ids)
+        titles = dict(titles) if titles is not None else {}
+        # Tracks that have a title but no features become isolated nodes, like in the networkx builders
+        known = set(track_ids)
+        track_ids += [track_id for track_id in titles if track_id not in known]
+        adjacency = sparse.csr_array(adjacency)
+        if adjacency.shape != (len(track_ids), len(track_ids)):
+            adjacency.resize((len(track_ids), len(track_ids)))
+        adjacency.sum_duplicates()
+        adjacency.sort_indices()
+        self.adjacency = adjacency
+        self.track_ids = track_ids
+        self.index = {track_id: position for position, track_id in enumerate(track_ids)}
+        self.titles = titles
+        self._networkx = None
+
+    # Builds the graph from parallel arrays of edge endpoints (positions in track_ids) and weights. With
+    # symmetric=True each edge only needs to be listed once, the reverse direction is added here.
+    @classmethod
+    def from_edges(cls, rows, cols, weights, track_ids, titles=None, symmetric=True):
+        num_nodes = len(track_ids)
+        adjacency = sparse.coo_array((np.asarray(weights, dtype=np.float32), (np.asarray(rows), np.asarray(cols))),
+                                     shape=(num_nodes, num_nodes)).tocsr()
+        if symmetric:
+            adjacency = adjacency.maximum(adjacency.T).tocsr()
+        return cls(adjacency, track_ids, titles)
+
+    # Converts a weighted networkx graph (nodes labelled with titles, as the builders make them)
+    @classmethod
+    def from_networkx(cls, G):
+        track_ids = list(G.nodes)
+        positions = {track_id: position for position, track_id in enumerate(track_ids)}
+        edges = [(positions[src], positions[dst], data.get('weight', 1.0)) for src, dst, data in G.edges(data=True)]
+        rows, cols, weights = zip(*edges) if edges else ((), (), ())
+        titles = {track_id: label for track_id, label in G.nodes(data='label') if label is not None}
+        return cls.from_edges(rows, cols, weights, track_ids, titles)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    @property
+    def num_edges(self):
+        return int(sparse.triu(self.adjacency, k=1).nnz)
+
+    # Positions and weights of the neighbours of the node at `position` (views into the CSR arrays, no copy)
+    def row(self, position):
+        start, stop = self.adjacency.indptr[position], self.adjacency.indptr[position + 1]
+        return self.adjacency.indices[start:stop], self.adjacency.data[start:stop]
+
+    # Track ids and weights of the neighbours of a track
+    def neighbors(self, track_id):
+        positions, weights = self.row(self.index[track_id])
+        return [self.track_ids[position] for position in positions.tolist()], weights
+
+    # Every edge once, as (row positions, column positions, weights) arrays with row < column
+    def edges(self):
+        upper = sparse.triu(self.adjacency, k=1).tocoo()
+        return upper.row, upper.col, upper.data
+
+    # networkx.Graph with the same nodes (labelled with their titles) and weighted edges, built on first use
+    def to_networkx(self):
+        if self._networkx is None:
+            G = nx.Graph()
+            G.add_nodes_from((track_id, {'label': self.titles.get(track_id, track_id)}) for track_id in self.track_ids)
+            rows, cols, weights = self.edges()
+            track_ids = np.array(self.track_ids, dtype=object)
+            G.add_weighted_edges_from(zip(track_ids[rows], track_ids[cols], weights.tolist()))
+            self._networkx = G
+        return self._networkx
+
+    def save(self, path):
+        np.savez(path,
+                 data=self.adjacency.data, indices=self.adjacency.indices, indptr=self.adjacency.indptr,
+                 track_ids=np.array(self.track_ids, dtype=str),
+                 titles=np.array([self.titles.get(track_id, '') for track_id in self.track_ids], dtype=str),
+                 has_title=np.array([track_id in self.titles for track_id in self.track_ids], dtype=bool))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            track_ids = saved['track_ids'].tolist()
+            adjacency = sparse.csr_array((saved['data'], saved['indices'], saved['indptr']),
+                                         shape=(len(track_ids), len(track_ids)))
+            titles = {track_id: title for track_id, title, has_title
+                      in zip(track_ids, saved['titles'].tolist(), saved['has_title'].tolist()) if has_title}
+        return cls(adjacency, track_ids, titles)
+
+
+# Lets the drawing functions take either a SimilarityGraph or a networkx graph
+def as_networkx(graph):
+    return graph.to_networkx() if isinstance(graph, SimilarityGraph) else graph
+
+
+def as_similarity_graph(graph):
+    return graph if isinstance(graph, SimilarityGraph) else SimilarityGraph.from_networkx(graph)
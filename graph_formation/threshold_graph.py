@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+from graph_formation.feature_matrix import block_similarity, default_block_size
+
+# Number of query rows sent to the KD-tree at once; each chunk's candidate pairs are all that is held in memory
+RANGE_QUERY_CHUNK = 2048
+
+# Widens the search radius a little so float rounding never drops a pair that passes the exact similarity check
+RADIUS_SLACK = 1e-5
+
+
+# Radius of the range query equivalent to `similarity > threshold`, in the space the KD-tree is built on, or None
+# when the threshold can't prune anything (every pair would be a candidate):
+#   cosine:    unit vectors, ||a - b||^2 = 2 - 2 cos(a, b), so cos > t  <=>  ||a - b|| < sqrt(2 - 2t)
+#   euclidean: 1 / (1 + d) > t  <=>  d < 1 / t - 1
+def search_radius(similarity_metric, threshold):
+    if similarity_metric == 'cosine':
+        return np.sqrt(2 - 2 * threshold) if threshold > -1 else None
+    if similarity_metric == 'euclidean':
+        return 1 / threshold - 1 if threshold > 0 else None
+    raise ValueError("Invalid similarity metric. Choose 'euclidean' or 'cosine'.")
+
+
+# Pairs (i < j) of the rows in `positions` (complete rows only) whose similarity is above the threshold, found with
+# chunked KD-tree range queries so only candidate pairs are ever scored
+def _range_query_edges(values, positions, similarity_metric, threshold, radius, chunk_size, progress_bar):
+    points = values[positions].astype(np.float64)
+    if similarity_metric == 'cosine':
+        norms = np.linalg.norm(points, axis=1)
+        nonzero = norms > 0  # Cosine similarity with a zero vector is undefined, those rows get no edges
+        progress_bar.update(int((~nonzero).sum()))
+        positions, points = positions[nonzero], points[nonzero] / norms[nonzero, None]
+    if not len(positions):
+        return
+    tree = cKDTree(points)
+    radius = radius * (1 + RADIUS_SLACK) + RADIUS_SLACK
+    for start in range(0, len(points), chunk_size):
+        stop = min(start + chunk_size, len(points))
+        # Dual-tree range search of the chunk against everything, returned as arrays without per-point lists
+        pairs = cKDTree(points[start:stop]).sparse_distance_matrix(tree, radius, output_type='ndarray')
+        progress_bar.update(stop - start)
+        rows = pairs['i'].astype(np.int64) + start
+        cols = pairs['j'].astype(np.int64)
+        keep = cols > rows  # Each pair once
+        rows, cols = positions[rows[keep]], positions[cols[keep]]
+
+        # Exact similarity of the candidates, computed like block_similarity does for complete rows
+        a, b = values[rows], values[cols]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dot = np.einsum('ij,ij->i', a, b)
+            if similarity_metric == 'cosine':
+                sim = dot / np.sqrt(np.einsum('ij,ij->i', a, a) * np.einsum('ij,ij->i', b, b))
+            else:
+                squared = np.einsum('ij,ij->i', a, a) + np.einsum('ij,ij->i', b, b) - 2 * dot
+                sim = 1 / (1 + np.sqrt(np.maximum(squared, 0)))
+        keep = np.isfinite(sim) & (sim != 0) & (sim > threshold)
+        yield rows[keep], cols[keep], sim[keep].astype(np.float32)
+
+
+# Pairs between `positions` and the rows pair_with(block) allows, scored in similarity blocks. Used for rows with
+# missing values (their similarity only counts shared attributes, which a KD-tree can't index) and when the threshold
+# can't prune anything.
+def _blocked_edges(values, mask, positions, similarity_metric, threshold, pair_with, progress_bar):
+    block_size = default_block_size(len(values))
+    for start in range(0, len(positions), block_size):
+        block = positions[start:start + block_size]
+        sim, valid = block_similarity(values[block], mask[block], values, mask, similarity_metric)
+        progress_bar.update(len(block))
+        keep = valid & pair_with(block)
+        if threshold is not None:
+            keep &= sim > threshold
+        block_rows, cols = np.nonzero(keep)
+        yield block[block_rows], cols, sim[block_rows, cols].astype(np.float32)
+
+
+# Generator of the edges of the threshold graph in chunks of (rows, cols, sims) arrays, every pair once, so memory
+# grows with the number of edges found rather than with n^2. Complete rows are paired through KD-tree range queries
+# (see search_radius); rows with missing attributes, and every row when the threshold can't prune, are scored in
+# similarity blocks. The edges are the ones the blocked builder finds: same common-attribute rule, same similarities.
+def iter_threshold_edges(feature_matrix, similarity_metric='cosine', threshold=None, chunk_size=RANGE_QUERY_CHUNK,
+                         progress=True):
+    values, mask = feature_matrix.values, feature_matrix.mask
+    num_tracks = len(feature_matrix)
+    radius = search_radius(similarity_metric, threshold) if threshold is not None else None
+    all_rows = np.arange(num_tracks)
+    if radius is None:
+        complete = np.empty(0, dtype=np.int64)
+        partial = all_rows
+    else:
+        is_complete = mask.all(axis=1)
+        complete, partial = np.flatnonzero(is_complete), np.flatnonzero(~is_complete)
+
+    # A partial row pairs with every complete row, and with the partial rows after it
+    is_partial = np.zeros(num_tracks, dtype=bool)
+    is_partial[partial] = True
+
+    def pair_with(block):
+        return ~is_partial[None, :] | (all_rows[None, :] > block[:, None])
+
+    progress_bar = tqdm(total=num_tracks, desc="Threshold edges", unit="track", disable=not progress)
+    try:
+        yield from _range_query_edges(values, complete, similarity_metric, threshold, radius, chunk_size,
+                                      progress_bar)
+        yield from _blocked_edges(values, mask, partial, similarity_metric, threshold, pair_with, progress_bar)
+    finally:
+        progress_bar.close()
+
+
+# All edges of the threshold graph as (rows, cols, sims) arrays with every pair once
+def threshold_edges(feature_matrix, similarity_metric='cosine', threshold=None, chunk_size=RANGE_QUERY_CHUNK,
+                    progress=True):
+    rows, cols, sims = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+    for chunk_rows, chunk_cols, chunk_sims in iter_threshold_edges(feature_matrix, similarity_metric, threshold,
+                                                                   chunk_size, progress):
+        rows.append(chunk_rows)
+        cols.append(chunk_cols)
+        sims.append(chunk_sims)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(sims)
@@ -0,0 +1,257 @@
+import os
+from multiprocessing import Pool, shared_memory
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+from graph_formation.feature_matrix import FeatureMatrix, block_similarity, block_top_k, default_block_size
+from graph_formation.similarity_graph import SimilarityGraph
+from instrumentation import trace
+
+# Libraries smaller than this are computed in the calling process, a pool costs more than it saves
+MIN_TRACKS_FOR_POOL = 4000
+
+# Feature arrays of the worker processes, attached to the parent's shared memory by _init_worker
+_worker = {}
+
+
+# Copies an array into a new shared memory block and returns (block, array view of the block)
+def _to_shared(array):
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared[...] = array
+    return block, shared
+
+
+def _init_worker(values_name, mask_name, shape, similarity_metric, k):
+    values_block = shared_memory.SharedMemory(name=values_name)
+    mask_block = shared_memory.SharedMemory(name=mask_name)
+    _worker['blocks'] = (values_block, mask_block)  # Keep the mappings alive for the life of the worker
+    _worker['values'] = np.ndarray(shape, dtype=np.float32, buffer=values_block.buf)
+    _worker['mask'] = np.ndarray(shape, dtype=bool, buffer=mask_block.buf)
+    _worker['similarity_metric'] = similarity_metric
+    _worker['k'] = k
+
+
+def _worker_top_k(bounds):
+    start, stop = bounds
+    values = _worker['values']
+    mask = _worker['mask']
+    sim, valid = block_similarity(values[start:stop], mask[start:stop], values, mask, _worker['similarity_metric'])
+    return start, block_top_k(sim, valid, start, _worker['k'])
+
+
+# Finds the k most similar tracks of every track without ever holding more than one block of the n x n similarity
+# matrix per process. Blocks of rows are spread over a process pool that reads the features from shared memory.
+# Returns (indices, sims), two (n, k) arrays with the most similar first; missing neighbours have index -1.
+@trace.traced('graph_build.topk_neighbors')
+def topk_neighbors(feature_matrix, k, similarity_metric='cosine', block_size=None, processes=None, progress=True):
+    num_tracks = len(feature_matrix)
+    k = max(0, min(k, num_tracks - 1))
+    indices = np.full((num_tracks, k), -1, dtype=np.int32)
+    sims = np.full((num_tracks, k), -np.inf, dtype=np.float32)
+    if k == 0:
+        return indices, sims
+
+    if block_size is None:
+        block_size = default_block_size(num_tracks)
+    if processes is None:
+        processes = os.cpu_count() if num_tracks >= MIN_TRACKS_FOR_POOL else 1
+    bounds = [(start, min(start + block_size, num_tracks)) for start in range(0, num_tracks, block_size)]
+    progress_bar = tqdm(total=num_tracks, desc="Top-k similarities", unit="track", disable=not progress)
+
+    def collect(start, result):
+        block_indices, block_sims = result
+        indices[start:start + len(block_indices)] = block_indices
+        sims[start:start + len(block_sims)] = block_sims
+        progress_bar.update(len(block_indices))
+
+    try:
+        if processes <= 1:
+            for start, stop in bounds:
+                sim, valid = block_similarity(feature_matrix.values[start:stop], feature_matrix.mask[start:stop],
+                                              feature_matrix.values, feature_matrix.mask, similarity_metric)
+                collect(start, block_top_k(sim, valid, start, k))
+        else:
+            values_block, values = _to_shared(feature_matrix.values)
+            mask_block, mask = _to_shared(feature_matrix.mask)
+            try:
+                initargs = (values_block.name, mask_block.name, values.shape, similarity_metric, k)
+                with Pool(processes=processes, initializer=_init_worker, initargs=initargs) as pool:
+                    for start, result in pool.imap_unordered(_worker_top_k, bounds):
+                        collect(start, result)
+            finally:
+                del values, mask
+                for block in (values_block, mask_block):
+                    block.close()
+                    block.unlink()
+    finally:
+        progress_bar.close()
+    return indices, sims
+
+
+# Turns per-track neighbour lists into a symmetric sparse adjacency matrix: tracks i and j are connected when either
+# one is among the other's top k
+def topk_to_csr(indices, sims):
+    num_tracks = len(indices)
+    rows = np.repeat(np.arange(num_tracks, dtype=np.int32), indices.shape[1])
+    cols = indices.ravel()
+    weights = sims.ravel()
+    keep = cols >= 0
+    adjacency = sparse.csr_array((weights[keep], (rows[keep], cols[keep])), shape=(num_tracks, num_tracks))
+    return adjacency.maximum(adjacency.T).tocsr()
+
+
+# Builds a similarity graph where every track is connected to its top_n most similar tracks, in O(n * top_n) memory.
+# output='sparse' returns a SimilarityGraph, output='networkx' the equivalent networkx.Graph with titles as labels.
+@trace.traced('graph_build.topk')
+def create_similarity_graph_topk(feature_matrix, top_n=10, similarity_metric='cosine', processes=None,
+                                 output='networkx', progress=True):
+    if output not in ('networkx', 'sparse'):
+        raise ValueError("Invalid output. Choose 'networkx' or 'sparse'.")
+    indices, sims = topk_neighbors(feature_matrix, top_n, similarity_metric, processes=processes, progress=progress)
+    graph = SimilarityGraph(topk_to_csr(indices, sims), feature_matrix.track_ids, feature_matrix.titles)
+    return graph if output == 'sparse' else graph.to_networkx()
+
+
+# Top-k neighbour lists of a library kept next to its features, so the graph can follow playlist changes without a
+# full rebuild. Rows never move: removed tracks keep their row with an all-False mask, which makes every similarity
+# involving them invalid. Adding m tracks costs one m x n similarity block (the new rows, and by symmetry their
+# similarity to every existing row, which is merged into the existing lists); removing tracks recomputes only the rows
+# that had one of them as a neighbour.
+class TopKTable:
+    def __init__(self, feature_matrix, indices, sims, k, similarity_metric='cosine', removed=None):
+        self.feature_matrix = feature_matrix
+        self.indices = indices
+        self.sims = sims
+        self.k = k
+        self.similarity_metric = similarity_metric
+        self.removed = removed if removed is not None else np.zeros(len(feature_matrix), dtype=bool)
+
+    @classmethod
+    @trace.traced('graph_build.topk_table')
+    def build(cls, feature_matrix, k=10, similarity_metric='cosine', processes=None, progress=True):
+        indices, sims = topk_neighbors(feature_matrix, k, similarity_metric, processes=processes, progress=progress)
+        indices, sims = _pad_columns(indices, sims, k)
+        return cls(feature_matrix, indices, sims, k, similarity_metric)
+
+    def __len__(self):
+        return len(self.feature_matrix)
+
+    # Top-k lists of `rows` against the whole table, in blocks, with each row's own track left out
+    def _rows_top_k(self, rows):
+        values, mask = self.feature_matrix.values, self.feature_matrix.mask
+        indices = np.full((len(rows), self.k), -1, dtype=np.int32)
+        sims = np.full((len(rows), self.k), -np.inf, dtype=np.float32)
+        block_size = default_block_size(len(values))
+        for start in range(0, len(rows), block_size):
+            block_rows = rows[start:start + block_size]
+            sim, valid = block_similarity(values[block_rows], mask[block_rows], values, mask, self.similarity_metric)
+            valid[np.arange(len(block_rows)), block_rows] = False
+            # start=len(values) tells block_top_k there is no diagonal, the track itself is already invalid
+            block_indices, block_sims = _pad_columns(*block_top_k(sim, valid, len(values), self.k), self.k)
+            indices[start:start + len(block_rows)] = block_indices
+            sims[start:start + len(block_rows)] = block_sims
+        return indices, sims
+
+    # Appends the rows of another FeatureMatrix (same attributes, already scaled the same way). Returns the number of
+    # existing rows whose neighbour list changed.
+    @trace.traced('graph_build.topk_table_add')
+    def add(self, feature_matrix):
+        old = self.feature_matrix
+        # A removed track that comes back gets a new row, its old one stays a tombstone
+        known = {old.track_ids[row] for row in np.flatnonzero(~self.removed).tolist()}
+        rows = [row for row, track_id in enumerate(feature_matrix.track_ids) if track_id not in known]
+        if not rows:
+            return 0
+        num_old = len(old)
+        titles = dict(old.titles)
+        titles.update(feature_matrix.titles)
+        self.feature_matrix = FeatureMatrix(np.vstack([old.values, feature_matrix.values[rows]]),
+                                            np.vstack([old.mask, feature_matrix.mask[rows]]),
+                                            old.track_ids + [feature_matrix.track_ids[row] for row in rows],
+                                            old.attributes, titles)
+        self.removed = np.concatenate([self.removed, np.zeros(len(rows), dtype=bool)])
+        new_rows = np.arange(num_old, len(self.feature_matrix))
+        new_indices, new_sims = self._rows_top_k(new_rows)
+
+        # Similarity of every existing row to the new ones is the transpose of the new rows' similarity block
+        values, mask = self.feature_matrix.values, self.feature_matrix.mask
+        sim, valid = block_similarity(values[new_rows], mask[new_rows], values[:num_old], mask[:num_old],
+                                      self.similarity_metric)
+        candidate_sims = np.where(valid, sim, -np.inf).T.astype(np.float32)
+        candidate_indices = np.broadcast_to(new_rows.astype(np.int32), candidate_sims.shape)
+        improves = (candidate_sims > self.sims[:, -1:]).any(axis=1) if self.k else np.zeros(num_old, dtype=bool)
+        affected = np.flatnonzero(improves)
+        merged_indices, merged_sims = _merge_top_k(self.indices[affected], self.sims[affected],
+                                                   candidate_indices[affected], candidate_sims[affected], self.k)
+
+        self.indices = np.vstack([self.indices, new_indices])
+        self.sims = np.vstack([self.sims, new_sims])
+        self.indices[affected] = merged_indices
+        self.sims[affected] = merged_sims
+        return len(affected)
+
+    # Tombstones tracks and recomputes the lists that pointed at them. Returns the number of rows recomputed.
+    @trace.traced('graph_build.topk_table_remove')
+    def remove(self, track_ids):
+        track_ids = set(track_ids)
+        fm = self.feature_matrix
+        rows = np.array([fm.index[track_id] for track_id in track_ids if track_id in fm.index], dtype=np.int64)
+        rows = rows[~self.removed[rows]]
+        self.removed[rows] = True
+        mask = fm.mask.copy()
+        mask[rows] = False
+        # Titles go too, including those of titled tracks without features (isolated nodes)
+        titles = {track_id: title for track_id, title in fm.titles.items() if track_id not in track_ids}
+        self.feature_matrix = FeatureMatrix(fm.values, mask, fm.track_ids, fm.attributes, titles)
+        if not len(rows):
+            return 0
+        self.indices[rows] = -1
+        self.sims[rows] = -np.inf
+        affected = np.flatnonzero(np.isin(self.indices, rows).any(axis=1))
+        self.indices[affected], self.sims[affected] = self._rows_top_k(affected)
+        return len(affected)
+
+    # SimilarityGraph of the live tracks (titled tracks without features become isolated nodes, as in the builders)
+    def to_graph(self):
+        live = np.flatnonzero(~self.removed)
+        adjacency = topk_to_csr(self.indices, self.sims)[live][:, live]
+        track_ids = [self.feature_matrix.track_ids[row] for row in live.tolist()]
+        return SimilarityGraph(adjacency, track_ids, self.feature_matrix.titles)
+
+    def save(self, path):
+        fm = self.feature_matrix
+        np.savez(path, values=fm.values, mask=fm.mask, indices=self.indices, sims=self.sims, removed=self.removed,
+                 track_ids=np.array(fm.track_ids, dtype=str), attributes=np.array(fm.attributes, dtype=str),
+                 title_ids=np.array(list(fm.titles.keys()), dtype=str),
+                 titles=np.array(list(fm.titles.values()), dtype=str),
+                 k=self.k, similarity_metric=self.similarity_metric)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            titles = dict(zip(saved['title_ids'].tolist(), saved['titles'].tolist()))
+            feature_matrix = FeatureMatrix(saved['values'], saved['mask'], saved['track_ids'].tolist(),
+                                           saved['attributes'].tolist(), titles)
+            return cls(feature_matrix, saved['indices'], saved['sims'], int(saved['k']),
+                       str(saved['similarity_metric']), saved['removed'])
+
+
+# Pads (n, j) neighbour lists to k columns with index -1 / similarity -inf (libraries with k or fewer tracks)
+def _pad_columns(indices, sims, k):
+    missing = k - indices.shape[1]
+    if missing <= 0:
+        return indices, sims
+    return (np.pad(indices, ((0, 0), (0, missing)), constant_values=-1),
+            np.pad(sims, ((0, 0), (0, missing)), constant_values=-np.inf))
+
+
+# Merges two sets of per-row neighbour lists and keeps the k most similar of each row, most similar first
+def _merge_top_k(indices, sims, other_indices, other_sims, k):
+    all_indices = np.hstack([indices, other_indices])
+    all_sims = np.hstack([sims, other_sims])
+    order = np.argsort(-all_sims, axis=1, kind='stable')[:, :k]
+    merged_indices = np.take_along_axis(all_indices, order, axis=1)
+    merged_sims = np.take_along_axis(all_sims, order, axis=1)
+    merged_indices[~np.isfinite(merged_sims)] = -1
+    return merged_indices, merged_sims
@@ -0,0 +1,302 @@
+import atexit
+import cProfile
+import csv
+import json
+import os
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+# Opt-in instrumentation of the pipeline stages (parse, features, similarity, neighbours, selection, graph build,
+# render). Nothing is recorded until enable() is called, and while disabled stage() hands back one shared no-op
+# context manager and @traced functions call straight through, so the hooks cost a global lookup.
+#
+#   from instrumentation import trace
+#   trace.enable(memory=True)
+#   ... run a queue or a graph build ...
+#   trace.get_tracer().write_json("../output/trace.json")
+#
+# Setting PSHUFFLE_TRACE=<path>.json (or .csv) traces a whole script run and writes the report at exit, next to a
+# <path>.folded file of collapsed stacks (flamegraph.pl / speedscope / py-spy format). PSHUFFLE_TRACE_MEMORY=1 adds
+# tracemalloc peaks and PSHUFFLE_TRACE_PROFILE=1 a <path>.pstats cProfile dump.
+#
+# tracemalloc's peak is process-wide, so memory is only recorded for stages on the main thread (stages on other
+# threads report a peak of 0), and those peaks are only meaningful while no other thread is allocating: trace memory
+# on single-threaded runs.
+
+TRACE_ENV = 'PSHUFFLE_TRACE'
+TRACE_MEMORY_ENV = 'PSHUFFLE_TRACE_MEMORY'
+TRACE_PROFILE_ENV = 'PSHUFFLE_TRACE_PROFILE'
+
+_tracer = None
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+# Totals of one stage name over every call
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.peak_bytes = 0
+
+    def add(self, seconds, peak_bytes):
+        self.calls += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.peak_bytes = max(self.peak_bytes, peak_bytes)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'total_seconds': round(self.total, 6),
+            'mean_ms': round(self.total / self.calls * 1000, 4) if self.calls else 0.0,
+            'min_ms': round(self.min * 1000, 4) if self.calls else 0.0,
+            'max_ms': round(self.max * 1000, 4),
+            'peak_bytes': self.peak_bytes,
+        }
+
+
+class _Stage:
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.tracer._enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer._exit()
+        return False
+
+
+# One frame of a thread's stage stack
+class _Frame:
+    __slots__ = ('name', 'path', 'start', 'children', 'memory_start', 'peak')
+
+    def __init__(self, name, path, start, memory_start):
+        self.name = name
+        self.path = path
+        self.start = start
+        self.children = 0.0
+        self.memory_start = memory_start
+        self.peak = memory_start
+
+
+class Tracer:
+    def __init__(self, memory=False, profile=False):
+        self.memory = memory
+        self.stages = {}
+        self.counters = {}
+        self.self_times = {}  # 'outer;inner' stack -> seconds spent in the innermost stage itself
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracemalloc = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.profiler = cProfile.Profile() if profile else None
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    # Whether this thread records memory peaks (see the module comment)
+    def _traces_memory(self):
+        return self.memory and threading.current_thread() is threading.main_thread()
+
+    def _enter(self, name):
+        stack = self._stack()
+        path = f"{stack[-1].path};{name}" if stack else name
+        memory_start = 0
+        if self._traces_memory():
+            current, peak = tracemalloc.get_traced_memory()
+            # The parent's peak so far has to be saved before reset_peak() forgets it
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            memory_start = current
+        stack.append(_Frame(name, path, time.perf_counter(), memory_start))
+
+    def _exit(self):
+        end = time.perf_counter()
+        stack = self._stack()
+        frame = stack.pop()
+        elapsed = end - frame.start
+        peak_bytes = 0
+        if self._traces_memory():
+            frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+            peak_bytes = frame.peak - frame.memory_start
+        if stack:
+            stack[-1].children += elapsed
+            stack[-1].peak = max(stack[-1].peak, frame.peak)
+        with self.lock:
+            stats = self.stages.get(frame.name)
+            if stats is None:
+                stats = self.stages[frame.name] = StageStats(frame.name)
+            stats.add(elapsed, peak_bytes)
+            self.self_times[frame.path] = self.self_times.get(frame.path, 0.0) + elapsed - frame.children
+
+    # Hit rate of every counter pair named <cache>.hits / <cache>.misses
+    def cache_hit_rates(self):
+        caches = {name.rsplit('.', 1)[0] for name in self.counters if name.endswith(('.hits', '.misses'))}
+        rates = {}
+        for cache in sorted(caches):
+            hits = self.counters.get(cache + '.hits', 0)
+            total = hits + self.counters.get(cache + '.misses', 0)
+            rates[cache] = round(hits / total, 4) if total else 0.0
+        return rates
+
+    def report(self):
+        with self.lock:
+            return {
+                'wall_seconds': round(time.perf_counter() - self.started, 6),
+                'memory_traced': self.memory,
+                'stages': {name: stats.as_dict() for name, stats in sorted(self.stages.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'cache_hit_rates': self.cache_hit_rates(),
+            }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    # One row per stage
+    def write_csv(self, path):
+        report = self.report()
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'calls', 'total_seconds', 'mean_ms', 'min_ms', 'max_ms', 'peak_bytes'])
+            for name, stats in report['stages'].items():
+                writer.writerow([name, stats['calls'], stats['total_seconds'], stats['mean_ms'], stats['min_ms'],
+                                 stats['max_ms'], stats['peak_bytes']])
+
+    # Collapsed stacks ("outer;inner <microseconds>" per line), the input format of flamegraph.pl and speedscope
+    def write_collapsed(self, path):
+        with self.lock:
+            lines = [f"{stack} {int(seconds * 1e6)}" for stack, seconds in sorted(self.self_times.items())]
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    # cProfile statistics (readable with pstats or snakeviz), when the tracer was created with profile=True
+    def write_profile(self, path):
+        if self.profiler is None:
+            raise RuntimeError("Profiling wasn't enabled, use enable(profile=True)")
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+        self.profiler.enable()
+
+    # Writes the report to `path` (.csv or .json), the collapsed stacks next to it and the profile when there is one
+    def write(self, path):
+        base, extension = os.path.splitext(path)
+        if extension == '.csv':
+            self.write_csv(path)
+        else:
+            self.write_json(path)
+        self.write_collapsed(base + '.folded')
+        if self.profiler is not None:
+            self.write_profile(base + '.pstats')
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+
+# Starts recording into a new Tracer and returns it. memory=True also records each main-thread stage's peak
+# allocation with tracemalloc (which slows allocation-heavy code down noticeably); profile=True runs cProfile
+# alongside.
+def enable(memory=False, profile=False):
+    global _tracer
+    disable()
+    _tracer = Tracer(memory, profile)
+    return _tracer
+
+
+# Stops recording and returns the tracer that was recording (or None)
+def disable():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+    return tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def is_enabled():
+    return _tracer is not None
+
+
+# Context manager timing the enclosed block as stage `name`
+def stage(name):
+    tracer = _tracer  # Read once, disable() may run on another thread
+    return _NULL_STAGE if tracer is None else tracer.stage(name)
+
+
+# Adds n to a counter, e.g. 'neighbors.cache.hits'
+def count(name, n=1):
+    tracer = _tracer
+    if tracer is not None:
+        tracer.count(name, n)
+
+
+# Decorator timing every call of a function as stage `name`
+def traced(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _enable_from_environment():
+    path = os.environ.get(TRACE_ENV)
+    if not path:
+        return
+    tracer = enable(memory=os.environ.get(TRACE_MEMORY_ENV) == '1', profile=os.environ.get(TRACE_PROFILE_ENV) == '1')
+
+    def write_at_exit():
+        if _tracer is tracer:
+            tracer.write(path)
+
+    atexit.register(write_at_exit)
+
+
+_enable_from_environment()
@@ -0,0 +1,13 @@
+import sys
+import time
+from playlist_store import convert_playlist, store_path
+
+# Converts playlist XML files to binary stores, e.g.
+#   PYTHONPATH=.. python convert_playlist.py ../xml_files/playlist_*.xml
+xml_files = sys.argv[1:] or ["../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml"]
+
+for xml_file in xml_files:
+    start = time.perf_counter()
+    store = convert_playlist(xml_file)
+    print(f"{xml_file} -> {store_path(xml_file)}: {len(store)} tracks, {len(store.numeric_columns)} numeric fields "
+          f"({time.perf_counter() - start:.2f}s)")
@@ -0,0 +1,383 @@
+import hashlib
+import json
+import os
+import numpy as np
+from playlist_io.xml_stream import iter_tracks
+from instrumentation import trace
+
+# Bump when the on-disk layout changes so old stores get rebuilt
+STORE_VERSION = 1
+
+# Track fields kept as text, every other field is stored as a float (same split as shuffle_functions.parse_xml)
+STRING_FIELDS = ['title', 'id', 'artist', 'type', 'uri', 'track_href', 'analysis_url']
+
+META_FILE = 'meta.json'
+NUMERIC_FILE = 'numeric.npy'
+NUMERIC_MASK_FILE = 'numeric_mask.npy'
+STRINGS_FILE = 'strings.bin'
+STRING_OFFSETS_FILE = 'string_offsets.npy'
+STRING_MASK_FILE = 'string_mask.npy'
+DELETED_FILE = 'deleted.npy'  # Tombstones written by playlist_sync; stores without it have no deleted tracks
+
+
+# Columnar, memory-mapped copy of a playlist XML file. Numeric fields live in one float64 (tracks x columns) array,
+# text fields in a single UTF-8 blob with per-column offsets. Opening a store only maps the files, nothing is parsed
+# or copied until a column is actually read.
+# Tracks removed by a sync stay in the arrays (so row numbers don't move) and are flagged in `deleted`; to_songs,
+# to_audio_features and FeatureMatrix.from_store skip them.
+class PlaylistStore:
+    def __init__(self, meta, numeric, numeric_mask, strings, string_offsets, string_mask, path=None, deleted=None):
+        self.meta = meta
+        self.path = path
+        self.numeric = numeric
+        self.numeric_mask = numeric_mask
+        self.strings_blob = strings
+        self.string_offsets = string_offsets
+        self.string_mask = string_mask
+        self.deleted = deleted if deleted is not None else np.zeros(meta['num_tracks'], dtype=bool)
+        self.numeric_columns = meta['numeric_columns']
+        self.string_columns = meta['string_columns']
+        self._numeric_positions = {name: i for i, name in enumerate(self.numeric_columns)}
+        self._string_positions = {name: i for i, name in enumerate(self.string_columns)}
+        self._decoded = {}
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        numeric = np.load(os.path.join(path, NUMERIC_FILE), mmap_mode='r')
+        numeric_mask = np.load(os.path.join(path, NUMERIC_MASK_FILE), mmap_mode='r')
+        string_offsets = np.load(os.path.join(path, STRING_OFFSETS_FILE), mmap_mode='r')
+        string_mask = np.load(os.path.join(path, STRING_MASK_FILE), mmap_mode='r')
+        strings_path = os.path.join(path, STRINGS_FILE)
+        # np.memmap refuses empty files
+        strings = np.memmap(strings_path, dtype=np.uint8, mode='r') if os.path.getsize(strings_path) else \
+            np.empty(0, dtype=np.uint8)
+        deleted_path = os.path.join(path, DELETED_FILE)
+        deleted = np.load(deleted_path) if os.path.exists(deleted_path) else None
+        return cls(meta, numeric, numeric_mask, strings, string_offsets, string_mask, path, deleted)
+
+    def __len__(self):
+        return self.meta['num_tracks']
+
+    # Float values of a numeric field (NaN where a track doesn't have it)
+    def column(self, name):
+        return self.numeric[:, self._numeric_positions[name]]
+
+    # (tracks x attributes) float array of the requested fields plus a mask of which values are present
+    def features(self, attributes):
+        positions = [self._numeric_positions[name] for name in attributes]
+        return np.asarray(self.numeric[:, positions]), np.asarray(self.numeric_mask[:, positions])
+
+    # Decoded values of a text field (None where a track doesn't have it), decoded once and kept
+    def strings(self, name):
+        if name not in self._decoded:
+            if name not in self._string_positions:
+                self._decoded[name] = [None] * len(self)
+            else:
+                column = self._string_positions[name]
+                offsets = self.string_offsets[column].tolist()
+                present = self.string_mask[:, column].tolist()
+                blob = bytes(self.strings_blob[offsets[0]:offsets[-1]])
+                base = offsets[0]
+                self._decoded[name] = [blob[start - base:stop - base].decode('utf-8') if is_present else None
+                                       for start, stop, is_present in zip(offsets[:-1], offsets[1:], present)]
+        return self._decoded[name]
+
+    @property
+    def ids(self):
+        return self.strings('id')
+
+    # Row numbers of the tracks that haven't been deleted
+    @property
+    def live_rows(self):
+        return np.flatnonzero(~self.deleted)
+
+    # New in-memory store with `tracks` (dicts of field -> text, as iter_tracks yields them) added after the
+    # existing rows. Existing rows keep their numbers, so anything indexed by row stays valid.
+    def append(self, tracks):
+        tracks = list(tracks)
+        numeric_columns = list(self.numeric_columns)
+        positions = dict(self._numeric_positions)
+        for track in tracks:
+            for tag in track:
+                if tag not in self._string_positions and tag not in positions:
+                    positions[tag] = len(numeric_columns)
+                    numeric_columns.append(tag)
+
+        numeric = np.full((len(self) + len(tracks), len(numeric_columns)), np.nan, dtype=np.float64)
+        numeric[:len(self), :len(self.numeric_columns)] = self.numeric
+        for row, track in enumerate(tracks, start=len(self)):
+            for tag, text in track.items():
+                if tag in positions and text is not None:
+                    numeric[row, positions[tag]] = float(text)
+
+        string_values = {name: self.strings(name) + [track.get(name) for track in tracks]
+                         for name in self.string_columns}
+        strings, string_offsets, string_mask = _encode_strings(string_values, self.string_columns)
+        meta = dict(self.meta, num_tracks=len(numeric), numeric_columns=numeric_columns)
+        deleted = np.concatenate([self.deleted, np.zeros(len(tracks), dtype=bool)])
+        return PlaylistStore(meta, numeric, ~np.isnan(numeric), strings, string_offsets, string_mask, self.path,
+                             deleted)
+
+    # New store sharing this one's arrays, with every track whose id is in track_ids flagged as deleted
+    def remove(self, track_ids):
+        track_ids = set(track_ids)
+        deleted = self.deleted | np.array([track_id in track_ids for track_id in self.ids], dtype=bool)
+        return PlaylistStore(self.meta, self.numeric, self.numeric_mask, self.strings_blob, self.string_offsets,
+                             self.string_mask, self.path, deleted)
+
+    # One track as a song dict (the format of shuffle_functions.parse_xml), read straight from the mapped arrays
+    def song(self, row):
+        song = {}
+        for column, name in enumerate(self.string_columns):
+            if self.string_mask[row, column]:
+                start, stop = self.string_offsets[column, row], self.string_offsets[column, row + 1]
+                song[name] = bytes(self.strings_blob[start:stop]).decode('utf-8')
+        song.update((name, value) for name, value, is_present
+                    in zip(self.numeric_columns, self.numeric[row].tolist(), self.numeric_mask[row].tolist())
+                    if is_present)
+        return song
+
+    # The live tracks as a StoreSongs sequence: dicts are only built for the songs that are read
+    def songs(self):
+        return StoreSongs(self)
+
+    # Same list of dicts as shuffle_functions.parse_xml
+    @trace.traced('store.to_songs')
+    def to_songs(self):
+        string_values = [(name, self.strings(name)) for name in self.string_columns]
+        numeric = np.asarray(self.numeric).tolist()
+        numeric_mask = np.asarray(self.numeric_mask).tolist()
+        songs = []
+        for row in self.live_rows.tolist():
+            song = {name: values[row] for name, values in string_values if values[row] is not None}
+            song.update((name, value) for name, value, is_present
+                        in zip(self.numeric_columns, numeric[row], numeric_mask[row]) if is_present)
+            songs.append(song)
+        return songs
+
+    # Same ({track_id: {attribute: value}}, {track_id: title}) pair as graph_functions.read_all_audio_features.
+    # Like the XML reader, only non-negative values count as features. Values written in scientific notation
+    # (e.g. a tiny instrumentalness of 1e-05) are kept here, where the XML text check drops them.
+    def to_audio_features(self, attributes):
+        attributes = [name for name in attributes if name in self._numeric_positions]
+        values, mask = self.features(attributes)
+        mask = mask & (np.nan_to_num(values, nan=-1) >= 0)
+        all_features = {}
+        titles = {}
+        for track_id, title, row_values, row_mask, is_deleted in zip(self.ids, self.strings('title'), values.tolist(),
+                                                                     mask.tolist(), self.deleted.tolist()):
+            if track_id is None or is_deleted:
+                continue
+            titles[track_id] = title if title is not None else 'No Title'
+            features = {name: value for name, value, is_present in zip(attributes, row_values, row_mask) if is_present}
+            if features:
+                all_features[track_id] = features
+        return all_features, titles
+
+
+# Read-only sequence of a store's live tracks as song dicts, built one at a time when a song is read, so a library
+# doesn't have to sit in memory as a list of dicts. features() and ids read the columns without building any dict
+# (SongIndex uses them). Songs appended with + (e.g. by SongIndex.add_songs) are kept as the dicts they were given.
+class StoreSongs:
+    def __init__(self, store, rows=None, extra=()):
+        self.store = store
+        self.rows = store.live_rows if rows is None else rows
+        self.extra = list(extra)
+
+    def __len__(self):
+        return len(self.rows) + len(self.extra)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("song position out of range")
+        if position >= len(self.rows):
+            return self.extra[position - len(self.rows)]
+        return self.store.song(int(self.rows[position]))
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def __add__(self, songs):
+        return StoreSongs(self.store, self.rows, self.extra + list(songs))
+
+    @property
+    def ids(self):
+        store_ids = self.store.ids
+        return [store_ids[row] for row in self.rows.tolist()] + [song['id'] for song in self.extra]
+
+    # (songs x attributes) float values and presence mask, in song order
+    def features(self, attributes):
+        values, mask = self.store.features(attributes)
+        values, mask = values[self.rows], mask[self.rows]
+        if self.extra:
+            extra = np.array([[song.get(name, np.nan) for name in attributes] for song in self.extra],
+                             dtype=np.float64).reshape(len(self.extra), len(attributes))
+            values = np.vstack([values, extra])
+            mask = np.vstack([mask, ~np.isnan(extra)])
+        return values, mask
+
+
+# Default store location for a playlist XML file: playlist_X.xml -> playlist_X.pstore
+def store_path(xml_file):
+    return os.path.splitext(xml_file)[0] + '.pstore'
+
+
+def _file_sha1(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Builds the store arrays from the XML file and returns them as an in-memory PlaylistStore
+@trace.traced('parse.build_store')
+def build_store(xml_file):
+    numeric_columns = []
+    numeric_positions = {}
+    numeric_rows = []
+    string_values = {name: [] for name in STRING_FIELDS}
+
+    for track in iter_tracks(xml_file):
+        numeric_row = {}
+        for tag, text in track.items():
+            if tag in string_values:
+                continue
+            if tag not in numeric_positions:
+                numeric_positions[tag] = len(numeric_columns)
+                numeric_columns.append(tag)
+            if text is not None:
+                numeric_row[numeric_positions[tag]] = float(text)
+        numeric_rows.append(numeric_row)
+        for name, values in string_values.items():
+            values.append(track.get(name))
+
+    num_tracks = len(numeric_rows)
+    numeric = np.full((num_tracks, len(numeric_columns)), np.nan, dtype=np.float64)
+    for row, numeric_row in enumerate(numeric_rows):
+        numeric[row, list(numeric_row.keys())] = list(numeric_row.values())
+    numeric_mask = ~np.isnan(numeric)
+
+    string_columns = list(STRING_FIELDS)
+    strings, string_offsets, string_mask = _encode_strings(string_values, string_columns)
+
+    stat = os.stat(xml_file)
+    meta = {
+        'version': STORE_VERSION,
+        'source': os.path.abspath(xml_file),
+        'source_mtime_ns': stat.st_mtime_ns,
+        'source_size': stat.st_size,
+        'source_sha1': _file_sha1(xml_file),
+        'num_tracks': num_tracks,
+        'numeric_columns': numeric_columns,
+        'string_columns': string_columns,
+    }
+    return PlaylistStore(meta, numeric, numeric_mask, strings, string_offsets, string_mask)
+
+
+# Packs {column: [text or None per track]} into one UTF-8 blob with per-column offsets and a presence mask
+def _encode_strings(string_values, string_columns):
+    num_tracks = len(string_values[string_columns[0]]) if string_columns else 0
+    string_offsets = np.zeros((len(string_columns), num_tracks + 1), dtype=np.int64)
+    string_mask = np.zeros((num_tracks, len(string_columns)), dtype=bool)
+    chunks = []
+    position = 0
+    for column, name in enumerate(string_columns):
+        string_offsets[column, 0] = position
+        for row, value in enumerate(string_values[name]):
+            if value is not None:
+                encoded = value.encode('utf-8')
+                chunks.append(encoded)
+                position += len(encoded)
+                string_mask[row, column] = True
+            string_offsets[column, row + 1] = position
+    return np.frombuffer(b''.join(chunks), dtype=np.uint8), string_offsets, string_mask
+
+
+def _save_array(path, array):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(temp_path, path)
+
+
+# Writes a store to disk. The metadata is removed first and written last, so an interrupted write always leaves a
+# store that is_fresh rejects. Every file is replaced rather than overwritten, so stores already opened from `path`
+# keep reading their old (memory-mapped) files.
+def write_store(store, path):
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    _save_array(os.path.join(path, NUMERIC_FILE), store.numeric)
+    _save_array(os.path.join(path, NUMERIC_MASK_FILE), store.numeric_mask)
+    _save_array(os.path.join(path, STRING_OFFSETS_FILE), store.string_offsets)
+    _save_array(os.path.join(path, STRING_MASK_FILE), store.string_mask)
+    _save_array(os.path.join(path, DELETED_FILE), store.deleted)
+    strings_path = os.path.join(path, STRINGS_FILE)
+    with open(strings_path + '.tmp', 'wb') as f:
+        f.write(np.asarray(store.strings_blob).tobytes())
+    os.replace(strings_path + '.tmp', strings_path)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(store.meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+# Converts a playlist XML file to a store and returns the opened store
+def convert_playlist(xml_file, path=None):
+    path = path or store_path(xml_file)
+    write_store(build_store(xml_file), path)
+    return PlaylistStore.open(path)
+
+
+# Checks that the store at `path` was built from the current version of the XML file. A matching mtime and size is
+# trusted as is; otherwise the file contents are hashed, so touching the XML without changing it doesn't force a
+# rebuild.
+def is_fresh(path, xml_file):
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        stat = os.stat(xml_file)
+    except (OSError, ValueError):
+        return False
+    if meta.get('version') != STORE_VERSION or meta.get('source_size') != stat.st_size:
+        return False
+    if meta.get('source_mtime_ns') == stat.st_mtime_ns:
+        return True
+    if meta.get('source_sha1') != _file_sha1(xml_file):
+        return False
+    # Same contents, remember the new mtime so the next check is cheap again
+    meta['source_mtime_ns'] = stat.st_mtime_ns
+    try:
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+    except OSError:
+        pass
+    return True
+
+
+# Opens the store for a playlist XML file. If the store is missing or stale the XML is parsed instead, and the
+# store is rebuilt for next time when `rebuild` is True and the directory is writable.
+@trace.traced('store.load_playlist')
+def load_playlist(xml_file, path=None, rebuild=True):
+    path = path or store_path(xml_file)
+    if is_fresh(path, xml_file):
+        trace.count('store.cache.hits')
+        return PlaylistStore.open(path)
+
+    trace.count('store.cache.misses')
+    store = build_store(xml_file)
+    if rebuild:
+        try:
+            write_store(store, path)
+            return PlaylistStore.open(path)
+        except OSError as e:
+            print(f"Could not write playlist store {path}: {e}")
+    return store
@@ -0,0 +1,65 @@
+import xml.etree.ElementTree as ET
+import numpy as np
+
+# Number of tracks per batch yielded by iter_feature_batches
+BATCH_SIZE = 4096
+
+
+# Generator that yields one {tag: text} dict per <track> of a playlist XML file. The file is read with iterparse and
+# every track element is cleared (and detached from the root) once it has been yielded, so memory stays flat no matter
+# how many tracks the export has.
+def iter_tracks(xml_file):
+    depth = 0
+    root = None
+    for event, element in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        # Only direct children of the root are tracks, same as root.findall('track')
+        if depth == 1 and element.tag == 'track':
+            yield {child.tag: child.text for child in element}
+        if depth == 1:
+            element.clear()
+            root.clear()
+
+
+# Text check read_all_audio_features has always used to decide whether a value is a feature: a plain non-negative
+# decimal number
+def is_feature_text(text):
+    return text is not None and text.replace('.', '', 1).isdigit()
+
+
+# Generator that yields the features of a playlist XML file in fixed-size batches of
+# (track_ids, titles, values, mask), where values is a float32 (batch x attributes) array and mask flags which values
+# were present. Tracks without any of the attributes are skipped, like in read_all_audio_features.
+def iter_feature_batches(xml_file, attributes, batch_size=BATCH_SIZE):
+    columns = {attribute: column for column, attribute in enumerate(attributes)}
+    values = np.zeros((batch_size, len(attributes)), dtype=np.float32)
+    mask = np.zeros((batch_size, len(attributes)), dtype=bool)
+    track_ids = []
+    titles = []
+
+    for track in iter_tracks(xml_file):
+        row = len(track_ids)
+        for tag, text in track.items():
+            column = columns.get(tag)
+            if column is not None and is_feature_text(text):
+                values[row, column] = float(text)
+                mask[row, column] = True
+        if not mask[row].any():
+            values[row] = 0
+            continue
+        track_ids.append(track['id'])
+        titles.append(track.get('title', 'No Title'))
+        if len(track_ids) == batch_size:
+            yield track_ids, titles, values, mask
+            values = np.zeros((batch_size, len(attributes)), dtype=np.float32)
+            mask = np.zeros((batch_size, len(attributes)), dtype=bool)
+            track_ids = []
+            titles = []
+
+    if track_ids:
+        yield track_ids, titles, values[:len(track_ids)], mask[:len(track_ids)]
@@ -0,0 +1,57 @@
+import os
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
+from shuffle.shuffle_functions import iter_song_queue
+from shuffle.song_index import get_song_index
+
+# Index and settings of the worker processes, set by _init_worker
+_worker = {}
+
+
+def _init_worker(index, num_songs, exponent):
+    _worker['index'] = index
+    _worker['num_songs'] = num_songs
+    _worker['exponent'] = exponent
+
+
+# Walks one queue and returns it as an array of song positions in the index
+def _walk(index, initial_song_id, num_songs, exponent, seed_sequence):
+    rng = np.random.default_rng(seed_sequence)
+    queue = iter_song_queue(initial_song_id, index.songs, index.weights, index.attributes, exponent, index=index,
+                            rng=rng)
+    return np.array([index.positions[song['id']] for song in islice(queue, num_songs + 1)], dtype=np.int32)
+
+
+def _worker_walk(task):
+    position, initial_song_id, seed_sequence = task
+    return position, _walk(_worker['index'], initial_song_id, _worker['num_songs'], _worker['exponent'], seed_sequence)
+
+
+# Generates one queue per seed song, like calling generate_song_queue for each of them, but sharing one prepared
+# matrix and neighbour index across every seed and spreading the walks over a process pool. Each seed gets its own
+# random stream spawned from `seed`, so the queues are the same whatever the number of processes.
+# Returns a list with, for every seed, a numpy array of the queued song ids (the seed first).
+def generate_song_queues(seeds, songs, weights, attributes, num_songs, exponent=2, scaling='none', backend='kdtree',
+                         processes=None, seed=None):
+    seeds = list(seeds)
+    num_songs = int(num_songs)
+    index = get_song_index(songs, weights, attributes, backend=backend, scaling=scaling)
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(seeds))
+    tasks = [(position, initial_song_id, seed_sequence)
+             for position, (initial_song_id, seed_sequence) in enumerate(zip(seeds, seed_sequences))]
+    if processes is None:
+        processes = min(os.cpu_count() or 1, len(seeds))
+
+    queues = [None] * len(seeds)
+    if processes <= 1:
+        for position, initial_song_id, seed_sequence in tasks:
+            queues[position] = _walk(index, initial_song_id, num_songs, exponent, seed_sequence)
+    else:
+        with Pool(processes=processes, initializer=_init_worker, initargs=(index, num_songs, exponent)) as pool:
+            chunksize = max(1, len(tasks) // (processes * 4))
+            for position, queue in pool.imap_unordered(_worker_walk, tasks, chunksize=chunksize):
+                queues[position] = queue
+
+    song_ids = np.array(index.song_ids)
+    return [song_ids[queue] for queue in queues]
@@ -0,0 +1,60 @@
+import time
+import numpy as np
+import shuffle_functions as sf
+from shuffle.song_index import SongIndex
+
+# Sample XML data
+xml_file = "../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml"  # Your XML data goes here
+
+# Load the playlist (from its binary store when it is up to date)
+songs = sf.load_songs(xml_file)
+
+attribute_keys = ['danceability',
+                  'energy',
+                  'speechiness',
+                  'acousticness',
+                  'instrumentalness',
+                  'liveness',
+                  'valence'
+                  ]
+
+weights = {
+    'danceability': 1.2,
+    'energy': 1.5,
+    'speechiness': 1,
+    'acousticness': 1.2,
+    'instrumentalness': 1.2,
+    'liveness': 1,
+    'valence': 0.8
+}
+
+num_neighbors = 20
+num_queries = 200  # Number of random songs to query
+
+rng = np.random.default_rng(0)
+query_ids = [songs[i]['id'] for i in rng.choice(len(songs), size=min(num_queries, len(songs)), replace=False)]
+
+# Reference: the linear scan in find_similar_songs
+start = time.perf_counter()
+expected = [{song['id'] for song, _ in sf.find_similar_songs(song_id, songs, weights, attribute_keys, num_neighbors)}
+            for song_id in query_ids]
+linear_latency = (time.perf_counter() - start) / len(query_ids)
+print(f"{'linear scan':<12} build: {0:8.3f}s  query: {linear_latency * 1000:8.3f}ms  recall: 1.000")
+
+for backend in ['brute', 'kdtree', 'hnsw']:
+    start = time.perf_counter()
+    index = SongIndex(songs, weights, attribute_keys, backend=backend)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = [index.query(song_id, num_neighbors) for song_id in query_ids]
+    latency = (time.perf_counter() - start) / len(query_ids)
+
+    start = time.perf_counter()
+    index.query_batch(query_ids, num_neighbors)
+    batch_latency = (time.perf_counter() - start) / len(query_ids)
+
+    recall = np.mean([len({song['id'] for song, _ in result} & truth) / len(truth)
+                      for result, truth in zip(results, expected)])
+    print(f"{backend:<12} build: {build_time:8.3f}s  query: {latency * 1000:8.3f}ms  "
+          f"batch query: {batch_latency * 1000:8.3f}ms  recall: {recall:.3f}")
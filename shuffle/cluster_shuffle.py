@@ -0,0 +1,141 @@
+from itertools import islice
+import numpy as np
+from scipy.spatial import cKDTree
+from graph_formation.communities import Clustering, cluster_means, nearest_centroid
+from shuffle.song_index import get_song_index
+from shuffle.samplers import select_candidate, DEFAULT_POOL_SIZE
+from instrumentation import trace
+
+# Number of nearest clusters searched along with the current song's own
+DEFAULT_ADJACENT_CLUSTERS = 2
+
+# Chance that a step only looks at a neighbouring cluster, so the queue drifts to a nearby mood
+DEFAULT_DRIFT = 0.05
+
+
+# Neighbour search restricted to a few clusters of a Clustering (see graph_formation/communities.py), over the
+# vectors of a SongIndex. Cluster centres are recomputed from the index's vectors, so "adjacent" means close in the
+# space the shuffle measures distances in, whatever the clustering was computed from. Songs the clustering doesn't
+# know join the cluster with the closest centre, including songs added to the index after the search was built (see
+# update).
+class ClusterSearch:
+    def __init__(self, index, clustering, num_adjacent=DEFAULT_ADJACENT_CLUSTERS):
+        if not isinstance(clustering, Clustering):
+            clustering = Clustering.load(clustering)
+        self.index = index
+        labels = np.full(len(index), -1, dtype=np.int64)
+        for track_id, label in zip(clustering.track_ids, clustering.labels.tolist()):
+            position = index.positions.get(track_id)
+            if position is not None:
+                labels[position] = label
+        known = labels >= 0
+        if not known.any():
+            raise ValueError("The clustering has none of the index's songs")
+        labels[known] = np.unique(labels[known], return_inverse=True)[1]  # Clusters without songs in the index
+        num_clusters = int(labels.max()) + 1
+        self.centres = cluster_means(index.vectors[known], labels[known], num_clusters)
+        if not known.all():
+            labels[~known] = nearest_centroid(index.vectors[~known], self.centres)
+        self.labels = labels
+
+        order = np.argsort(labels, kind='stable')
+        self.members = np.split(order, np.cumsum(np.bincount(labels, minlength=num_clusters))[:-1])
+        num_adjacent = min(num_adjacent, num_clusters - 1)
+        if num_adjacent > 0:
+            # The closest centre of every centre is itself, drop it
+            _, adjacent = cKDTree(self.centres).query(self.centres, num_adjacent + 1)
+            self.adjacent = np.asarray(adjacent).reshape(num_clusters, num_adjacent + 1)[:, 1:]
+        else:
+            self.adjacent = np.empty((num_clusters, 0), dtype=np.int64)
+
+    @property
+    def num_clusters(self):
+        return len(self.members)
+
+    # Puts the songs added to the index (SongIndex.add_songs) since the last call in the cluster with the closest
+    # centre. The centres themselves don't move.
+    def update(self):
+        start = len(self.labels)
+        if start >= len(self.index):
+            return
+        added = np.arange(start, len(self.index))
+        labels = nearest_centroid(self.index.vectors[added], self.centres)
+        self.labels = np.concatenate([self.labels, labels])
+        for cluster in np.unique(labels).tolist():
+            self.members[cluster] = np.concatenate([self.members[cluster], added[labels == cluster]])
+
+    # Up to num_neighbors songs of the given clusters closest to `position`, skipping the song itself, removed songs
+    # and songs marked in `visited`. Returns (positions, distances), closest first.
+    @trace.traced('neighbors.cluster_search')
+    def neighbors(self, position, clusters, visited, num_neighbors=20):
+        candidates = np.concatenate([self.members[cluster] for cluster in clusters])
+        candidates = candidates[~visited[candidates] & ~self.index.removed[candidates] & (candidates != position)]
+        difference = self.index.vectors[candidates] - self.index.vectors[position]
+        distances = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+        if len(candidates) > num_neighbors:
+            top = np.argpartition(distances, num_neighbors - 1)[:num_neighbors]
+            candidates, distances = candidates[top], distances[top]
+        order = np.argsort(distances, kind='stable')
+        return candidates[order], distances[order]
+
+
+# iter_song_queue with neighbours looked up in the current song's cluster and its num_adjacent closest clusters
+# instead of the whole library, so every step scores a small partition. With probability `drift` a step only looks
+# at one of the adjacent clusters, which moves the queue on to a neighbouring mood. When the searched clusters have
+# no unqueued song left, the step falls back to the whole index like iter_song_queue does.
+# `clustering` is a Clustering, a path to one saved with Clustering.save, or an already built ClusterSearch.
+def iter_cluster_queue(initial_song_id, songs, weights, attributes, clustering, exponent=2, num_neighbors=20,
+                       num_adjacent=DEFAULT_ADJACENT_CLUSTERS, drift=DEFAULT_DRIFT, index=None, scaling='none',
+                       rng=None, pool_size=DEFAULT_POOL_SIZE, temperature=1.0):
+    rng = rng if rng is not None else np.random.default_rng()
+    if isinstance(clustering, ClusterSearch):
+        search = clustering
+        index = search.index
+    else:
+        if index is None:
+            index = get_song_index(songs, weights, attributes, scaling=scaling)
+        search = ClusterSearch(index, clustering, num_adjacent)
+    search.update()
+    current_position = index.positions[initial_song_id]
+    queued = np.zeros(len(index), dtype=bool)
+    queued[current_position] = True
+    songs = index.songs
+    yield songs[current_position]
+
+    # Walks until no song is left rather than for a fixed number of steps, as songs may be added to the index while
+    # the queue is being walked
+    while True:
+        if len(queued) < len(index):
+            search.update()
+            queued = np.concatenate([queued, np.zeros(len(index) - len(queued), dtype=bool)])
+            songs = index.songs
+        cluster = search.labels[current_position]
+        adjacent = search.adjacent[cluster]
+        if drift and len(adjacent) and rng.random() < drift:
+            clusters = [adjacent[rng.integers(len(adjacent))]]
+        else:
+            clusters = [cluster, *adjacent]
+        positions, distances = search.neighbors(current_position, clusters, queued, num_neighbors)
+        selected = select_candidate(positions, distances, queued, exponent, pool_size, temperature, rng)
+
+        # Nothing left nearby: widen to the whole library
+        num_candidates = num_neighbors
+        while selected < 0:
+            positions, distances = index.neighbors(current_position, num_candidates)
+            selected = select_candidate(positions, distances, queued, exponent, pool_size, temperature, rng)
+            if num_candidates >= len(index) - 1:
+                break
+            num_candidates *= 2
+
+        if selected < 0:
+            return
+        queued[selected] = True
+        current_position = selected
+        yield songs[selected]
+
+
+def generate_cluster_queue(initial_song_id, songs, weights, attributes, clustering, num_songs, exponent=2,
+                           drift=DEFAULT_DRIFT, index=None, scaling='none', rng=None):
+    return list(islice(iter_cluster_queue(initial_song_id, songs, weights, attributes, clustering, exponent,
+                                          drift=drift, index=index, scaling=scaling, rng=rng),
+                       int(num_songs) + 1))
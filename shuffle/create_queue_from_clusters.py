@@ -0,0 +1,49 @@
+import os
+import shuffle_functions as sf
+from shuffle.cluster_shuffle import generate_cluster_queue
+from shuffle.song_index import get_song_index
+from graph_formation.communities import Clustering
+
+# Sample XML data
+xml_file = "../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml"  # Your XML data goes here
+clusters_file = "../output/gabeMain_clusters.npz"  # Computed on the first run, delete it to recluster
+
+songs = sf.load_songs(xml_file)
+
+attribute_keys = ['danceability',
+                  'energy',
+                  'loudness',
+                  'speechiness',
+                  'acousticness',
+                  'instrumentalness',
+                  'liveness',
+                  'valence'
+                  ]
+
+weights = {
+    'danceability': 1.2,
+    'energy': 1.2,
+    'loudness': 1,
+    'speechiness': 1,
+    'acousticness': 0.6,
+    'instrumentalness': 1,
+    'liveness': 0,
+    'valence': 1.5,
+}
+
+index = get_song_index(songs, weights, attribute_keys, scaling='minmax')
+if os.path.exists(clusters_file):
+    clustering = Clustering.load(clusters_file)
+else:
+    # k-means in the same scaled, weighted space the shuffle measures distances in
+    clustering = Clustering.from_vectors(index.vectors, index.song_ids)
+    clustering.save(clusters_file)
+
+initial_song_id = '4smkJW6uzoHxGReZqqwHS5'  # Replace with your actual initial song ID
+num_songs_to_queue = 30  # Number of songs you want in the queue
+drift = 0.1  # Chance of moving on to a neighbouring cluster at each step
+queued_songs = generate_cluster_queue(initial_song_id, songs, weights, attribute_keys, clustering, num_songs_to_queue,
+                                      drift=drift, index=index)
+
+for song in queued_songs:
+    print(song)
@@ -0,0 +1,16 @@
+import shuffle_functions as sf
+from shuffle.graph_walk import generate_graph_queue
+
+# Similarity graph saved by graph_formation/nearest_neighbors.py
+graph_file = "../output/gabeMain_graph.npz"
+
+# Sample XML data, only used to print the song details
+xml_file = "../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml"  # Your XML data goes here
+songs = sf.load_songs(xml_file)
+
+initial_song_id = '4smkJW6uzoHxGReZqqwHS5'  # Replace with your actual initial song ID
+num_songs_to_queue = 30  # Number of songs you want in the queue
+queued_songs = generate_graph_queue(graph_file, initial_song_id, num_songs_to_queue, songs=songs)
+
+for song in queued_songs:
+    print(song)
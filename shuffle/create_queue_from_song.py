@@ -3,8 +3,8 @@ import shuffle_functions as sf
 # Sample XML data
 xml_file = "../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml"  # Your XML data goes here
 
-# Parse XML data
-songs = sf.parse_xml(xml_file)
+# Load the playlist (from its binary store when it is up to date)
+songs = sf.load_songs(xml_file)
 
 # Weights dictionary (customize as needed)\
 attribute_keys = ['danceability',
@@ -30,7 +30,9 @@ weights = {
 
 initial_song_id = '4smkJW6uzoHxGReZqqwHS5'  # Replace with your actual initial song ID
 num_songs_to_queue = 30  # Number of songs you want in the queue
-queued_songs = sf.generate_song_queue(initial_song_id, songs, weights, attribute_keys, num_songs_to_queue)
+# Min-max scale every attribute over the playlist so loudness (in dB) doesn't outweigh the 0-1 attributes
+queued_songs = sf.generate_song_queue(initial_song_id, songs, weights, attribute_keys, num_songs_to_queue,
+                                      scaling='minmax')
 
 for song in queued_songs:
     print(song)
\ No newline at end of file
@@ -3,8 +3,8 @@ import shuffle_functions as sf
 # Sample XML data
 xml_file = "../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml"  # Your XML data goes here
 
-# Parse XML data
-songs = sf.parse_xml(xml_file)
+# Load the playlist (from its binary store when it is up to date)
+songs = sf.load_songs(xml_file)
 
 # Weights dictionary (customize as needed)\
 attribute_keys = ['danceability',
@@ -26,6 +26,8 @@ weights = {
     'valence': 1
 }
 
-similar_songs_with_distances = sf.find_similar_songs('4jz3eqH3Y8j565cUe3aSOq', songs, weights, attribute_keys)
-selected_song, similarity_value = sf.roulette_selection(similar_songs_with_distances)
+current_song_id = '4jz3eqH3Y8j565cUe3aSOq'
+similar_songs_with_distances = sf.find_similar_songs(current_song_id, songs, weights, attribute_keys)
+selected_song = sf.roulette_selection(similar_songs_with_distances, {current_song_id})
+similarity_value = next(distance for song, distance in similar_songs_with_distances if song is selected_song)
 print(f"Selected Song: {selected_song['title']} by {selected_song['artist']} - Similarity Value: {similarity_value}")
\ No newline at end of file
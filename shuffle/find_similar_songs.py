@@ -1,10 +1,11 @@
 import shuffle_functions as sf
+from shuffle.song_index import get_song_index
 
 # Sample XML data
 xml_file = "../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml"  # Your XML data goes here
 
-# Parse XML data
-songs = sf.parse_xml(xml_file)
+# Load the playlist (from its binary store when it is up to date)
+songs = sf.load_songs(xml_file)
 
 # Weights dictionary (customize as needed)\
 attribute_keys = ['danceability',
@@ -31,7 +32,10 @@ weights = {
 }
 
 
+# Min-max scale every attribute over the playlist so loudness (in dB) doesn't outweigh the 0-1 attributes
+index = get_song_index(songs, weights, attribute_keys, scaling='minmax')
+
 # Find similar songs
-similar_songs = sf.find_similar_songs('57bgtoPSgt236HzfBOd8kj', songs, weights, attribute_keys)
+similar_songs = sf.find_similar_songs('57bgtoPSgt236HzfBOd8kj', songs, weights, attribute_keys, index=index)
 for song, distance in similar_songs:
     print(f"{song['title']} by {song['artist']} - Similarity Value: {distance}")
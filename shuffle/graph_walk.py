@@ -0,0 +1,79 @@
+from itertools import islice
+import numpy as np
+from graph_formation.similarity_graph import SimilarityGraph
+from shuffle.song_index import song_ids
+from instrumentation import trace
+
+# Number of recently queued songs tried as restart points before teleporting to a random unqueued song
+RESTART_DEPTH = 20
+
+
+# Random unqueued position: rejection sampling while most songs are unqueued, an exact draw once few are left
+def _random_unvisited(visited, num_visited, rng):
+    if num_visited < len(visited) // 2:
+        while True:
+            position = int(rng.integers(len(visited)))
+            if not visited[position]:
+                return position
+    return int(rng.choice(np.flatnonzero(~visited)))
+
+
+# Picks an unqueued neighbour of `position` with probability proportional to similarity ** exponent, or None
+@trace.traced('selection.graph_step')
+def _step(graph, position, visited, exponent, rng):
+    neighbors, weights = graph.row(position)
+    free = ~visited[neighbors]
+    if not free.any():
+        return None
+    neighbors = neighbors[free]
+    # Work in log space so large exponents don't underflow, and keep non-positive similarities just possible
+    log_weights = exponent * np.log(np.maximum(weights[free].astype(np.float64), 1e-12))
+    probabilities = np.exp(log_weights - log_weights.max())
+    return int(neighbors[rng.choice(len(neighbors), p=probabilities / probabilities.sum())])
+
+
+# Generator that yields a queue of track ids by a weighted random walk over a precomputed similarity graph, starting
+# with the initial song. Each step only looks at the current song's edges, so it costs O(degree) whatever the library
+# size. Songs are never repeated. When every neighbour is already queued the walk restarts from a recently queued
+# song that still has free neighbours, and teleports to a random unqueued song when none of the last RESTART_DEPTH
+# has any; restart_probability also makes it teleport at random for more variety.
+def iter_graph_walk(graph, initial_song_id, exponent=2, restart_probability=0.0, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    visited = np.zeros(len(graph), dtype=bool)
+    current = graph.index[initial_song_id]
+    visited[current] = True
+    recent = [current]
+    yield initial_song_id
+
+    for num_visited in range(1, len(graph)):
+        selected = None
+        if not restart_probability or rng.random() >= restart_probability:
+            selected = _step(graph, current, visited, exponent, rng)
+            for restart in reversed(recent[-RESTART_DEPTH:-1] if selected is None else ()):
+                selected = _step(graph, restart, visited, exponent, rng)
+                if selected is not None:
+                    break
+        if selected is None:
+            selected = _random_unvisited(visited, num_visited, rng)
+
+        visited[selected] = True
+        recent.append(selected)
+        if len(recent) > RESTART_DEPTH:
+            del recent[0]
+        current = selected
+        yield graph.track_ids[selected]
+
+
+# Builds a queue of num_songs songs after the initial one from a similarity graph saved with SimilarityGraph.save (or
+# an already loaded SimilarityGraph). Returns track ids, or the matching song dicts when `songs` is given.
+def generate_graph_queue(graph, initial_song_id, num_songs, exponent=2, restart_probability=0.0, songs=None,
+                         rng=None):
+    if not isinstance(graph, SimilarityGraph):
+        graph = SimilarityGraph.load(graph)
+    walk = iter_graph_walk(graph, initial_song_id, exponent, restart_probability, rng)
+    queue = list(islice(walk, int(num_songs) + 1))
+    if songs is None:
+        return queue
+    # Positions rather than songs, so only the queued songs of a StoreSongs are built
+    positions = {song_id: position for position, song_id in enumerate(song_ids(songs))}
+    return [songs[positions[track_id]] for track_id in queue if track_id in positions]
@@ -0,0 +1,79 @@
+import numpy as np
+from instrumentation import trace
+
+# Distances are clamped to this before taking logs, so identical songs get the highest weight instead of log(0)
+MIN_DISTANCE = 1e-12
+
+# Number of closest unqueued candidates roulette_selection has always drawn from
+DEFAULT_POOL_SIZE = 3
+
+
+# Log of the selection weight (1 / distance) ** (exponent / temperature) of every candidate. Working with logs avoids
+# the overflow (1 / distance) ** 10 hits for very close songs.
+def selection_log_weights(distances, exponent=10, temperature=1.0):
+    distances = np.maximum(np.asarray(distances, dtype=np.float64), MIN_DISTANCE)
+    return -(exponent / temperature) * np.log(distances)
+
+
+# Draws k distinct positions with probability proportional to exp(log_weights) (Gumbel-top-k trick: add Gumbel noise
+# and keep the k largest). Entries with log weight -inf are never drawn. Works on the last axis, so a 2-D array draws
+# for every row at once. Without an rng the global np.random state is used, so np.random.seed() still makes queues
+# reproducible.
+def gumbel_top_k(log_weights, k=1, rng=None):
+    log_weights = np.asarray(log_weights, dtype=np.float64)
+    noise = rng.gumbel(size=log_weights.shape) if rng is not None else np.random.gumbel(size=log_weights.shape)
+    keys = log_weights + noise
+    k = min(k, log_weights.shape[-1])
+    top = np.argpartition(-keys, k - 1, axis=-1)[..., :k] if k < log_weights.shape[-1] else \
+        np.broadcast_to(np.arange(log_weights.shape[-1]), log_weights.shape)
+    order = np.argsort(-np.take_along_axis(keys, top, axis=-1), axis=-1)
+    return np.take_along_axis(top, order, axis=-1)
+
+
+# Walker/Vose alias table: after O(n) setup, every draw (with replacement) costs O(1). Worth it when many draws are
+# made from the same distribution.
+class AliasTable:
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        scaled = weights / weights.sum() * n
+        self.probability = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            low, high = small.pop(), large.pop()
+            self.probability[low] = scaled[low]
+            self.alias[low] = high
+            scaled[high] -= 1 - scaled[low]
+            (small if scaled[high] < 1 else large).append(high)
+
+    # Without an rng the global np.random state is used, like gumbel_top_k
+    def sample(self, size=None, rng=None):
+        if rng is not None:
+            columns = rng.integers(0, len(self.probability), size=size)
+            keep = rng.random(size=size) < self.probability[columns]
+        else:
+            columns = np.random.randint(0, len(self.probability), size=size)
+            keep = np.random.random(size=size) < self.probability[columns]
+        return np.where(keep, columns, self.alias[columns])
+
+
+# Picks the next song from a neighbour list. `candidates` are song positions sorted closest first, `distances` their
+# distances and `visited` a boolean array over all songs marking the ones already queued. Only the pool_size closest
+# unvisited candidates take part (all of them when pool_size is None); each is drawn with probability proportional to
+# (1 / distance) ** (exponent / temperature). Returns the chosen position, or -1 when every candidate is visited.
+# With size=n, returns n independent draws instead.
+@trace.traced('selection.select_candidate')
+def select_candidate(candidates, distances, visited, exponent=10, pool_size=DEFAULT_POOL_SIZE, temperature=1.0,
+                     rng=None, size=None):
+    candidates = np.asarray(candidates)
+    free = ~visited[candidates]
+    pool = np.flatnonzero(free)[:pool_size]
+    if len(pool) == 0:
+        return -1 if size is None else np.full(size, -1)
+    log_weights = selection_log_weights(np.asarray(distances)[pool], exponent, temperature)
+    if size is None:
+        return int(candidates[pool[gumbel_top_k(log_weights, 1, rng)[0]]])
+    probabilities = np.exp(log_weights - log_weights.max())
+    return candidates[pool[AliasTable(probabilities).sample(size, rng)]]
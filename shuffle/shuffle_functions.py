@@ -1,21 +1,29 @@
-import xml.etree.ElementTree as ET
+from itertools import islice
 import numpy as np
 from scipy.spatial.distance import cosine
+from playlist_io.playlist_store import load_playlist, STRING_FIELDS
+from playlist_io.xml_stream import iter_tracks
+from shuffle.song_index import get_song_index
+from shuffle.samplers import select_candidate, DEFAULT_POOL_SIZE
+from instrumentation import trace
 
 # Parse the XML and convert to a list of dicts
+@trace.traced('parse.parse_xml')
 def parse_xml(file_path):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-
     songs = []
-    for track in root.findall('track'):
-        song = {child.tag: child.text for child in track}
-        song = {k: float(v) if k not in ['title', 'id', 'artist', 'type', 'uri', 'track_href', 'analysis_url'] else v
-                for k, v in song.items()}
+    for song in iter_tracks(file_path):
+        song = {k: float(v) if k not in STRING_FIELDS else v for k, v in song.items()}
         songs.append(song)
     return songs
 
 
+# Same songs as parse_xml, but read from the playlist's binary store (rebuilt from the XML file when it is missing or
+# out of date) instead of parsing the XML every time. Returns a playlist_store.StoreSongs sequence, which only builds
+# the dicts of the songs that are read; SongIndex reads the feature columns directly.
+def load_songs(file_path):
+    return load_playlist(file_path).songs()
+
+
 # Calculate weighted Euclidean distance between two songs
 def calculate_distance(song1, song2, weights, attributes, distance_type='euclidean'):
     if distance_type == 'euclidean':
@@ -34,8 +42,12 @@ def calculate_distance(song1, song2, weights, attributes, distance_type='euclide
 
 
 
-# Main function to find similar songs
-def find_similar_songs(song_id, songs, weights, attributes, num_neighbors=20):
+# Main function to find similar songs. Pass a SongIndex (see song_index.get_song_index) to answer from the index
+# instead of scanning the whole playlist.
+def find_similar_songs(song_id, songs, weights, attributes, num_neighbors=20, index=None):
+    if index is not None:
+        return index.query(song_id, num_neighbors)
+
     target_song = next(song for song in songs if song['id'] == song_id)
     distances = []
 
@@ -47,55 +59,55 @@ def find_similar_songs(song_id, songs, weights, attributes, num_neighbors=20):
     distances.sort(key=lambda x: x[1])  # Sort by distance
     return distances[:num_neighbors]  # Return the top 20 songs along with their distances
 
-# Function used to reward more similar songs
-def roulette_selection(similar_songs_with_distances, queued_song_ids, exponent=10):
+# Function used to reward more similar songs: draws one of the pool_size closest songs that aren't queued yet, with
+# probability proportional to (1 / distance) ** (exponent / temperature). The weights are computed in log space, so
+# large exponents no longer overflow, and an identical song (distance 0) gets the highest weight.
+# rng is a numpy Generator (a shared default one when None).
+def roulette_selection(similar_songs_with_distances, queued_song_ids, exponent=10, rng=None,
+                       pool_size=DEFAULT_POOL_SIZE, temperature=1.0):
+    if not similar_songs_with_distances:
+        return None
     # Filter out songs that are already in the queue
-    filtered_songs_with_distances = [(song, distance) for song, distance in similar_songs_with_distances if song['id'] not in queued_song_ids]
-
-    # Take only the top 3 songs based on distance
-    top_songs_with_distances = filtered_songs_with_distances[:3]
-
-    # If there are less than 3 songs available, select from whatever is available
-    if len(top_songs_with_distances) == 0:
+    queued = np.array([song['id'] in queued_song_ids for song, _ in similar_songs_with_distances], dtype=bool)
+    distances = [distance for _, distance in similar_songs_with_distances]
+    selected_index = select_candidate(np.arange(len(queued)), distances, queued, exponent, pool_size, temperature, rng)
+    if selected_index < 0:
         return None
-
-    # Initialize a list to store the probabilities for the top 3 songs
-    probabilities = []
-
-    # Process each of the top 3 songs and calculate its probability
-    for song, distance in top_songs_with_distances:
-        # Calculate the probability using the inverse of the distance and apply an exponent
-        prob = (1 / distance if distance != 0 else 1.0) ** exponent
-        probabilities.append(prob)
-
-    # Normalize the probabilities so they form a probability distribution
-    total = sum(probabilities)
-    probabilities = [prob / total for prob in probabilities]
-
-    # Randomly select a song based on the probability distribution
-    selected_index = np.random.choice(len(top_songs_with_distances), p=probabilities)
-    selected_song = top_songs_with_distances[selected_index][0]
-
-    return selected_song
-
-def generate_song_queue(initial_song_id, songs, weights, attributes, num_songs, exponent=2):
-    current_song_id = initial_song_id
-    song_queue = [next(song for song in songs if song['id'] == initial_song_id)]
-    queued_song_ids = {initial_song_id}  # Set of IDs to track already queued songs
-
-    while len(song_queue) < num_songs + 1:  # +1 because the initial song is already in the queue
-        # Find similar songs to the current song
-        similar_songs_with_distances = find_similar_songs(current_song_id, songs, weights, attributes)
-
-        # Select the next song using roulette selection
-        selected_song = roulette_selection(similar_songs_with_distances, queued_song_ids, exponent)
-
-        # Add the selected song to the queue
-        song_queue.append(selected_song)
-        queued_song_ids.add(selected_song['id'])
-
-        # Update the current song to the selected song
-        current_song_id = selected_song['id']
-
-    return song_queue
-
+    return similar_songs_with_distances[selected_index][0]
+
+# Generator that yields the queue one song at a time, starting with the initial song, so playback can start as soon as
+# the first songs are chosen. Neighbour lists come from the cached index instead of a scan of the whole playlist, and
+# the next song is drawn with samplers.select_candidate (see roulette_selection for pool_size and temperature).
+# When every one of the num_neighbors closest songs is already queued, the candidate list is doubled until an
+# unqueued song shows up, so the walk only stops once every song in the playlist has been queued.
+def iter_song_queue(initial_song_id, songs, weights, attributes, exponent=2, num_neighbors=20, index=None,
+                    scaling='none', rng=None, pool_size=DEFAULT_POOL_SIZE, temperature=1.0):
+    if index is None:
+        index = get_song_index(songs, weights, attributes, scaling=scaling)
+    current_position = index.positions[initial_song_id]
+    queued = np.zeros(len(index), dtype=bool)  # Tracks already queued songs by position
+    queued[current_position] = True
+    songs = index.songs  # Includes songs added to the index after it was built
+    yield songs[current_position]
+
+    for _ in range(len(index) - 1):
+        num_candidates = num_neighbors
+        while True:
+            positions, distances = index.neighbors(current_position, num_candidates)
+            selected = select_candidate(positions, distances, queued, exponent, pool_size, temperature, rng)
+            if selected >= 0 or num_candidates >= len(index) - 1:
+                break
+            num_candidates *= 2
+
+        if selected < 0:
+            return
+        queued[selected] = True
+        current_position = selected
+        yield songs[selected]
+
+def generate_song_queue(initial_song_id, songs, weights, attributes, num_songs, exponent=2, index=None,
+                        scaling='none'):
+    # +1 because the initial song is also in the queue
+    return list(islice(iter_song_queue(initial_song_id, songs, weights, attributes, exponent, index=index,
+                                       scaling=scaling),
+                       int(num_songs) + 1))
@@ -0,0 +1,344 @@
+import heapq
+import math
+from collections import OrderedDict
+import numpy as np
+from scipy.spatial import cKDTree
+from graph_formation.preprocessing import prepare_features_cached
+from playlist_io.playlist_store import StoreSongs
+from instrumentation import trace
+
+# Number of neighbour lists SongIndex.neighbors keeps in memory before evicting the least recently used
+NEIGHBOR_CACHE_SIZE = 1024
+
+# Number of indexes get_song_index keeps alive before evicting the least recently used (each holds its playlist)
+INDEX_CACHE_SIZE = 4
+
+# Number of query rows scored at once by the brute-force backend (keeps the distance block around 32MB)
+BRUTE_FORCE_BLOCK_CELLS = 2 ** 22
+
+
+# Turns a list of song dicts into vectors where plain Euclidean distance equals the weighted distance used by
+# calculate_distance: sqrt(sum w * (a - b)^2) == ||sqrt(w) * a - sqrt(w) * b||. With a scaling other than 'none'
+# every attribute is first rescaled over the playlist (see preprocessing.SCALINGS), so loudness and tempo don't drown
+# out the 0-1 attributes.
+def song_vectors(songs, weights, attributes, scaling='none'):
+    return song_features(songs, weights, attributes, scaling).vectors
+
+
+# The PreparedFeatures behind song_vectors, whose transform() scales songs added later the same way. Songs loaded
+# from a store (StoreSongs) are read from its columns, where a missing value counts as the attribute's center.
+@trace.traced('features.song_vectors')
+def song_features(songs, weights, attributes, scaling='none'):
+    if isinstance(songs, StoreSongs):
+        values, mask = songs.features(attributes)
+    else:
+        values = _song_values(songs, attributes)
+        mask = np.ones(values.shape, dtype=bool)
+    return prepare_features_cached(values, mask, attributes, weights, scaling)
+
+
+# Ids of the songs, without building the dicts of StoreSongs
+def song_ids(songs):
+    return songs.ids if isinstance(songs, StoreSongs) else [song['id'] for song in songs]
+
+
+def _song_values(songs, attributes):
+    values = np.array([[song[key] for key in attributes] for song in songs], dtype=np.float64)
+    return values.reshape(len(songs), len(attributes))
+
+
+# Exact search: scores every song with one matrix product per block of queries and keeps the k best with argpartition
+class BruteForceBackend:
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+
+    def extend(self, vectors):
+        self.vectors = np.vstack([self.vectors, vectors])
+        self.squared_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+
+    def search(self, queries, k):
+        k = min(k, len(self.vectors))
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float64)
+        block_size = max(1, BRUTE_FORCE_BLOCK_CELLS // max(len(self.vectors), 1))
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            squared = (np.einsum('ij,ij->i', block, block)[:, None] + self.squared_norms[None, :]
+                       - 2 * block @ self.vectors.T)
+            np.maximum(squared, 0, out=squared)
+            top = np.argpartition(squared, k - 1, axis=1)[:, :k] if k < len(self.vectors) else \
+                np.broadcast_to(np.arange(len(self.vectors)), squared.shape)
+            top_squared = np.take_along_axis(squared, top, axis=1)
+            order = np.argsort(top_squared, axis=1, kind='stable')
+            indices[start:start + len(block)] = np.take_along_axis(top, order, axis=1)
+            distances[start:start + len(block)] = np.sqrt(np.take_along_axis(top_squared, order, axis=1))
+        return indices, distances
+
+
+# Exact search with a KD-tree, O(log n) per query for the handful of attributes songs have
+class KDTreeBackend:
+    def __init__(self, vectors, leafsize=16):
+        self.leafsize = leafsize
+        self.tree = cKDTree(vectors, leafsize=leafsize)
+        self.size = len(vectors)
+
+    # Rebuilding is O(n log n) and takes milliseconds for the few attributes songs have
+    def extend(self, vectors):
+        self.__init__(np.vstack([self.tree.data, vectors]), self.leafsize)
+
+    def search(self, queries, k):
+        k = min(k, self.size)
+        distances, indices = self.tree.query(queries, k=k)
+        return np.asarray(indices, dtype=np.int64).reshape(len(queries), k), \
+            np.asarray(distances, dtype=np.float64).reshape(len(queries), k)
+
+
+# Approximate search with a Hierarchical Navigable Small World graph. Every song is linked to its closest songs on
+# layer 0, and a random, exponentially thinning subset of songs is also linked on the layers above. A query walks
+# greedily down from the top layer, so it only ever looks at O(log n) songs.
+class HNSWBackend:
+    def __init__(self, vectors, M=16, ef_construction=100, ef_search=64, seed=0):
+        self.vectors = vectors
+        self.M = M
+        self.max_links0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_scale = 1 / math.log(max(M, 2))
+        self.rng = np.random.default_rng(seed)
+        self.layers = []  # layers[level][node] -> list of linked nodes
+        self.entry_point = None
+        for node in range(len(vectors)):
+            self.add(node)
+
+    def _distances(self, query, nodes):
+        diff = self.vectors[nodes] - query
+        return np.einsum('ij,ij->i', diff, diff)
+
+    # Best-first search of one layer, returns the ef closest (squared distance, node) pairs found
+    def _search_layer(self, query, entry_points, ef, level):
+        links = self.layers[level]
+        visited = set(entry_points)
+        entry_distances = self._distances(query, entry_points)
+        candidates = [(d, node) for d, node in zip(entry_distances.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        best = [(-d, node) for d, node in candidates]  # max-heap of the ef closest so far
+        heapq.heapify(best)
+        while len(best) > ef:
+            heapq.heappop(best)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -best[0][0]:
+                break
+            neighbors = [neighbor for neighbor in links.get(node, ()) if neighbor not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for neighbor_distance, neighbor in zip(self._distances(query, neighbors).tolist(), neighbors):
+                if len(best) < ef or neighbor_distance < -best[0][0]:
+                    heapq.heappush(candidates, (neighbor_distance, neighbor))
+                    heapq.heappush(best, (-neighbor_distance, neighbor))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+        return sorted((-d, node) for d, node in best)
+
+    # Keeps only the closest max_links links of a node
+    def _shrink(self, node, links, max_links):
+        if len(links) <= max_links:
+            return links
+        distances = self._distances(self.vectors[node], links)
+        return [links[i] for i in np.argsort(distances)[:max_links]]
+
+    def add(self, node):
+        query = self.vectors[node]
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_scale)
+        while len(self.layers) <= level:
+            self.layers.append({})
+
+        if self.entry_point is None:
+            for layer in range(level + 1):
+                self.layers[layer][node] = []
+            self.entry_point = node
+            self.top_level = level
+            return
+
+        entry_points = [self.entry_point]
+        for layer in range(self.top_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+
+        for layer in range(min(level, self.top_level), -1, -1):
+            found = self._search_layer(query, entry_points, self.ef_construction, layer)
+            max_links = self.max_links0 if layer == 0 else self.M
+            links = [neighbor for _, neighbor in found[:self.M]]
+            self.layers[layer][node] = links
+            for neighbor in links:
+                neighbor_links = self.layers[layer][neighbor]
+                neighbor_links.append(node)
+                if len(neighbor_links) > max_links:
+                    self.layers[layer][neighbor] = self._shrink(neighbor, neighbor_links, max_links)
+            entry_points = [neighbor for _, neighbor in found]
+
+        for layer in range(self.top_level + 1, level + 1):
+            self.layers[layer][node] = []
+        if level > self.top_level:
+            self.entry_point = node
+            self.top_level = level
+
+    # Inserts new songs into the existing graph, no rebuild needed
+    def extend(self, vectors):
+        start = len(self.vectors)
+        self.vectors = np.vstack([self.vectors, vectors])
+        for node in range(start, len(self.vectors)):
+            self.add(node)
+
+    def search(self, queries, k):
+        k = min(k, len(self.vectors))
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float64)
+        for row, query in enumerate(queries):
+            entry_points = [self.entry_point]
+            for layer in range(self.top_level, 0, -1):
+                entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+            found = self._search_layer(query, entry_points, max(self.ef_search, k), 0)[:k]
+            # The graph can reach fewer than k songs in tiny libraries, score everything in that case
+            if len(found) < k:
+                all_distances = self._distances(query, np.arange(len(self.vectors)))
+                found = [(all_distances[node], node) for node in np.argsort(all_distances, kind='stable')[:k]]
+            indices[row] = [node for _, node in found]
+            distances[row] = np.sqrt([distance for distance, _ in found])
+        return indices, distances
+
+
+BACKENDS = {
+    'brute': BruteForceBackend,
+    'kdtree': KDTreeBackend,
+    'hnsw': HNSWBackend,
+}
+
+
+# Weighted k-nearest-neighbour index over a playlist. Build it once per (songs, weights, attributes) and query it as
+# many times as needed instead of rescanning the whole library for every song.
+# add_songs and remove_songs keep it current when the playlist changes: added songs are scaled with the statistics of
+# the original library and inserted into the backend, removed songs keep their position but are never returned again.
+class SongIndex:
+    @trace.traced('neighbors.build_index')
+    def __init__(self, songs, weights, attributes, backend='brute', cache_size=NEIGHBOR_CACHE_SIZE, scaling='none',
+                 **backend_options):
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid backend. Expected one of {sorted(BACKENDS)}")
+        self.songs = songs
+        self.weights = dict(weights)
+        self.attributes = list(attributes)
+        self.backend_name = backend
+        self.scaling = scaling
+        self.song_ids = song_ids(songs)
+        self.positions = {song_id: position for position, song_id in enumerate(self.song_ids)}
+        self.prepared = song_features(songs, weights, attributes, scaling)
+        self.vectors = self.prepared.vectors
+        self.removed = np.zeros(len(songs), dtype=bool)
+        self.backend = BACKENDS[backend](self.vectors, **backend_options)
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._neighbor_cache = OrderedDict()  # position -> (neighbour positions, distances)
+
+    # Number of positions, removed songs included (positions never move)
+    def __len__(self):
+        return len(self.songs)
+
+    @property
+    def num_removed(self):
+        return int(self.removed.sum())
+
+    # Finds the num_neighbors closest songs for each of the given song positions, excluding the song itself and
+    # removed songs. Returns two (len(positions), num_neighbors) arrays: song positions and distances, closest first.
+    @trace.traced('neighbors.search')
+    def query_positions(self, positions, num_neighbors=20):
+        positions = np.atleast_1d(np.asarray(positions, dtype=np.int64))
+        num_removed = self.num_removed
+        num_neighbors = min(num_neighbors, len(self) - num_removed - 1)
+        if num_neighbors <= 0:
+            return np.empty((len(positions), 0), dtype=np.int64), np.empty((len(positions), 0))
+
+        # Ask for enough extra results that dropping the song itself and every removed song still leaves enough
+        indices, distances = self.backend.search(self.vectors[positions], num_neighbors + 1 + num_removed)
+        keep = (indices != positions[:, None]) & ~self.removed[indices]
+        # The first num_neighbors kept results of every row (if the song itself wasn't returned, because of exact
+        # duplicates, this drops the farthest result instead)
+        columns = np.argsort(~keep, axis=1, kind='stable')[:, :num_neighbors]
+        return np.take_along_axis(indices, columns, axis=1), np.take_along_axis(distances, columns, axis=1)
+
+    # Adds songs (dicts with every attribute) at the end of the index
+    def add_songs(self, songs):
+        songs = [song for song in songs if song['id'] not in self.positions]
+        if not songs:
+            return
+        vectors, _ = self.prepared.transform(_song_values(songs, self.attributes),
+                                             np.ones((len(songs), len(self.attributes)), dtype=bool))
+        self.backend.extend(vectors)
+        self.vectors = np.vstack([self.vectors, vectors])
+        # New list, so the caller's list (and get_song_index's cache entry for it) isn't changed under them
+        self.songs = self.songs + songs
+        for song in songs:
+            self.positions[song['id']] = len(self.song_ids)
+            self.song_ids.append(song['id'])
+        self.removed = np.concatenate([self.removed, np.zeros(len(songs), dtype=bool)])
+        self._neighbor_cache.clear()
+
+    # Stops returning these songs. Every removal widens the searches a little, rebuild the index after many of them.
+    def remove_songs(self, song_ids):
+        for song_id in song_ids:
+            position = self.positions.pop(song_id, None)
+            if position is not None:
+                self.removed[position] = True
+        self._neighbor_cache.clear()
+
+    # Cached version of query_positions for a single song. Keeps the widest neighbour list computed so far for the
+    # most recently used songs, so asking again for the same or a smaller number of neighbours is free.
+    def neighbors(self, position, num_neighbors=20):
+        num_neighbors = min(num_neighbors, len(self) - 1)
+        cached = self._neighbor_cache.get(position)
+        if cached is not None and len(cached[0]) >= num_neighbors:
+            self.cache_hits += 1
+            trace.count('neighbors.cache.hits')
+            self._neighbor_cache.move_to_end(position)
+            return cached[0][:num_neighbors], cached[1][:num_neighbors]
+
+        self.cache_misses += 1
+        trace.count('neighbors.cache.misses')
+        indices, distances = self.query_positions([position], num_neighbors)
+        self._neighbor_cache[position] = (indices[0], distances[0])
+        self._neighbor_cache.move_to_end(position)
+        while len(self._neighbor_cache) > self.cache_size:
+            self._neighbor_cache.popitem(last=False)
+        return indices[0], distances[0]
+
+    # Same output as find_similar_songs: a list of (song, distance) tuples, closest first
+    def query(self, song_id, num_neighbors=20):
+        return self.query_batch([song_id], num_neighbors)[0]
+
+    def query_batch(self, song_ids, num_neighbors=20):
+        positions = [self.positions[song_id] for song_id in song_ids]
+        indices, distances = self.query_positions(positions, num_neighbors)
+        return [[(self.songs[index], distance) for index, distance in zip(row_indices.tolist(), row_distances.tolist())]
+                for row_indices, row_distances in zip(indices, distances)]
+
+
+# The INDEX_CACHE_SIZE most recently used indexes, keyed by (playlist, weights, attributes, backend)
+_index_cache = OrderedDict()
+
+
+# Returns the index for this playlist and settings, building it on first use
+def get_song_index(songs, weights, attributes, backend='brute', scaling='none', **backend_options):
+    key = (id(songs), len(songs), tuple(sorted(weights.items())), tuple(attributes), backend, scaling,
+           tuple(sorted(backend_options.items())))
+    index = _index_cache.get(key)
+    # The playlist is keyed by identity, so make sure it is still the same list object
+    if index is None or index.songs is not songs:
+        index = SongIndex(songs, weights, attributes, backend, scaling=scaling, **backend_options)
+        _index_cache[key] = index
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    _index_cache.move_to_end(key)
+    return index
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the parts of the Spotify Web API this project uses, so the fetcher can be exercised and
+# benchmarked without credentials or network access.
+#   GET /v1/audio-features?ids=a,b,c  -> {"audio_features": [...]}, deterministic features per id
+#   POST /v1/me/player/queue?uri=...  -> 204, the uri is appended to server.queued
+
+AUDIO_FEATURE_NAMES = ['danceability', 'energy', 'speechiness', 'acousticness', 'instrumentalness', 'liveness',
+                       'valence']
+
+
+# Deterministic, plausible-looking audio features for an id
+def fake_audio_features(track_id):
+    digest = hashlib.sha256(track_id.encode('utf-8')).digest()
+    features = {name: round(digest[i] / 255, 4) for i, name in enumerate(AUDIO_FEATURE_NAMES)}
+    features.update({
+        'loudness': round(-digest[7] / 255 * 20, 3),
+        'tempo': round(60 + digest[8] / 255 * 140, 3),
+        'key': digest[9] % 12,
+        'mode': digest[10] % 2,
+        'duration_ms': 120000 + digest[11] * 1000,
+        'time_signature': 4,
+        'type': 'audio_features',
+        'id': track_id,
+        'uri': f"spotify:track:{track_id}",
+    })
+    return features
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so clients can reuse connections
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Counts the request and answers 429 every `rate_limit_every` requests when configured to
+    def _rate_limited(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            count = server.request_count
+        if server.rate_limit_every and count % server.rate_limit_every == 0:
+            self._send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                            {'Retry-After': str(server.retry_after)})
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/v1/audio-features':
+            self._send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+            return
+        if self._rate_limited():
+            return
+        time.sleep(self.server.latency)
+        ids = [track_id for track_id in parse_qs(url.query).get('ids', [''])[0].split(',') if track_id]
+        if len(ids) > 100:
+            self._send_json(400, {'error': {'status': 400, 'message': 'Too many ids requested'}})
+            return
+        self._send_json(200, {'audio_features': [fake_audio_features(track_id) for track_id in ids]})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/v1/me/player/queue':
+            self._send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+            return
+        if self._rate_limited():
+            return
+        time.sleep(self.server.latency)
+        uri = parse_qs(url.query).get('uri', [None])[0]
+        if not uri:
+            self._send_json(400, {'error': {'status': 400, 'message': 'Missing uri'}})
+            return
+        with self.server.lock:
+            self.server.queued.append(uri)
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+# Starts the fake server on a background thread and returns (server, base_url). Call server.shutdown() to stop it.
+# latency is added to every request; with rate_limit_every=N every Nth request gets a 429 asking to wait retry_after.
+def start_fake_server(port=0, latency=0.0, rate_limit_every=0, retry_after=1):
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeSpotifyHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.rate_limit_every = rate_limit_every
+    server.retry_after = retry_after
+    server.request_count = 0
+    server.queued = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    server, base_url = start_fake_server(port=8765)
+    print(f"Fake Spotify API listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,93 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from instrumentation import trace
+
+# Bump when the shape of the cached features changes, older entries are then treated as misses
+FEATURE_VERSION = 1
+
+# Audio features don't change, but refetch now and then in case Spotify reanalyses a track
+DEFAULT_TTL = 90 * 24 * 3600
+
+# Maximum number of ids per SELECT (stays under SQLite's bound-parameter limit)
+QUERY_CHUNK_SIZE = 500
+
+
+# On-disk audio-feature cache keyed by track id, shared by every playlist. Tracks Spotify has no features for are
+# cached too (as None), so they aren't requested again either. Entries older than `ttl` seconds or written with
+# another FEATURE_VERSION count as misses.
+class FeatureCache:
+    def __init__(self, path, ttl=DEFAULT_TTL, version=FEATURE_VERSION):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS audio_features ("
+                                "track_id TEXT PRIMARY KEY, version INTEGER NOT NULL, fetched_at REAL NOT NULL, "
+                                "features TEXT)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # Returns {track_id: features} for the ids that are cached and still valid; the others are counted as misses
+    def get_many(self, track_ids):
+        track_ids = list(dict.fromkeys(track_ids))
+        oldest = time.time() - self.ttl if self.ttl is not None else float('-inf')
+        found = {}
+        with self.lock:
+            for start in range(0, len(track_ids), QUERY_CHUNK_SIZE):
+                chunk = track_ids[start:start + QUERY_CHUNK_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT track_id, features FROM audio_features WHERE version = ? AND fetched_at >= ? "
+                    f"AND track_id IN ({','.join('?' * len(chunk))})", [self.version, oldest, *chunk])
+                for track_id, features in rows:
+                    found[track_id] = json.loads(features) if features is not None else None
+            self.hits += len(found)
+            self.misses += len(track_ids) - len(found)
+        trace.count('feature_cache.hits', len(found))
+        trace.count('feature_cache.misses', len(track_ids) - len(found))
+        return found
+
+    def get(self, track_id, default=None):
+        return self.get_many([track_id]).get(track_id, default)
+
+    # Stores {track_id: features or None}
+    def put_many(self, features_by_id):
+        now = time.time()
+        rows = [(track_id, self.version, now, json.dumps(features) if features is not None else None)
+                for track_id, features in features_by_id.items()]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO audio_features VALUES (?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    # Removes expired entries and entries from other versions
+    def prune(self):
+        oldest = time.time() - self.ttl if self.ttl is not None else float('-inf')
+        with self.lock:
+            self.connection.execute("DELETE FROM audio_features WHERE version != ? OR fetched_at < ?",
+                                    (self.version, oldest))
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM audio_features").fetchone()[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,193 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+import spotipy
+from spotipy.oauth2 import SpotifyClientCredentials
+from tqdm import tqdm
+from instrumentation import trace
+
+# The audio-features endpoint accepts up to 100 ids per call
+MAX_BATCH_SIZE = 100
+
+# Number of attempts for a batch that fails with a network error (rate limiting is retried without limit)
+MAX_ATTEMPTS = 5
+
+
+# Raised by clients when the API answers 429, with the number of seconds it asked us to wait
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+# Token bucket shared by all the fetcher threads. Each request takes a token; tokens refill at `rate` per second up
+# to `capacity`. When the API answers 429, pause() stops every thread until the Retry-After delay has passed.
+class TokenBucket:
+    def __init__(self, rate=10.0, capacity=10):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# Client interface used by the fetcher: audio_features(track_ids) returns one features dict (or None) per id, in the
+# same order, and raises RateLimited on a 429. This one goes through spotipy.
+class SpotipyFeaturesClient:
+    def __init__(self, sp):
+        self.sp = sp
+
+    def audio_features(self, track_ids):
+        try:
+            return self.sp.audio_features(list(track_ids))
+        except spotipy.SpotifyException as e:
+            if e.http_status == 429:
+                raise RateLimited(int((e.headers or {}).get('Retry-After', 1)))
+            raise e
+
+
+# Same interface over plain HTTP, for any server that speaks the audio-features endpoint (e.g. fake_spotify_server)
+class HttpFeaturesClient:
+    def __init__(self, base_url, token=None, pool_size=8):
+        self.base_url = base_url.rstrip('/')
+        self.session = pooled_session(pool_size)
+        if token:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+
+    def audio_features(self, track_ids):
+        response = self.session.get(f"{self.base_url}/v1/audio-features", params={'ids': ','.join(track_ids)},
+                                    timeout=30)
+        if response.status_code == 429:
+            raise RateLimited(int(response.headers.get('Retry-After', 1)))
+        response.raise_for_status()
+        return response.json()['audio_features']
+
+
+# requests session that keeps up to pool_size connections open, so the fetcher threads reuse them
+def pooled_session(pool_size=8):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# spotipy client with a pooled session. spotipy's own retries are turned off so 429s reach the shared rate limiter.
+def make_spotipy_client(client_id, client_secret, pool_size=8):
+    client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
+    sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager,
+                         requests_session=pooled_session(pool_size), retries=0, status_retries=0)
+    return SpotipyFeaturesClient(sp)
+
+
+# Reads the {track_id: features} pairs saved by earlier, interrupted runs. A line a crash left half written is skipped,
+# the entries appended after it by later runs still count.
+def load_checkpoint(checkpoint_path):
+    done = {}
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                done[entry['id']] = entry['features']
+    return done
+
+
+# Opens a checkpoint for appending, starting on a new line if the last run stopped in the middle of one
+def _open_checkpoint(checkpoint_path):
+    ends_mid_line = False
+    if os.path.exists(checkpoint_path) and os.path.getsize(checkpoint_path):
+        with open(checkpoint_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            ends_mid_line = f.read(1) != b'\n'
+    checkpoint = open(checkpoint_path, 'a')
+    if ends_mid_line:
+        checkpoint.write('\n')
+    return checkpoint
+
+
+# Fetches one batch, waiting on the shared limiter before every attempt
+@trace.traced('fetch.batch')
+def _fetch_batch(client, limiter, batch):
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            return client.audio_features(batch)
+        except RateLimited as e:
+            print(f"Rate limiting in effect, sleeping for {e.retry_after} seconds.")
+            limiter.pause(e.retry_after)
+        except requests.RequestException:
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS:
+                raise
+            time.sleep(2 ** attempt + random.random())
+
+
+# Fetches the audio features of many tracks. Ids are sent in batches of up to 100, max_workers batches run at once,
+# and every request goes through one token bucket. When checkpoint_path is given, each finished batch is appended to
+# it, so rerunning after an interruption only fetches what is missing. When a FeatureCache is given, it is consulted
+# first and only the misses are requested (and then added to it).
+# Returns {track_id: features dict, or None when Spotify has no features for the track}.
+def fetch_all_audio_features(client, track_ids, batch_size=MAX_BATCH_SIZE, max_workers=4, limiter=None,
+                             checkpoint_path=None, cache=None, progress=True):
+    track_ids = list(dict.fromkeys(track_id for track_id in track_ids if track_id))
+    limiter = limiter or TokenBucket()
+    results = load_checkpoint(checkpoint_path)
+    if cache is not None:
+        results.update(cache.get_many([track_id for track_id in track_ids if track_id not in results]))
+    missing = [track_id for track_id in track_ids if track_id not in results]
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+
+    progress_bar = tqdm(total=len(track_ids), initial=len(track_ids) - len(missing), desc="Fetching audio features",
+                        unit="track", disable=not progress)
+    checkpoint = _open_checkpoint(checkpoint_path) if checkpoint_path else None
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(_fetch_batch, client, limiter, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                features = future.result()
+                if cache is not None:
+                    cache.put_many(dict(zip(batch, features)))
+                for track_id, track_features in zip(batch, features):
+                    results[track_id] = track_features
+                    if checkpoint:
+                        checkpoint.write(json.dumps({'id': track_id, 'features': track_features}) + '\n')
+                if checkpoint:
+                    checkpoint.flush()
+                progress_bar.update(len(batch))
+    finally:
+        if checkpoint:
+            checkpoint.close()
+        progress_bar.close()
+
+    return {track_id: results.get(track_id) for track_id in track_ids}
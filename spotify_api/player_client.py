@@ -0,0 +1,53 @@
+import spotipy
+from spotipy.oauth2 import SpotifyOAuth
+from spotify_api.feature_fetcher import RateLimited, pooled_session
+
+# Scope needed to add songs to the user's queue
+PLAYBACK_SCOPE = "user-modify-playback-state"
+
+
+# Player interface used by the queue service: add_to_queue(uri) queues one track on the user's active device and
+# raises RateLimited on a 429. This one goes through spotipy with a pooled connection.
+class SpotipyPlayerClient:
+    def __init__(self, sp, device_id=None):
+        self.sp = sp
+        self.device_id = device_id
+
+    def add_to_queue(self, uri):
+        try:
+            self.sp.add_to_queue(uri, device_id=self.device_id)
+        except spotipy.SpotifyException as e:
+            if e.http_status == 429:
+                raise RateLimited(int((e.headers or {}).get('Retry-After', 1)))
+            raise e
+
+
+# Same interface over plain HTTP, for any server that speaks the player queue endpoint (e.g. fake_spotify_server)
+class HttpPlayerClient:
+    def __init__(self, base_url, token=None, device_id=None, pool_size=4):
+        self.base_url = base_url.rstrip('/')
+        self.device_id = device_id
+        self.session = pooled_session(pool_size)
+        if token:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+
+    def add_to_queue(self, uri):
+        params = {'uri': uri}
+        if self.device_id:
+            params['device_id'] = self.device_id
+        response = self.session.post(f"{self.base_url}/v1/me/player/queue", params=params, timeout=10)
+        if response.status_code == 429:
+            raise RateLimited(int(response.headers.get('Retry-After', 1)))
+        response.raise_for_status()
+
+
+# spotipy player authorised for the user's playback, with a pooled session. spotipy's own retries are turned off so
+# 429s reach the caller.
+def make_spotipy_player(client_id, client_secret, redirect_uri="http://localhost:8080/callback", device_id=None,
+                        pool_size=4):
+    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=client_id,
+                                                   client_secret=client_secret,
+                                                   redirect_uri=redirect_uri,
+                                                   scope=PLAYBACK_SCOPE),
+                         requests_session=pooled_session(pool_size), retries=0, status_retries=0)
+    return SpotipyPlayerClient(sp, device_id)
@@ -0,0 +1,119 @@
+import argparse
+import configparser
+import os
+import time
+import numpy as np
+from playlist_io.playlist_store import load_playlist, write_store, store_path, STRING_FIELDS
+from graph_formation.feature_matrix import FeatureMatrix
+from graph_formation.topk_graph import TopKTable
+from spotify_api import feature_fetcher as ff
+from spotify_api.feature_cache import FeatureCache
+
+# Keeps a playlist's store (and optionally its top-k table and similarity graph) in line with the playlist on Spotify
+# without rewriting the XML file: only the tracks added since the last sync are fetched and appended, removed tracks
+# are tombstoned, and the graph only recomputes the neighbour lists the change touches.
+
+
+# What a sync changed. added_songs are the new tracks as song dicts (the format of shuffle_functions.load_songs), so
+# a running QueueService can add them to its index (see QueueService.apply_sync).
+class SyncResult:
+    def __init__(self, added_ids, removed_ids, added_songs, graph_rows_changed=0, elapsed=0.0):
+        self.added_ids = added_ids
+        self.removed_ids = removed_ids
+        self.added_songs = added_songs
+        self.graph_rows_changed = graph_rows_changed
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return (f"SyncResult(added={len(self.added_ids)}, removed={len(self.removed_ids)}, "
+                f"graph_rows_changed={self.graph_rows_changed}, elapsed={self.elapsed:.2f}s)")
+
+
+# Ids on the playlist that the store doesn't have, and ids in the store that are no longer on the playlist
+def diff_playlist(store, playlist_track_ids):
+    wanted = list(dict.fromkeys(track_id for track_id in playlist_track_ids if track_id))
+    ids = store.ids
+    live_ids = [ids[row] for row in store.live_rows.tolist() if ids[row] is not None]
+    live = set(live_ids)
+    wanted_set = set(wanted)
+    return [track_id for track_id in wanted if track_id not in live], \
+        [track_id for track_id in live_ids if track_id not in wanted_set]
+
+
+# Track elements the way pull_song_attributes.py writes them (title, id, artist and every feature that is present),
+# as {field: text} dicts like xml_stream.iter_tracks yields. Tracks without features are left out.
+def track_fields(tracks, all_audio_features):
+    fields = []
+    for track in tracks:
+        audio_features = all_audio_features.get(track['id'])
+        if audio_features:
+            element = {'title': track['name'], 'id': track['id'],
+                       'artist': ', '.join(artist['name'] for artist in track['artists'])}
+            element.update((name, str(value)) for name, value in audio_features.items() if value is not None)
+            fields.append(element)
+    return fields
+
+
+# Brings the store of xml_file up to date with `tracks` (the playlist's track objects, as in
+# sp.playlist_tracks(...)['items'][i]['track']). Audio features are fetched through `client` (and `cache`) for the
+# added tracks only. When table_path points to a saved TopKTable (built from unscaled store features), it is updated
+# and saved too, and its graph is written to graph_path when given.
+def sync_playlist(xml_file, tracks, client, cache=None, table_path=None, graph_path=None, progress=False):
+    start = time.perf_counter()
+    tracks = [track for track in tracks if track and track.get('id')]
+    store = load_playlist(xml_file)
+    added, removed = diff_playlist(store, [track['id'] for track in tracks])
+    if not added and not removed:
+        return SyncResult([], [], [], elapsed=time.perf_counter() - start)
+
+    by_id = {track['id']: track for track in tracks}
+    all_audio_features = ff.fetch_all_audio_features(client, added, cache=cache, progress=progress) if added else {}
+    new_tracks = track_fields([by_id[track_id] for track_id in added], all_audio_features)
+    num_rows = len(store)
+    store = store.append(new_tracks).remove(removed)
+    write_store(store, store.path or store_path(xml_file))
+
+    graph_rows_changed = 0
+    if table_path and os.path.exists(table_path):
+        table = TopKTable.load(table_path)
+        new_rows = FeatureMatrix.from_store(store, table.feature_matrix.attributes,
+                                            rows=np.arange(num_rows, len(store)))
+        graph_rows_changed = table.remove(removed) + table.add(new_rows)
+        table.save(table_path)
+        if graph_path:
+            table.to_graph().save(graph_path)
+
+    added_songs = [{name: value if name in STRING_FIELDS else float(value) for name, value in fields.items()}
+                   for fields in new_tracks]
+    return SyncResult([song['id'] for song in added_songs], removed, added_songs, graph_rows_changed,
+                      time.perf_counter() - start)
+
+
+# All track objects of a playlist, following the pagination
+def fetch_playlist_tracks(sp, playlist_id):
+    results = sp.playlist_tracks(playlist_id, fields="items.track(id,name,artists(name)),next")
+    items = list(results['items'])
+    while results['next']:
+        results = sp.next(results)
+        items.extend(results['items'])
+    return [item['track'] for item in items]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync a playlist's store (and top-k graph) with Spotify.")
+    parser.add_argument('playlist_id')
+    parser.add_argument('--xml-file', help="Defaults to ../xml_files/playlist_<playlist_id>.xml")
+    parser.add_argument('--table', help="TopKTable .npz to update, e.g. ../output/gabeMain_topk.npz")
+    parser.add_argument('--graph', help="Where to save the updated SimilarityGraph")
+    parser.add_argument('--config', default="../config/config.ini")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    client = ff.make_spotipy_client(config.get('spotifyCredentials', 'CLIENT_ID'),
+                                    config.get('spotifyCredentials', 'CLIENT_SECRET'))
+    xml_file = args.xml_file or f"../xml_files/playlist_{args.playlist_id}.xml"
+    with FeatureCache("../cache/audio_features.sqlite") as cache:
+        result = sync_playlist(xml_file, fetch_playlist_tracks(client.sp, args.playlist_id), client, cache,
+                               args.table, args.graph, progress=True)
+    print(result)
@@ -1,22 +1,8 @@
 import configparser
+import os
 import xml.etree.ElementTree as ET
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-import time
-from tqdm import tqdm  # Import the tqdm function
-
-
-def fetch_audio_features(sp, track_id):
-    while True:
-        try:
-            return sp.audio_features(track_id)[0]
-        except spotipy.SpotifyException as e:
-            if e.http_status == 429:
-                retry_after = int(e.headers['Retry-After'])
-                print(f"Rate limiting in effect, sleeping for {retry_after} seconds.")
-                time.sleep(retry_after)  # Adding 1 to ensure it waits enough.
-            else:
-                raise e
+from spotify_api import feature_fetcher as ff
+from spotify_api.feature_cache import FeatureCache
 
 
 # Read the configuration file
@@ -28,8 +14,8 @@ client_id = config.get('spotifyCredentials', 'CLIENT_ID')
 client_secret = config.get('spotifyCredentials', 'CLIENT_SECRET')
 
 # Spotify credentials and client setup
-client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+client = ff.make_spotipy_client(client_id, client_secret)
+sp = client.sp
 
 playlist_id = '2W3uVri9LqxSHLFZLsxMgJ'  # Replace with your playlist ID
 fields = "items.track(id,name,artists(name)),next"  # Define the fields you want to extract
@@ -47,15 +33,19 @@ while results['next']:
 # Create the XML structure for audio features
 root = ET.Element("playlist")
 
-# Initialize tqdm progress bar
-progress_bar = tqdm(total=len(tracks), desc="Processing tracks", unit="track")
+# Fetch audio features in batches of 100 on a few threads, handling rate limiting. Tracks already fetched for any
+# playlist come from the local cache, and progress is checkpointed so an interrupted run picks up where it stopped.
+checkpoint_path = "../xml_files/playlist_" + playlist_id + ".checkpoint.jsonl"
+with FeatureCache("../cache/audio_features.sqlite") as cache:
+    all_audio_features = ff.fetch_all_audio_features(client, [item['track']['id'] for item in tracks],
+                                                     checkpoint_path=checkpoint_path, cache=cache)
+    stats = cache.stats()
+    print(f"Audio feature cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
 
 for item in tracks:
     track = item['track']
     track_id = track['id']
-
-    # Fetch audio features for the track, handling rate limiting
-    audio_features = fetch_audio_features(sp, track_id)
+    audio_features = all_audio_features.get(track_id)
 
     if audio_features:
         track_element = ET.SubElement(root, "track")
@@ -70,11 +60,6 @@ for item in tracks:
             if feature_value is not None:
                 ET.SubElement(track_element, feature_name).text = str(feature_value)
 
-    progress_bar.update(1)  # Update the progress bar
-
-# Close the progress bar
-progress_bar.close()
-
 # Convert the XML structure to a string
 xml_str = ET.tostring(root, encoding='unicode')
 
@@ -83,4 +68,7 @@ with open("../xml_files/playlist_" + playlist_id + ".xml", "w") as f:
     f.write('<?xml version="1.0"?>\n')
     f.write(xml_str)
 
+# Everything is saved, the checkpoint is no longer needed
+os.remove(checkpoint_path)
+
 print("XML file with audio features created successfully.")
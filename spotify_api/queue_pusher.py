@@ -0,0 +1,161 @@
+import queue
+import random
+import threading
+import time
+import numpy as np
+import requests
+import spotipy
+from spotify_api.feature_fetcher import RateLimited, TokenBucket, MAX_ATTEMPTS
+from instrumentation import trace
+
+# Number of generated songs that may wait for the player before the generator is paused
+PUSH_BUFFER_SIZE = 32
+
+_DONE = object()
+
+
+# What happened to one song: when it was generated, picked up by the pusher and accepted by the player
+# (time.perf_counter() values), how many attempts the push took, and the error that stopped the pipeline, if any
+class PushResult:
+    def __init__(self, position, uri, generated_at, started_at=None, pushed_at=None, attempts=0, error=None):
+        self.position = position
+        self.uri = uri
+        self.generated_at = generated_at
+        self.started_at = started_at
+        self.pushed_at = pushed_at
+        self.attempts = attempts
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.pushed_at is not None
+
+    # Seconds between the song being generated and the player accepting it (time spent waiting for earlier songs,
+    # rate limiting and retries included)
+    @property
+    def latency(self):
+        return self.pushed_at - self.generated_at if self.ok else None
+
+    # Seconds spent pushing this song alone (rate limiting and retries included)
+    @property
+    def push_time(self):
+        return self.pushed_at - self.started_at if self.ok else None
+
+
+# Errors worth retrying: connection problems, timeouts and 5xx answers, from either player client. Other 4xx answers
+# (bad uri, expired token, no active device) would fail the same way every time.
+def is_transient(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+    elif isinstance(error, spotipy.SpotifyException):
+        status = error.http_status
+    else:
+        return False
+    return status is not None and status >= 500
+
+
+# Pushes songs to a player (anything with add_to_queue(uri), see player_client.py) while they are still being
+# generated. A producer thread pulls songs from the iterable into a bounded buffer and the calling thread pushes them
+# one at a time, in order. A 429 pauses the shared token bucket for its Retry-After and the same song is retried;
+# transient errors (see is_transient) are retried with exponential backoff up to max_attempts, others fail at once.
+# If a song still can't be pushed, nothing after it is pushed either, so the player's queue is always a prefix of the
+# generated one.
+class QueuePusher:
+    def __init__(self, player, limiter=None, buffer_size=PUSH_BUFFER_SIZE, max_attempts=MAX_ATTEMPTS, backoff=1.0):
+        self.player = player
+        self.limiter = limiter or TokenBucket()
+        self.buffer_size = buffer_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    # Waits for room in the buffer unless the consumer has stopped. Returns False when it has.
+    @staticmethod
+    def _put(buffer, item, stop):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, songs, buffer, stop):
+        try:
+            for song in songs:
+                if not self._put(buffer, (song, time.perf_counter()), stop):
+                    return
+            self._put(buffer, _DONE, stop)
+        except Exception as e:  # Handed to the consumer, which raises it
+            self._put(buffer, e, stop)
+        finally:
+            close = getattr(songs, 'close', None)
+            if close is not None:
+                close()
+
+    # Pushes one uri, waiting on the limiter before every attempt. Returns the number of attempts it took.
+    @trace.traced('push.add_to_queue')
+    def _push_one(self, uri):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            attempt += 1
+            try:
+                self.player.add_to_queue(uri)
+                return attempt
+            except RateLimited as e:
+                self.limiter.pause(e.retry_after)
+            except Exception as e:
+                if not is_transient(e) or attempt >= self.max_attempts:
+                    raise
+                time.sleep(self.backoff * (2 ** attempt + random.random()))
+
+    # Pushes every song (dicts with a 'uri') in order and returns a PushResult per song that reached the pusher.
+    # on_push(result) is called after each successful push, e.g. to log progress.
+    def push(self, songs, on_push=None):
+        buffer = queue.Queue(self.buffer_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(songs, buffer, stop), daemon=True)
+        producer.start()
+        results = []
+        try:
+            while True:
+                item = buffer.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                song, generated_at = item
+                result = PushResult(len(results), song['uri'], generated_at, time.perf_counter())
+                results.append(result)
+                try:
+                    result.attempts = self._push_one(song['uri'])
+                except Exception as e:
+                    result.error = e
+                    break
+                result.pushed_at = time.perf_counter()
+                if on_push is not None:
+                    on_push(result)
+        finally:
+            stop.set()
+            producer.join()
+        return results
+
+
+# Summary of a push: how many songs made it, the time until the first one was queued, and percentiles (ms) of the
+# per-song push time and of the generated-to-queued latency
+def latency_report(results):
+    pushed = [result for result in results if result.ok]
+    report = {
+        'pushed': len(pushed),
+        'failed': sum(1 for result in results if result.error is not None),
+        'retries': sum(max(result.attempts - 1, 0) for result in results),
+    }
+    if pushed:
+        report['first_push_ms'] = round(pushed[0].latency * 1000, 3)
+        for prefix, values in (('push', [result.push_time for result in pushed]),
+                               ('latency', [result.latency for result in pushed])):
+            for name, q in (('p50', 50), ('p95', 95), ('max', 100)):
+                report[f'{prefix}_{name}_ms'] = round(float(np.percentile(values, q)) * 1000, 3)
+    return report
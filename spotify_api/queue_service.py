@@ -0,0 +1,244 @@
+import argparse
+import configparser
+import json
+import os
+import threading
+import time
+from itertools import islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from shuffle import shuffle_functions as sf
+from shuffle.song_index import SongIndex
+from spotify_api.queue_pusher import QueuePusher, latency_report
+from spotify_api.player_client import make_spotipy_player, HttpPlayerClient
+
+# Resident queue service: loads the playlist and its neighbour index once, reloads them when the playlist file
+# changes, and answers "next N songs from seed X" over HTTP without reparsing or re-authenticating per request.
+#   GET  /next?seed=<track id>&n=<count>[&push=1][&rng_seed=<int>]  -> {"songs": [...], "elapsed_ms": ..., "push": ...}
+#   GET  /status                                                    -> library size, load time, cache counters
+#   POST /reload                                                    -> reloads the playlist now
+
+DEFAULT_ATTRIBUTES = ['danceability', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness',
+                      'liveness', 'valence', 'tempo']
+
+DEFAULT_WEIGHTS = {
+    'danceability': 1.2,
+    'energy': 1.5,
+    'loudness': 1,
+    'speechiness': 1,
+    'acousticness': 1.2,
+    'instrumentalness': 1.2,
+    'liveness': 1,
+    'valence': 0.8,
+    'tempo': 0
+}
+
+# Seconds between checks of the playlist file's modification time
+POLL_INTERVAL = 2.0
+
+# Largest queue a single request may ask for
+MAX_QUEUE_LENGTH = 1000
+
+SONG_FIELDS = ('id', 'title', 'artist', 'uri')
+
+
+# Songs and index of one version of the playlist file
+class Library:
+    def __init__(self, xml_file, weights, attributes, scaling, backend):
+        self.mtime = os.stat(xml_file).st_mtime_ns
+        self.songs = sf.load_songs(xml_file)
+        self.index = SongIndex(self.songs, weights, attributes, backend, scaling=scaling)
+        self.loaded_at = time.time()
+        # SongIndex's neighbour cache isn't thread-safe, so requests on the same library take turns
+        self.lock = threading.Lock()
+
+
+class QueueService:
+    def __init__(self, xml_file, weights=None, attributes=None, scaling='minmax', backend='kdtree', player=None,
+                 exponent=2, poll_interval=POLL_INTERVAL):
+        self.xml_file = xml_file
+        self.weights = dict(weights if weights is not None else DEFAULT_WEIGHTS)
+        self.attributes = list(attributes if attributes is not None else DEFAULT_ATTRIBUTES)
+        self.scaling = scaling
+        self.backend = backend
+        self.player = player
+        # One pusher for the whole service, so every request shares its rate limiter. Pushes take turns (push_lock),
+        # otherwise two requests' songs would interleave in the player's queue.
+        self.pusher = QueuePusher(player) if player is not None else None
+        self.push_lock = threading.Lock()
+        self.exponent = exponent
+        self.poll_interval = poll_interval
+        self.reload_lock = threading.Lock()
+        self.library = self._load()
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def _load(self):
+        return Library(self.xml_file, self.weights, self.attributes, self.scaling, self.backend)
+
+    # Loads the playlist again (when it changed, unless force=True). The new library is built next to the old one
+    # and swapped in at the end, so requests keep being answered while it loads. Returns True when it reloaded.
+    def reload(self, force=False):
+        with self.reload_lock:
+            if not force and os.stat(self.xml_file).st_mtime_ns == self.library.mtime:
+                return False
+            self.library = self._load()
+            return True
+
+    # Polls the playlist file on a background thread and reloads it when it changes
+    def start_watching(self):
+        def watch():
+            while not self._stop.wait(self.poll_interval):
+                try:
+                    self.reload()
+                except Exception as e:
+                    # e.g. a half-written file; keep serving the old library and try again on the next poll
+                    print(f"Reload of {self.xml_file} failed: {e}")
+
+        self._watcher = threading.Thread(target=watch, daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # Applies a playlist_sync.SyncResult to the loaded index in place instead of reloading the whole library
+    def apply_sync(self, result):
+        library = self.library
+        with library.lock:
+            library.index.add_songs(result.added_songs)
+            library.index.remove_songs(result.removed_ids)
+            library.songs = library.index.songs
+
+    # The seed song followed by the next n songs of its queue
+    def next_songs(self, seed, n, rng=None):
+        library = self.library
+        if seed not in library.index.positions:
+            raise KeyError(seed)
+        with library.lock:
+            return list(islice(sf.iter_song_queue(seed, library.songs, self.weights, self.attributes, self.exponent,
+                                                  index=library.index, rng=rng),
+                               n + 1))
+
+    # Adds the songs to the player's queue in order (see QueuePusher) and returns latency_report of the push. A push
+    # waits for any push already running, so every request's songs stay together.
+    def push(self, songs):
+        if self.pusher is None:
+            raise RuntimeError("No player client configured")
+        with self.push_lock:
+            results = self.pusher.push(songs)
+        return latency_report(results)
+
+    def status(self):
+        library = self.library
+        return {
+            'xml_file': self.xml_file,
+            'tracks': len(library.songs) - library.index.num_removed,
+            'loaded_at': library.loaded_at,
+            'backend': self.backend,
+            'scaling': self.scaling,
+            'cache_hits': library.index.cache_hits,
+            'cache_misses': library.index.cache_misses,
+        }
+
+
+class QueueRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == '/status':
+            self._send_json(200, service.status())
+            return
+        if url.path != '/next':
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        params = parse_qs(url.query)
+        seed = params.get('seed', [None])[0]
+        try:
+            n = int(params.get('n', ['20'])[0])
+            rng_seed = params.get('rng_seed', [None])[0]
+            rng = np.random.default_rng(int(rng_seed)) if rng_seed is not None else None
+        except ValueError:
+            self._send_json(400, {'error': 'n and rng_seed must be integers'})
+            return
+        if not seed or not 0 <= n <= MAX_QUEUE_LENGTH:
+            self._send_json(400, {'error': f'Expected a seed and 0 <= n <= {MAX_QUEUE_LENGTH}'})
+            return
+
+        start = time.perf_counter()
+        try:
+            songs = service.next_songs(seed, n, rng)
+        except KeyError:
+            self._send_json(404, {'error': f'Unknown song {seed}'})
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        body = {'songs': [{field: song.get(field) for field in SONG_FIELDS} for song in songs],
+                'elapsed_ms': round(elapsed_ms, 3)}
+        if params.get('push', ['0'])[0] == '1':
+            try:
+                body['push'] = service.push(songs[1:])
+            except Exception as e:
+                self._send_json(502, {'error': f'Pushing to the player failed: {e}'})
+                return
+            if body['push']['failed']:
+                self._send_json(502, dict(body, error='Pushing to the player failed'))
+                return
+        self._send_json(200, body)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/reload':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        self.server.service.reload(force=True)
+        self._send_json(200, self.server.service.status())
+
+
+# Starts the HTTP front end on a background thread and returns (server, base_url). Call server.shutdown() to stop it.
+def start_queue_server(service, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), QueueRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve song queues from a playlist XML file.")
+    parser.add_argument('xml_file')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--player-url', help="Push to this player API (e.g. fake_spotify_server) instead of Spotify")
+    parser.add_argument('--config', default="../config/config.ini")
+    args = parser.parse_args()
+
+    if args.player_url:
+        player = HttpPlayerClient(args.player_url)
+    else:
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        player = make_spotipy_player(config.get('spotifyCredentials', 'CLIENT_ID'),
+                                     config.get('spotifyCredentials', 'CLIENT_SECRET'))
+
+    service = QueueService(args.xml_file, player=player)
+    service.start_watching()
+    server, base_url = start_queue_server(service, port=args.port)
+    print(f"Queue service for {len(service.library.songs)} songs listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        service.stop()
+        server.shutdown()
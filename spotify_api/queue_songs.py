@@ -1,11 +1,13 @@
 import configparser
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
+import sys
+from itertools import islice
 from shuffle import shuffle_functions as sf
+from spotify_api.player_client import make_spotipy_player
+from spotify_api.queue_pusher import QueuePusher, latency_report
 xml_file = "../xml_files/playlist_5X13HtrTfhv5JpnTeMtL0D.xml"  # Your XML data goes here
 
-# Parse XML data
-songs = sf.parse_xml(xml_file)
+# Load the playlist (from its binary store when it is up to date)
+songs = sf.load_songs(xml_file)
 
 # Weights dictionary (customize as needed)
 attribute_keys = ['danceability',
@@ -56,9 +58,10 @@ weights = {
 # Carry On - Fun: 7gpy7sfWPNuOKmUNs3XQYE
 # Don't You Worry 'Bout a Thing: Stevie Wonder: 1QvWxgZvTU0w8rlPRE5Zrv
 
-initial_song_id = input("Please enter the starting song ID: ")  # Replace with your actual initial song ID
-num_songs_to_queue = input("How many songs do you want me to queue?: ")  # Number of songs you want in the queue
-queued_songs = sf.generate_song_queue(initial_song_id, songs, weights, attribute_keys, num_songs_to_queue)
+# Usage: python queue_songs.py <starting song ID> [number of songs to queue]
+# For repeated queueing, run queue_service.py instead: it keeps the playlist, index and Spotify client loaded.
+initial_song_id = sys.argv[1]
+num_songs_to_queue = int(sys.argv[2]) if len(sys.argv) > 2 else 20
 
 # Read the configuration file
 config = configparser.ConfigParser()
@@ -68,18 +71,16 @@ config.read("../config/config.ini")
 client_id = config.get('spotifyCredentials', 'CLIENT_ID')
 client_secret = config.get('spotifyCredentials', 'CLIENT_SECRET')
 
-# Spotify credentials and client setup
-client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=client_id,
-                                               client_secret=client_secret,
-                                               redirect_uri="http://localhost:8080/callback",
-                                               scope="user-modify-playback-state"))
-
-
-
-
-# For each song in your queue
-for song in queued_songs:
-    track_uri = song['uri']  # Assuming 'uri' is a part of your song dictionary
-    sp.add_to_queue(track_uri, device_id=None)  # If you know the device ID, you can specify it here
+# Spotify player client (authorised for playback, pooled connections). If you know the device ID, you can specify it
+player = make_spotipy_player(client_id, client_secret, device_id=None)
 
+# Min-max scale every attribute over the playlist so loudness (in dB) and tempo (in BPM) don't outweigh the rest.
+# The queue is generated lazily and the pusher starts queueing the first songs while later ones are being chosen
+# (+1 because the initial song is also in the queue).
+queued_songs = islice(sf.iter_song_queue(initial_song_id, songs, weights, attribute_keys, scaling='minmax'),
+                      num_songs_to_queue + 1)
+results = QueuePusher(player).push(queued_songs)
+print(latency_report(results))
+for result in results:
+    if result.error is not None:
+        print(f"Stopped at {result.uri}: {result.error}")
@@ -0,0 +1,69 @@
+import numpy as np
+from graph_formation.communities import Clustering
+from shuffle.cluster_shuffle import ClusterSearch, iter_cluster_queue
+from shuffle.song_index import SongIndex
+
+ATTRIBUTES = ['danceability', 'energy', 'valence']
+WEIGHTS = {'danceability': 1, 'energy': 1, 'valence': 1}
+
+
+def _songs(count, prefix, seed):
+    rng = np.random.default_rng(seed)
+    return [dict(zip(ATTRIBUTES, values.tolist()), id=f"{prefix}{i}", uri=f"spotify:track:{prefix}{i}")
+            for i, values in enumerate(rng.random((count, len(ATTRIBUTES))))]
+
+
+def _search(num_songs=1000, num_clusters=20):
+    index = SongIndex(_songs(num_songs, 'song', 0), WEIGHTS, ATTRIBUTES)
+    clustering = Clustering.from_vectors(index.vectors, index.song_ids, num_clusters)
+    return index, ClusterSearch(index, clustering)
+
+
+def test_queue_from_song_added_after_search_was_built():
+    index, search = _search()
+    added = _songs(10, 'added', 1)
+    index.add_songs(added)
+
+    queue = list(iter_cluster_queue(added[5]['id'], None, WEIGHTS, ATTRIBUTES, search, drift=0.2,
+                                    rng=np.random.default_rng(0)))
+
+    assert queue[0]['id'] == added[5]['id']
+    assert len(queue) == len(index)
+    assert len({song['id'] for song in queue}) == len(index)
+    assert len(search.labels) == len(index)
+    assert sum(len(members) for members in search.members) == len(index)
+
+
+def test_added_songs_join_the_closest_cluster():
+    index, search = _search()
+    index.add_songs(_songs(10, 'added', 1))
+    search.update()
+
+    added = np.arange(1000, len(index))
+    distances = np.linalg.norm(index.vectors[added, None, :] - search.centres[None, :, :], axis=2)
+    assert (search.labels[added] == distances.argmin(axis=1)).all()
+    for position, cluster in zip(added.tolist(), search.labels[added].tolist()):
+        assert position in search.members[cluster]
+
+
+def test_songs_added_during_the_walk_are_queued():
+    index, search = _search(200, 5)
+    queue = iter_cluster_queue('song0', None, WEIGHTS, ATTRIBUTES, search, rng=np.random.default_rng(0))
+    first = [next(queue) for _ in range(10)]
+    index.add_songs(_songs(5, 'added', 1))
+
+    rest = list(queue)
+    ids = [song['id'] for song in first + rest]
+    assert len(ids) == len(set(ids))
+    assert len(ids) == len(index)
+
+
+def test_removed_songs_are_never_queued():
+    index, search = _search(300, 6)
+    removed = [f"song{i}" for i in range(100, 150)]
+    index.remove_songs(removed)
+
+    queue = list(iter_cluster_queue('song0', None, WEIGHTS, ATTRIBUTES, search, rng=np.random.default_rng(0)))
+
+    assert not {song['id'] for song in queue} & set(removed)
+    assert len(queue) == len(index) - len(removed)
@@ -0,0 +1,37 @@
+import json
+from spotify_api.feature_fetcher import fetch_all_audio_features, load_checkpoint
+
+
+class FakeClient:
+    def __init__(self):
+        self.requested = []
+
+    def audio_features(self, track_ids):
+        self.requested.extend(track_ids)
+        return [{'id': track_id, 'energy': 0.5} for track_id in track_ids]
+
+
+def _entry(track_id):
+    return json.dumps({'id': track_id, 'features': {'id': track_id, 'energy': 0.5}}) + '\n'
+
+
+def test_entries_after_a_truncated_line_are_loaded(tmp_path):
+    path = tmp_path / 'checkpoint.jsonl'
+    path.write_text(_entry('a') + _entry('b')[:15] + '\n' + _entry('c') + _entry('d'))
+
+    assert set(load_checkpoint(path)) == {'a', 'c', 'd'}
+
+
+def test_resume_after_a_crash_mid_write(tmp_path):
+    path = tmp_path / 'checkpoint.jsonl'
+    path.write_text(_entry('a') + _entry('b')[:15])
+
+    client = FakeClient()
+    fetch_all_audio_features(client, ['a', 'b', 'c'], batch_size=1, max_workers=1, checkpoint_path=str(path),
+                             progress=False)
+    assert sorted(client.requested) == ['b', 'c']
+
+    client = FakeClient()
+    results = fetch_all_audio_features(client, ['a', 'b', 'c'], checkpoint_path=str(path), progress=False)
+    assert client.requested == []
+    assert set(results) == {'a', 'b', 'c'}